@@ -0,0 +1,205 @@
+# AdaptiveConcurrency.py
+
+'''
+Adaptive limit on the number of concurrently running samples of a batch
+(e.g. Netmorph sample runs with BatchRun), adjusted AIMD-style after
+each wave of samples:
+- additive increase: when a wave had few request failures, enough free
+  server RAM, and the limit was actually reached, the limit goes up by
+  increase_step,
+- multiplicative decrease: when the failure rate of requests in a wave
+  exceeds max_failure_rate, or free server RAM dropped below lowbytes,
+  the limit is multiplied by decrease_factor, and it is not increased
+  again after the next wave.
+
+This converges on the largest number of concurrent samples the server
+handles without comms failures, which is where completed samples per
+hour are highest, instead of relying on a fixed batch size.
+
+The controller does not launch anything itself. The caller runs the
+batch in waves, each with a plain integer batch size of limit, and calls
+adjust() between waves (see run_samples() in gen_autonm_labels.py):
+
+    scheduler = AIMDController(initial=4, max_limit=batchsize, lowbytes=RESOURCESLOWBYTES)
+    while samples remain:
+        batchrun = BatchRun(..., from_sample=start, to_sample=start+scheduler.wave_size())
+        scheduler.attach(batchrun)   # observe RTsuccess()/RTfailed()
+        batchrun.monitor_batch(..., batchsize=scheduler.limit, ...)
+        scheduler.adjust()
+
+    # in the evaluation function called for each running sample:
+    scheduler.poll(batchrun.ClientInstance, batchrun.runs_running())
+'''
+
+import json
+import threading
+import time
+from datetime import datetime
+
+# Keys of free RAM in GetResourceStatus() responses. BatchRun records free
+# RAM as OSRAMfree in resource_checks.json, deletesimtest.py reads RAMfree.
+RAMFREEKEYS = ( 'OSRAMfree', 'RAMfree' )
+
+class AIMDController:
+    def __init__(self, initial:int, min_limit=1, max_limit:int=None, increase_step=1, decrease_factor=0.5, period_s=30.0, lowbytes:int=None, headroom=2.0, max_failure_rate=0.05, wave_multiple=4):
+        '''
+        lowbytes is the free server RAM below which the limit is decreased.
+        The limit is only increased while free RAM is at least
+        headroom*lowbytes. With lowbytes None, RAM is not checked. Free RAM
+        is retrieved at most once every period_s. A wave holds
+        wave_multiple*limit samples.
+        '''
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max_limit
+        self.limit = self.clamp(initial)
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.period_s = period_s
+        self.lowbytes = lowbytes
+        self.headroom = headroom
+        self.max_failure_rate = max_failure_rate
+        self.wave_multiple = wave_multiple
+
+        self.lock = threading.Lock()
+        self.T_start = time.time()
+        self.T_RAMchecked = 0.0
+        self.RAMkey_missing = False
+        self.successes = 0
+        self.failures = 0
+        self.max_running = 0
+        self.min_RAMfree = None
+        self.cooldown = False
+        self.completed = 0
+        self.history = []
+
+    def clamp(self, limit)->int:
+        limit = max(self.min_limit, int(limit))
+        if self.max_limit is not None:
+            limit = min(limit, self.max_limit)
+        return limit
+
+    def wave_size(self)->int:
+        return self.limit * self.wave_multiple
+
+    # --- Observations
+
+    def request(self, success:bool):
+        with self.lock:
+            if success:
+                self.successes += 1
+            else:
+                self.failures += 1
+
+    def sample_completed(self):
+        with self.lock:
+            self.completed += 1
+
+    def samples_per_hour(self)->float:
+        hours = (time.time() - self.T_start) / 3600.0
+        if hours <= 0:
+            return 0.0
+        return self.completed / hours
+
+    def attach(self, batchrun):
+        '''
+        Wraps RTsuccess() and RTfailed() of a BatchRun instance (including
+        its own internal calls), so that all tracked request outcomes are
+        observed.
+        '''
+        RTsuccess = batchrun.RTsuccess
+        RTfailed = batchrun.RTfailed
+        def tracked_success(*args, **kwargs):
+            self.request(True)
+            return RTsuccess(*args, **kwargs)
+        def tracked_failed(*args, **kwargs):
+            self.request(False)
+            return RTfailed(*args, **kwargs)
+        batchrun.RTsuccess = tracked_success
+        batchrun.RTfailed = tracked_failed
+
+    def RAMfree(self, ClientInstance):
+        '''
+        Free server RAM in bytes, or None if it could not be determined.
+        A failed request counts as a request failure, a response without
+        a known free RAM key does not.
+        '''
+        try:
+            resources = ClientInstance.GetResourceStatus()
+        except Exception as e:
+            print('AIMDController: Unable to retrieve resource status: '+str(e))
+            self.request(False)
+            return None
+        self.request(True)
+        if isinstance(resources, dict):
+            for key in RAMFREEKEYS:
+                if key in resources:
+                    return resources[key]
+        if not self.RAMkey_missing:
+            print('AIMDController: No free RAM in resource status response, adapting to request failures only.')
+            self.RAMkey_missing = True
+        return None
+
+    def poll(self, ClientInstance, running:int):
+        '''
+        Call frequently (e.g. for each status check). Tracks the number of
+        running samples and, once per period_s, the free server RAM.
+        '''
+        with self.lock:
+            self.max_running = max(self.max_running, running)
+            check_RAM = self.lowbytes is not None and ClientInstance is not None and not self.RAMkey_missing and time.time() - self.T_RAMchecked >= self.period_s
+            if check_RAM:
+                self.T_RAMchecked = time.time()
+        if check_RAM:
+            RAMfree = self.RAMfree(ClientInstance)
+            if RAMfree is not None:
+                with self.lock:
+                    self.min_RAMfree = RAMfree if self.min_RAMfree is None else min(self.min_RAMfree, RAMfree)
+
+    # --- Control
+
+    def adjust(self)->int:
+        '''
+        Applies AIMD to the observations since the last call (one wave)
+        and returns the new limit.
+        '''
+        with self.lock:
+            RAMfree = self.min_RAMfree
+            requests = self.successes + self.failures
+            failure_rate = self.failures / requests if requests > 0 else 0.0
+            low_RAM = self.lowbytes is not None and RAMfree is not None and RAMfree < self.lowbytes
+            previous = self.limit
+            if failure_rate > self.max_failure_rate or low_RAM:
+                self.limit = self.clamp(self.limit * self.decrease_factor)
+                self.cooldown = True
+            elif self.cooldown:
+                self.cooldown = False
+            else:
+                RAM_ok = self.lowbytes is None or RAMfree is None or RAMfree >= self.headroom*self.lowbytes
+                if RAM_ok and self.max_running >= self.limit:
+                    self.limit = self.clamp(self.limit + self.increase_step)
+
+            entry = {
+                'T': datetime.now().strftime('%Y%m%d%H%M%S'),
+                'limit': self.limit,
+                'previous': previous,
+                'max_running': self.max_running,
+                'requests': requests,
+                'failures': self.failures,
+                'min_RAMfree': RAMfree,
+                'completed': self.completed,
+                'samples_per_hour': self.samples_per_hour(),
+            }
+            self.history.append(entry)
+            RAMinfo = 'unknown' if RAMfree is None else '%.2f GB' % (float(RAMfree)/(1024*1024*1024))
+            print('AIMDController: Concurrent samples %d -> %d (max running %d, %d of %d requests failed, min RAM free %s, %.1f samples/h)' % (previous, self.limit, self.max_running, self.failures, requests, RAMinfo, entry['samples_per_hour']))
+
+            self.successes = 0
+            self.failures = 0
+            self.max_running = 0
+            self.min_RAMfree = None
+            return self.limit
+
+    def save_history(self, filepath:str):
+        with self.lock:
+            with open(filepath, 'w') as f:
+                json.dump(self.history, f, indent=1)
@@ -0,0 +1,135 @@
+# AsyncMonitor.py
+
+'''
+Concurrent monitoring of batches of NES simulations (e.g. Netmorph
+sample runs) with asyncio.
+
+The NES client calls are blocking, so AsyncNESCalls runs them on a
+bounded thread pool and awaits them with a per-request timeout. This
+lets status, ModelSave, GetConnectome and DeleteResidentByID requests
+for many simulations be in flight at the same time, without one slow
+response holding up the rest.
+
+monitor_runs() polls every running sample in its own task. Each time a
+status arrives, the handler for that sample is awaited immediately, so
+completion handling (saving, connectome checks, freeing memory) starts
+as soon as a sample is done instead of at the end of a sweep over the
+whole batch. A run whose status requests keep failing, or that is not
+done by a deadline, is given up with status 'failed'.
+
+Example:
+
+    async def on_status(calls, run, status):
+        Percent, NetmorphStatus = status
+        if NetmorphStatus == 'Done':
+            await calls.call(run['Sim'].ModelSave, run['modelname'])
+            return 'completed'
+        return 'running'
+
+    run_monitor(runs, lambda run: run['Sim'].Netmorph_GetStatus, on_status)
+'''
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+class AsyncNESCalls:
+    def __init__(self, max_concurrent=8, timeout_s=60.0):
+        '''
+        At most max_concurrent blocking calls are in flight at once.
+        A call that takes longer than timeout_s raises asyncio.TimeoutError.
+        Note that the timed out call keeps its worker thread until the
+        NES client returns, since blocking calls cannot be cancelled.
+        '''
+        self.max_concurrent = max_concurrent
+        self.timeout_s = timeout_s
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrent)
+
+    def submit(self, func, *args, **kwargs):
+        return self.executor.submit(func, *args, **kwargs)
+
+    async def wait(self, future, timeout_s:float=None):
+        '''
+        Awaits a call made with submit(). On a timeout the call is left
+        to finish in its worker, so that it can be awaited again.
+        '''
+        if timeout_s is None:
+            timeout_s = self.timeout_s
+        return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout=timeout_s)
+
+    async def call(self, func, *args, timeout_s:float=None, **kwargs):
+        future = self.submit(func, *args, **kwargs)
+        try:
+            return await self.wait(future, timeout_s)
+        except asyncio.TimeoutError:
+            future.cancel() # Only has an effect while the call is still queued.
+            raise
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+async def monitor_run(calls:AsyncNESCalls, run:dict, statusfunc, handler, poll_interval_s:float, max_failures=10, deadline_s:float=None):
+    '''
+    Polls one run until handler returns a status other than 'running'.
+    Failed or timed out status requests are retried after poll_interval_s,
+    as they are often momentary communication problems. While a timed out
+    status request is still running in its worker, that request is awaited
+    again instead of sending another one, so a stuck run does not take up
+    more workers. After max_failures consecutive failed or timed out status
+    requests, or when the run is not done deadline_s after monitoring
+    started, the run is given up with status 'failed'.
+    '''
+    T_start = time.time()
+    failures = 0
+    pending = None
+    while True:
+        if pending is None:
+            pending = calls.submit(statusfunc(run))
+        try:
+            status = await calls.wait(pending)
+            pending = None
+            failures = 0
+        except Exception as e:
+            if pending.done():
+                pending = None
+            failures += 1
+            if failures >= max_failures:
+                print('...giving up on sample run %s after %d consecutive failed status requests: %s' % (str(run.get('runID')), failures, str(e) or type(e).__name__))
+                run['status'] = 'failed'
+                return run
+            print('...failed to retrieve status for sample run %s, continuing (possible momentary comms problem): %s' % (str(run.get('runID')), str(e) or type(e).__name__))
+        else:
+            run['status'] = await handler(calls, run, status)
+            if run['status'] != 'running':
+                return run
+        if deadline_s is not None and time.time() - T_start >= deadline_s:
+            print('...giving up on sample run %s, not done after %.1f seconds' % (str(run.get('runID')), deadline_s))
+            run['status'] = 'failed'
+            return run
+        await asyncio.sleep(poll_interval_s)
+
+async def monitor_runs_async(runs:list, statusfunc, handler, max_concurrent=8, timeout_s=60.0, poll_interval_s=1.0, max_failures=10, deadline_s:float=None)->list:
+    calls = AsyncNESCalls(max_concurrent, timeout_s)
+    try:
+        tasks = [ asyncio.create_task(monitor_run(calls, run, statusfunc, handler, poll_interval_s, max_failures, deadline_s)) for run in runs if run['status'] == 'running' ]
+        finished = []
+        for task in asyncio.as_completed(tasks):
+            finished.append(await task)
+        return finished
+    finally:
+        calls.shutdown()
+
+def run_monitor(runs:list, statusfunc, handler, max_concurrent=8, timeout_s=60.0, poll_interval_s=1.0, max_failures=10, deadline_s:float=None)->list:
+    '''
+    Monitors all runs with status 'running' until each is done.
+    - statusfunc(run) returns the blocking status call to make, e.g.
+      run['Sim'].Netmorph_GetStatus.
+    - handler(calls, run, status) is a coroutine that returns the new
+      status of the run ('running', 'completed', 'failed', ...). It can
+      make further requests with await calls.call(...).
+    - A run is given up as 'failed' after max_failures consecutive failed
+      status requests, or if it is not done after deadline_s (None for no
+      deadline).
+    Returns the finished runs in the order in which they finished.
+    '''
+    return asyncio.run(monitor_runs_async(runs, statusfunc, handler, max_concurrent, timeout_s, poll_interval_s, max_failures, deadline_s))
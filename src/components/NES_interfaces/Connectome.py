@@ -0,0 +1,244 @@
+# Connectome.py
+
+'''
+Sparse representation of the connectome returned by NES GetConnectome().
+
+The NES response holds one list per presynaptic neuron for each of
+ConnectionTargets, ConnectionTypes, ConnectionWeights, ConnectionGPeakSum
+and NumReceptors. Connectome flattens these in a single pass into COO
+arrays (pre, post, receptor type and one value array per quantity).
+From there:
+- receptor('AMPA') returns a view restricted to one receptor type.
+- aggregate() sums parallel connections into unique (pre, post) pairs.
+- csr() returns the aggregated matrix as (indptr, indices, data).
+- out_sums() and in_sums() aggregate by pre- or postsynaptic neuron.
+- dense() builds an N x N matrix, only when it is really needed (e.g.
+  for plot_weights).
+
+AbstractConnectome does the same for GetAbstractConnectome(Sparse=True),
+with edges indexed by pre- and postsynaptic neuron, a neuron to region
+array and a mask of the edges that are still active, so that usable path
+analysis can eliminate edges with vectorized mask operations.
+'''
+
+import numpy as np
+
+RECEPTOR_TYPES = {
+    'AMPA': 1,
+    'GABA': 2,
+    'NMDA': 3,
+}
+
+# Quantity names used by the scripts and the NES response keys they map to.
+QUANTITIES = {
+    'weights': 'ConnectionWeights',
+    'conductance': 'ConnectionGPeakSum',
+    'numreceptors': 'NumReceptors',
+}
+
+def flatten_lists(lists:list, dtype)->np.ndarray:
+    if len(lists) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.fromiter((v for sublist in lists for v in sublist), dtype=dtype)
+
+class Connectome:
+    def __init__(self, num_neurons:int, pre:np.ndarray, post:np.ndarray, types:np.ndarray, values:dict):
+        self.num_neurons = num_neurons
+        self.pre = pre
+        self.post = post
+        self.types = types
+        self.values = values
+
+    @classmethod
+    def from_nes(cls, connections_dict:dict):
+        '''
+        Build from a GetConnectome() response. Quantities missing in the
+        response are left out of values.
+        '''
+        targets = connections_dict['ConnectionTargets']
+        num_neurons = len(targets)
+        counts = np.fromiter((len(t) for t in targets), dtype=np.int64, count=num_neurons)
+        pre = np.repeat(np.arange(num_neurons, dtype=np.int32), counts)
+        post = flatten_lists(targets, np.int32)
+        types = flatten_lists(connections_dict['ConnectionTypes'], np.int8)
+        if len(post) != len(pre) or len(types) != len(pre):
+            raise Exception('Connectome: ConnectionTargets and ConnectionTypes do not match.')
+        values = {}
+        for quantity, nes_key in QUANTITIES.items():
+            if nes_key in connections_dict:
+                values[quantity] = flatten_lists(connections_dict[nes_key], np.float64)
+                if len(values[quantity]) != len(pre):
+                    raise Exception('Connectome: %s does not match ConnectionTargets.' % nes_key)
+        return cls(num_neurons, pre, post, types, values)
+
+    def __len__(self)->int:
+        return len(self.pre)
+
+    def select(self, mask:np.ndarray):
+        return Connectome(
+            self.num_neurons,
+            self.pre[mask],
+            self.post[mask],
+            self.types[mask],
+            { quantity: v[mask] for quantity, v in self.values.items() })
+
+    def receptor(self, receptor:str):
+        '''
+        View of the connections with receptor type 'AMPA', 'GABA' or 'NMDA'.
+        '''
+        if receptor not in RECEPTOR_TYPES:
+            raise Exception('Connectome: Unknown receptor type %s.' % str(receptor))
+        return self.select(self.types == RECEPTOR_TYPES[receptor])
+
+    def quantity(self, usematrix:str)->np.ndarray:
+        if usematrix not in self.values:
+            raise Exception('Connectome: No %s in connectome.' % str(usematrix))
+        return self.values[usematrix]
+
+    def total(self, usematrix='weights')->float:
+        return float(self.quantity(usematrix).sum())
+
+    def presynaptic(self)->np.ndarray:
+        '''
+        Sorted IDs of neurons with at least one connection in this view.
+        '''
+        return np.unique(self.pre)
+
+    def aggregate(self, usematrix='weights')->tuple:
+        '''
+        Sums parallel connections. Returns (pre, post, summed) for unique
+        (pre, post) pairs, sorted by pre then post.
+        '''
+        pair = self.pre.astype(np.int64)*self.num_neurons + self.post
+        unique_pairs, inverse = np.unique(pair, return_inverse=True)
+        summed = np.bincount(inverse, weights=self.quantity(usematrix), minlength=len(unique_pairs))
+        return (unique_pairs // self.num_neurons).astype(np.int32), (unique_pairs % self.num_neurons).astype(np.int32), summed
+
+    def csr(self, usematrix='weights')->tuple:
+        '''
+        Returns the aggregated matrix as CSR (indptr, indices, data), with
+        rows by presynaptic and columns by postsynaptic neuron.
+        '''
+        pre, post, summed = self.aggregate(usematrix)
+        indptr = np.zeros(self.num_neurons+1, dtype=np.int64)
+        np.cumsum(np.bincount(pre, minlength=self.num_neurons), out=indptr[1:])
+        return indptr, post, summed
+
+    def out_sums(self, usematrix='weights')->np.ndarray:
+        return np.bincount(self.pre, weights=self.quantity(usematrix), minlength=self.num_neurons)
+
+    def in_sums(self, usematrix='weights')->np.ndarray:
+        return np.bincount(self.post, weights=self.quantity(usematrix), minlength=self.num_neurons)
+
+    def dense(self, usematrix='weights')->np.ndarray:
+        matrix = np.zeros((self.num_neurons, self.num_neurons))
+        np.add.at(matrix, (self.pre, self.post), self.quantity(usematrix))
+        return matrix
+
+def prepost_pyramidal_AMPA(connections_dict:dict, dense=True)->tuple:
+    '''
+    Pyramidal neurons are those with at least one AMPA connection.
+    Returns (pyramidal, gpeaksum), where gpeaksum is the N x N matrix of
+    combined AMPA peak conductances between pre-post pairs (dense=True),
+    or the aggregated (pre, post, summed) COO triplet (dense=False).
+    '''
+    ampa = Connectome.from_nes(connections_dict).receptor('AMPA')
+    pyramidal = [ int(n) for n in ampa.presynaptic() ]
+    if dense:
+        return pyramidal, ampa.dense('conductance')
+    return pyramidal, ampa.aggregate('conductance')
+
+class AbstractConnectome:
+    '''
+    Indexed graph of a GetAbstractConnectome(Sparse=True) response, whose
+    PrePostNumReceptors is a list of [pre, post, numreceptors] triples.
+    Holds:
+    - pre, post, numreceptors: edge arrays.
+    - active: boolean mask of edges still in use.
+    - region_of: region index of every neuron ID (-1 if in no region),
+      with region_names giving the name of each index. A neuron listed in
+      several regions gets the last of them.
+    - in_indptr/in_edges and out_indptr/out_edges: edge indices grouped by
+      post- and presynaptic neuron, so that the edges of a neuron are
+      found without scanning the whole list.
+    '''
+    def __init__(self, response:dict):
+        edges = np.asarray(response['PrePostNumReceptors'], dtype=np.int64).reshape(-1, 3)
+        self.pre = edges[:, 0]
+        self.post = edges[:, 1]
+        self.numreceptors = edges[:, 2]
+        self.active = np.ones(len(edges), dtype=bool)
+
+        regions = response['Regions']
+        self.region_names = list(regions.keys())
+        max_id = max([ -1 ] + [ int(edges[:, :2].max()) if len(edges) > 0 else -1 ] + [ max(ids) for ids in regions.values() if len(ids) > 0 ])
+        self.num_neurons = max_id + 1
+        self.regions = regions
+        # Where regions overlap, the last region listed wins, as in the
+        # neuron-to-region map of the list-based code that this replaces.
+        self.region_of = np.full(self.num_neurons, -1, dtype=np.int32)
+        for reg_idx in range(len(self.region_names)):
+            self.region_of[np.asarray(regions[self.region_names[reg_idx]], dtype=np.int64)] = reg_idx
+
+        self.in_indptr, self.in_edges = self.group_edges(self.post)
+        self.out_indptr, self.out_edges = self.group_edges(self.pre)
+
+    def group_edges(self, by:np.ndarray)->tuple:
+        order = np.argsort(by, kind='stable')
+        indptr = np.zeros(self.num_neurons+1, dtype=np.int64)
+        np.cumsum(np.bincount(by, minlength=self.num_neurons), out=indptr[1:])
+        return indptr, order
+
+    def region_index(self, region:str)->int:
+        if region not in self.region_names:
+            return -2 # Matches no neuron, not even those outside all regions.
+        return self.region_names.index(region)
+
+    def region_ids(self, region:str)->np.ndarray:
+        return np.flatnonzero(self.region_of == self.region_index(region))
+
+    def region_pair_counts(self)->dict:
+        '''
+        Returns {pre region: {post region: number of edges}}, with 'unknown'
+        for neurons that are in no region. A neuron in several regions is
+        counted in the first of them.
+        '''
+        names = self.region_names + [ 'unknown' ]
+        codes = np.full(self.num_neurons, len(names)-1, dtype=np.int64)
+        for reg_idx in reversed(range(len(self.region_names))):
+            codes[np.asarray(self.regions[self.region_names[reg_idx]], dtype=np.int64)] = reg_idx
+        pairs, counts = np.unique(codes[self.pre]*len(names) + codes[self.post], return_counts=True)
+        PreRegions = {}
+        for pair, count in zip(pairs, counts):
+            PreRegions.setdefault(names[pair // len(names)], {})[names[pair % len(names)]] = int(count)
+        return PreRegions
+
+    def active_inputs_to(self, neuron_id:int)->np.ndarray:
+        edges = self.in_edges[self.in_indptr[neuron_id]:self.in_indptr[neuron_id+1]]
+        return self.pre[edges[self.active[edges]]]
+
+    def active_outputs_from(self, neuron_id:int)->np.ndarray:
+        edges = self.out_edges[self.out_indptr[neuron_id]:self.out_indptr[neuron_id+1]]
+        return self.post[edges[self.active[edges]]]
+
+    def active_input_counts(self, source_region:str=None)->np.ndarray:
+        '''
+        Number of active input edges of every neuron, optionally only
+        counting edges from neurons in source_region.
+        '''
+        mask = self.active
+        if source_region is not None:
+            mask = mask & (self.region_of[self.pre] == self.region_index(source_region))
+        return np.bincount(self.post[mask], minlength=self.num_neurons)
+
+    def eliminate_by_post(self, neuron_ids):
+        self.active[np.isin(self.post, neuron_ids)] = False
+
+    def eliminate_by_pre(self, neuron_ids):
+        self.active[np.isin(self.pre, neuron_ids)] = False
+
+    def num_active(self)->int:
+        return int(self.active.sum())
+
+    def active_str(self)->str:
+        return ''.join([ '[%s -> %s], ' % (pre, post) for pre, post in zip(self.pre[self.active], self.post[self.active]) ])
@@ -0,0 +1,238 @@
+# ImageStackDownload.py
+
+'''
+Parallel, resumable download of rendered VSDA EM and CA image stacks.
+
+SaveImageStack(folder, workers) of a VSDA instance downloads the whole
+stack with a fixed number of workers and starts over when anything
+fails. ImageStackDownloader instead:
+- lists the expected tiles with GetImageStack(),
+- skips tiles that are already in the download manifest and whose file
+  still has the recorded size and SHA-256 hash,
+- fetches the rest with GetImage() on a thread pool whose parallelism
+  adapts: it grows by one after a run of successes and is halved when
+  a request fails,
+- checks each decoded tile (not empty, PNG signature for .png files),
+  writes it atomically and records it in the manifest,
+- retries failed tiles in later rounds.
+
+The manifest (download_manifest.json in the stack folder) is updated as
+tiles complete, so an interrupted download resumes with only the tiles
+that are missing or damaged, e.g. when the script is run again for the
+same rendered stack.
+
+Assumed VSDA client API (the calls SaveImageStack() itself is built on):
+- GetImageStack() returns the list of tile handles of the rendered stack,
+- GetImage(handle) returns the base64 encoded image data of one tile,
+- tiles are stored under the last path component of their handle, and
+  that name carries the X, Y and Slice indices of the tile.
+'''
+
+import base64
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+MANIFEST_FILE = 'download_manifest.json'
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+def tile_filename(handle:str)->str:
+    return handle.split('/')[-1]
+
+def file_sha256(filepath:str)->str:
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def stack_dimensions(handles:list)->tuple:
+    '''
+    Returns (NumImagesX, NumImagesY, NumSlices) from tile names with X,
+    Y and Slice (or Z) indices, e.g. 'Slice3_X1_Y0.png', or None if the
+    names do not contain these indices.
+    '''
+    maxima = { 'X': -1, 'Y': -1, 'S': -1 }
+    for handle in handles:
+        name = tile_filename(handle)
+        x = re.search(r'X(\d+)', name)
+        y = re.search(r'Y(\d+)', name)
+        s = re.search(r'(?:Slice|Z)(\d+)', name)
+        if x is None or y is None or s is None:
+            return None
+        maxima['X'] = max(maxima['X'], int(x.group(1)))
+        maxima['Y'] = max(maxima['Y'], int(y.group(1)))
+        maxima['S'] = max(maxima['S'], int(s.group(1)))
+    if len(handles) == 0:
+        return None
+    return maxima['X']+1, maxima['Y']+1, maxima['S']+1
+
+class AdaptiveLimit:
+    '''
+    Concurrency limit between 1 and max_limit, increased by one after
+    increase_after consecutive successes and halved on a failure.
+    '''
+    def __init__(self, initial:int, max_limit:int, increase_after=8):
+        self.limit = max(1, min(initial, max_limit))
+        self.max_limit = max_limit
+        self.increase_after = increase_after
+        self.active = 0
+        self.successes = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def release(self, success:bool):
+        with self.condition:
+            self.active -= 1
+            if success:
+                self.successes += 1
+                if self.successes >= self.increase_after and self.limit < self.max_limit:
+                    self.limit += 1
+                    self.successes = 0
+            else:
+                self.limit = max(1, self.limit // 2)
+                self.successes = 0
+            self.condition.notify_all()
+
+class ImageStackDownloader:
+    def __init__(self, vsda_instance, folder:str, max_workers=20, initial_workers=4, rounds=4, retry_pause_s=2.0, verify_existing=True):
+        self.vsda = vsda_instance
+        self.folder = folder
+        self.max_workers = max_workers
+        self.initial_workers = initial_workers
+        self.rounds = rounds
+        self.retry_pause_s = retry_pause_s
+        self.verify_existing = verify_existing
+        self.manifest_lock = threading.Lock()
+        self.manifest = self.load_manifest()
+
+    def manifest_path(self)->str:
+        return os.path.join(self.folder, MANIFEST_FILE)
+
+    def load_manifest(self)->dict:
+        if not os.path.exists(self.manifest_path()):
+            return { 'tiles': {} }
+        try:
+            with open(self.manifest_path(), 'r') as f:
+                return json.load(f)
+        except Exception as e:
+            print('ImageStackDownloader: Unreadable manifest, downloading all tiles: '+str(e))
+            return { 'tiles': {} }
+
+    def save_manifest(self):
+        with self.manifest_lock:
+            tmpfile = self.manifest_path()+'.tmp'
+            with open(tmpfile, 'w') as f:
+                json.dump(self.manifest, f, indent=1)
+            os.replace(tmpfile, self.manifest_path())
+
+    def is_complete(self, handle:str)->bool:
+        record = self.manifest['tiles'].get(handle)
+        if record is None:
+            return False
+        filepath = os.path.join(self.folder, record['file'])
+        if not os.path.exists(filepath) or os.path.getsize(filepath) != record['size']:
+            return False
+        if self.verify_existing and file_sha256(filepath) != record['sha256']:
+            return False
+        return True
+
+    def missing_tiles(self, handles:list)->list:
+        return [ handle for handle in handles if not self.is_complete(handle) ]
+
+    def fetch_tile(self, handle:str):
+        ImageData = self.vsda.GetImage(handle)
+        if isinstance(ImageData, str):
+            ImageData = ImageData.encode('ascii')
+        data = base64.decodebytes(ImageData)
+        filename = tile_filename(handle)
+        if len(data) == 0:
+            raise Exception('Empty image data for '+handle)
+        if filename.lower().endswith('.png') and not data.startswith(PNG_SIGNATURE):
+            raise Exception('Image data for %s is not a PNG image' % handle)
+        filepath = os.path.join(self.folder, filename)
+        tmpfile = filepath+'.part'
+        with open(tmpfile, 'wb') as f:
+            f.write(data)
+        os.replace(tmpfile, filepath)
+        with self.manifest_lock:
+            self.manifest['tiles'][handle] = {
+                'file': filename,
+                'size': len(data),
+                'sha256': hashlib.sha256(data).hexdigest(),
+            }
+
+    def fetch_limited(self, limit:AdaptiveLimit, handle:str):
+        limit.acquire()
+        success = False
+        try:
+            self.fetch_tile(handle)
+            success = True
+        finally:
+            limit.release(success)
+
+    def download(self, handles:list=None)->list:
+        '''
+        Downloads all missing tiles. Returns the list of tile handles.
+        Raises an exception if tiles are still missing after all rounds,
+        progress so far is kept in the manifest.
+        '''
+        os.makedirs(self.folder, exist_ok=True)
+        if handles is None:
+            handles = self.vsda.GetImageStack()
+            if not isinstance(handles, (list, tuple)):
+                raise Exception('ImageStackDownloader: GetImageStack() returned %s instead of a list of tile handles.' % type(handles).__name__)
+        self.manifest['num_tiles'] = len(handles)
+        missing = self.missing_tiles(handles)
+        if len(missing) < len(handles):
+            print('ImageStackDownloader: Resuming, %d of %d tiles already present.' % (len(handles)-len(missing), len(handles)))
+
+        limit = AdaptiveLimit(self.initial_workers, self.max_workers)
+        for round in range(self.rounds):
+            if len(missing) == 0:
+                break
+            if round > 0:
+                print('ImageStackDownloader: Retrying %d tiles (round %d).' % (len(missing), round+1))
+                time.sleep(self.retry_pause_s*round)
+            failed = []
+            last_error = None
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = { executor.submit(self.fetch_limited, limit, handle): handle for handle in missing }
+                for num_done, future in enumerate(as_completed(futures)):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        failed.append(futures[future])
+                        last_error = e
+                    if num_done % 50 == 49:
+                        self.save_manifest()
+            self.save_manifest()
+            if len(failed) > 0:
+                print('ImageStackDownloader: Failed to retrieve %d tiles (last error: %s), parallelism now %d.' % (len(failed), str(last_error), limit.limit))
+            missing = failed
+
+        if len(missing) > 0:
+            raise Exception('ImageStackDownloader: %d of %d tiles missing after %d rounds, run again to resume.' % (len(missing), len(handles), self.rounds))
+        return handles
+
+def download_image_stack(vsda_instance, folder:str, max_workers=20)->tuple:
+    '''
+    Resumable replacement for vsda_instance.SaveImageStack(folder, max_workers).
+    Returns (NumImagesX, NumImagesY, NumSlices) as SaveImageStack does,
+    derived from the tile names. Raises an exception if the names do not
+    contain the indices, the downloaded tiles are kept.
+    '''
+    handles = ImageStackDownloader(vsda_instance, folder, max_workers).download()
+    dimensions = stack_dimensions(handles)
+    if dimensions is None:
+        raise Exception('download_image_stack: Unable to derive stack dimensions from tile names (e.g. %s).' % (tile_filename(handles[0]) if len(handles) > 0 else 'no tiles'))
+    return dimensions
@@ -5,7 +5,7 @@
 Utility functions used with known ground-truth recorded data.
 '''
 
-#import numpy as np
+import numpy as np
 import matplotlib.pyplot as plt
 #from matplotlib.colors import ListedColormap
 #import matplotlib.gridspec as gridspec
@@ -17,6 +17,9 @@ from os import makedirs
 # import pandas as pd
 import pickle
 
+from .common.BlockCompression import dump_pickled
+from .TraceStore import save_trace_store
+
 def extract_t_Vm(data:dict)->tuple:
     if 't_ms' not in data:
         print('extract_t_Vm Error: Missing t_ms record.')
@@ -75,33 +78,222 @@ def extract_spiketimes(data:dict)->list:
         return None
     return spikes_cells
 
-def save_t_Vm_pickled(t_ms, Vm_cells, savefolder: str, spikes_cells=None):
+def sorted_neuron_ids(data:dict)->list:
+    '''
+    Returns the neuron ID keys of a NES recording dict sorted by their
+    integer value (replaces scanning for the maximum ID).
+    '''
+    return sorted(data.keys(), key=int)
+
+def extract_t_Vm_array(data:dict, free_source=False)->tuple:
+    '''
+    Single-pass columnar conversion of a NES GetRecording() dict.
+    Returns (t_ms, Vm, neuron_ids), where t_ms is a float64 array, Vm is a
+    dense (neurons x samples) float32 array and neuron_ids holds the integer
+    ID of the neuron in each row.
+    With free_source=True, each neuron's record is removed from data as
+    soon as it has been copied, so that the JSON lists and the array do
+    not all have to be held in memory at the same time.
+    '''
+    if 't_ms' not in data:
+        print('extract_t_Vm_array Error: Missing t_ms record.')
+        return None, None, None
+
+    t_ms = np.asarray(data.pop('t_ms') if free_source else data['t_ms'], dtype=np.float64)
+    num_samples = len(t_ms)
+
+    if "circuits" in data:
+        # Circuit recordings are keyed by cell name, use the order of appearance.
+        cells = []
+        circuits = data["circuits"]
+        for region in circuits:
+            if region!='t_ms':
+                for cell in circuits[region]:
+                    if 'Vm_mV' in circuits[region][cell]:
+                        cells.append( (circuits[region], cell) )
+        source = cells
+        neuron_ids = np.arange(len(cells))
+    elif "neurons" in data:
+        neurons = data["neurons"]
+        keys = []
+        for neuron_id in sorted_neuron_ids(neurons):
+            if 'Vm_mV' not in neurons[neuron_id]:
+                print('Missing Vm_mV at neuron '+str(neuron_id))
+            else:
+                keys.append(neuron_id)
+        source = [ (neurons, neuron_id) for neuron_id in keys ]
+        neuron_ids = np.array([ int(neuron_id) for neuron_id in keys ], dtype=np.int64)
+    else:
+        print('extract_t_Vm_array Error: Missing cells membrane potential data.')
+        return None, None, None
+
+    Vm = np.full((len(source), num_samples), np.nan, dtype=np.float32)
+    for row, (container, key) in enumerate(source):
+        Vm_mV = container.pop(key)['Vm_mV'] if free_source else container[key]['Vm_mV']
+        n = min(len(Vm_mV), num_samples)
+        Vm[row, :n] = Vm_mV[:n]
+    return t_ms, Vm, neuron_ids
+
+def extract_spiketimes_csr(data:dict, neuron_ids=None, free_source=False)->tuple:
+    '''
+    Single-pass conversion of a NES GetSpikeTimes() dict into CSR form.
+    Returns (neuron_ids, offsets, times), where the spike times of the
+    neuron in row i are times[offsets[i]:offsets[i+1]].
+    If neuron_ids is given (e.g. from extract_t_Vm_array), rows follow
+    that order and neurons without spikes get empty rows.
+    '''
+    if neuron_ids is None:
+        keys = [ neuron_id for neuron_id in sorted_neuron_ids(data) if 'tSpike_ms' in data[neuron_id] ]
+        neuron_ids = np.array([ int(neuron_id) for neuron_id in keys ], dtype=np.int64)
+    else:
+        neuron_ids = np.asarray(neuron_ids, dtype=np.int64)
+        keys = [ str(neuron_id) for neuron_id in neuron_ids ]
+
+    counts = np.zeros(len(keys), dtype=np.int64)
+    trains = []
+    for row, key in enumerate(keys):
+        record = (data.pop(key, None) if free_source else data.get(key, None))
+        train = record['tSpike_ms'] if (record is not None and 'tSpike_ms' in record) else []
+        counts[row] = len(train)
+        trains.append(np.asarray(train, dtype=np.float64))
+    offsets = np.zeros(len(keys)+1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    times = np.concatenate(trains) if len(trains)>0 else np.zeros(0, dtype=np.float64)
+    return neuron_ids, offsets, times
+
+def csr_to_spikes_cells(offsets:np.ndarray, times:np.ndarray)->list:
+    '''
+    Per-neuron views of CSR spike trains, in the spikes_cells list layout.
+    '''
+    return [ times[offsets[i]:offsets[i+1]] for i in range(len(offsets)-1) ]
+
+def pickled_path(savefolder: str, name: str, codec=None)->str:
+    '''
+    With a codec (see common/BlockCompression.py) the pickle is written
+    block-compressed in parallel to a .pkl.blz file, otherwise as a plain .pkl.
+    '''
+    if codec:
+        return savefolder+'/'+name+'.pkl.blz'
+    return savefolder+'/'+name+'.pkl'
+
+def store_pickled(data, filepath: str, codec=None):
+    if codec:
+        dump_pickled(data, filepath, codec=codec)
+        return
+    with open(filepath, 'wb') as f:
+        pickle.dump(data, f)
+
+def save_t_Vm_pickled(t_ms, Vm_cells, savefolder: str, spikes_cells=None, codec=None):
     if not isdir(savefolder):
         makedirs(savefolder)
+    filepath = pickled_path(savefolder, 'groundtruth-Vm', codec)
     try:
-        with open(savefolder+'/groundtruth-Vm.pkl', 'wb') as f:
-            pickle.dump({'t_ms': t_ms, 'Vm_cells': Vm_cells, 'spikes_cells': spikes_cells}, f)
+        store_pickled({'t_ms': t_ms, 'Vm_cells': Vm_cells, 'spikes_cells': spikes_cells}, filepath, codec)
     except:
-        print('save_t_Vm_pickled Error: Unable to store data in '+savefolder+'/groundtruth-Vm.pkl')
+        print('save_t_Vm_pickled Error: Unable to store data in '+filepath)
+
+def save_t_Vm_store(t_ms, Vm, savefolder: str, neuron_ids=None, spikes_offsets=None, spikes_times=None):
+    '''
+    Stores recorded Vm (neurons x samples) and CSR spike trains as a
+    memory-mappable trace store in savefolder/groundtruth-Vm, see TraceStore.py.
+    '''
+    storefolder = savefolder+'/groundtruth-Vm'
+    try:
+        save_trace_store(storefolder, t_ms, Vm, neuron_ids, spikes_offsets, spikes_times)
+    except Exception as e:
+        print('save_t_Vm_store Error: Unable to store data in '+storefolder+': '+str(e))
+
+def minmax_decimate(t_ms, Vm, num_bins:int)->tuple:
+    '''
+    Reduce each trace (row of Vm) to min/max envelopes in num_bins time bins,
+    e.g. one bin per horizontal pixel. NaN samples are ignored.
+    Returns (t_bins, Vmin, Vmax), where t_bins holds the first time point
+    in each bin. Traces with no more than 2*num_bins samples are returned
+    unchanged (as both Vmin and Vmax).
+    '''
+    t_ms = np.asarray(t_ms)
+    Vm = np.atleast_2d(np.asarray(Vm, dtype=np.float32))
+    num_samples = Vm.shape[1]
+    if num_samples <= 2*num_bins:
+        return t_ms, Vm, Vm
+    bin_starts = np.linspace(0, num_samples, num_bins, endpoint=False).astype(np.int64)
+    Vmin = np.fmin.reduceat(Vm, bin_starts, axis=1)
+    Vmax = np.fmax.reduceat(Vm, bin_starts, axis=1)
+    return t_ms[bin_starts], Vmin, Vmax
+
+def plot_t_Vm_heatmap(t_ms, Vm_cells, filepath: str, figspecs:dict, num_bins:int, dpi:int, spikes_cells:list=None):
+    '''
+    Heatmap layout for many neurons: one image row per neuron showing the
+    max envelope of Vm (so spikes stay visible), with an optional spike
+    raster underneath. Both are rasterized.
+    '''
+    t_bins, Vmin, Vmax = minmax_decimate(t_ms, Vm_cells, num_bins)
+    t_start, t_end = float(t_ms[0]), float(t_ms[-1])
+    if spikes_cells:
+        fig, axs = plt.subplots(2, 1, figsize=figspecs['figsize'], sharex=True, gridspec_kw={'height_ratios': [3, 1]})
+        ax = axs[0]
+    else:
+        fig, ax = plt.subplots(1, 1, figsize=figspecs['figsize'])
+    fig.suptitle("God's eye recorded data")
+    im = ax.imshow(Vmax, origin='lower', aspect='auto', interpolation='nearest',
+                   extent=(t_start, t_end, -0.5, len(Vmax)-0.5), rasterized=True)
+    fig.colorbar(im, ax=ax, label='v_m (mV)')
+    ax.set(ylabel='neuron')
+    if spikes_cells:
+        try:
+            axs[1].eventplot(spikes_cells, linewidths=figspecs['linewidth'], colors='red', rasterized=True)
+            axs[1].set(xlabel='t (ms)', ylabel='neuron')
+        except Exception as e:
+            print('Spike plotting error: '+str(e))
+    else:
+        ax.set(xlabel='t (ms)')
+    plt.draw()
+    plt.savefig(filepath, dpi=dpi)
+
+# With decimate=True, each trace is reduced to min/max envelopes at the
+# horizontal resolution of the saved figure and line art is rasterized,
+# which keeps rendering time and file size small for long recordings.
+# With more than heatmap_above neurons, a heatmap with spike raster is
+# drawn instead of one subplot per neuron.
+# With raise_errors=True, a plot that cannot be stored raises instead of
+# printing an error (used by PlotQueue, so that failures are reported).
+def plot_t_Vm(t_ms, Vm_cells, savefolder: str, figspecs:dict={'figsize':(6,6),'linewidth':0.5, 'figext': 'pdf'}, cell_titles:list=None, spikes_cells:list=None, decimate=False, heatmap_above:int=None, dpi=300, raise_errors=False):
+    if not isdir(savefolder):
+        makedirs(savefolder)
+    filepath = savefolder+'/groundtruth-Vm.'+figspecs['figext']
+
+    num_bins = int(figspecs['figsize'][0]*dpi)
+    if heatmap_above is not None and len(Vm_cells) > heatmap_above:
+        try:
+            plot_t_Vm_heatmap(t_ms, Vm_cells, filepath, figspecs, num_bins, dpi, spikes_cells)
+        except:
+            if raise_errors:
+                raise
+            print('plot_t_Vm Error: Unable to store plot in '+filepath)
+        return
 
-def plot_t_Vm(t_ms, Vm_cells, savefolder: str, figspecs:dict={'figsize':(6,6),'linewidth':0.5, 'figext': 'pdf'}, cell_titles:list=None, spikes_cells:list=None):
     fig = plt.figure(figsize=figspecs['figsize'])
     gs = fig.add_gridspec(len(Vm_cells),1, hspace=0)
     axs = gs.subplots(sharex=True, sharey=True)
     fig.suptitle("God's eye recorded data")
+    if decimate:
+        t_bins, Vmin, Vmax = minmax_decimate(t_ms, Vm_cells, num_bins)
     for c in range(len(Vm_cells)):
         # if c == 0:
         #   ax = fig.add_subplot(gs[0])
         # else:
         #   ax = fig.add_subplot(gs[c], sharex=ax)
-        axs[c].plot(t_ms, Vm_cells[c], linewidth=figspecs['linewidth'])
+        if decimate:
+            axs[c].fill_between(t_bins, Vmin[c], Vmax[c], linewidth=figspecs['linewidth'], rasterized=True)
+        else:
+            axs[c].plot(t_ms, Vm_cells[c], linewidth=figspecs['linewidth'])
         if spikes_cells:
             try:
                 axs[c].scatter(
                     spikes_cells[c],
                     [ 30.0 for i in range(len(spikes_cells[c])) ],
                     s=[ 0.01 for i in range(len(spikes_cells[c])) ],
-                    color='red', zorder=5, marker='.') # , label='Spikes'
+                    color='red', zorder=5, marker='.', rasterized=decimate) # , label='Spikes'
             except Exception as e:
                 print('Spike plotting error: '+str(e))
         if cell_titles:
@@ -129,25 +321,23 @@ def plot_t_Vm(t_ms, Vm_cells, savefolder: str, figspecs:dict={'figsize':(6,6),'l
     # df = pd.concat([cell, df], ignore_index=True)
     # df.to_csv(savefolder+'data.csv', index=False)
 
-    if not isdir(savefolder):
-        makedirs(savefolder)
-
-    filepath = savefolder+'/groundtruth-Vm.'+figspecs['figext']
     try:
-        plt.savefig(filepath, dpi=300)
+        plt.savefig(filepath, dpi=dpi)
     except:
+        if raise_errors:
+            raise
         print('plot_t_Vm Error: Unable to store plot in '+filepath)
 
-def save_connections_pickled(connectionmatrix, savefolder: str, nameappend:str):
+def save_connections_pickled(connectionmatrix, savefolder: str, nameappend:str, codec=None):
     if not isdir(savefolder):
         makedirs(savefolder)
+    filepath = pickled_path(savefolder, 'connections'+nameappend, codec)
     try:
-        with open(savefolder+'/connections'+nameappend+'.pkl', 'wb') as f:
-            pickle.dump(connectionmatrix, f)
+        store_pickled(connectionmatrix, filepath, codec)
     except:
-        print('save_connections_pickled Error: Unable to store data in '+savefolder+'/connections'+nameappend+'.pkl')
+        print('save_connections_pickled Error: Unable to store data in '+filepath)
 
-def plot_weights(weightmatrix, savefolder: str, nameappend:str, figspecs:dict={'figsize':(6,6),'linewidth':0.5, 'figext': 'pdf'}, vmin=None, vmax=None, cmap='viridis'):
+def plot_weights(weightmatrix, savefolder: str, nameappend:str, figspecs:dict={'figsize':(6,6),'linewidth':0.5, 'figext': 'pdf'}, vmin=None, vmax=None, cmap='viridis', raise_errors=False):
     import numpy as np
 
     if vmin is None:
@@ -173,6 +363,8 @@ def plot_weights(weightmatrix, savefolder: str, nameappend:str, figspecs:dict={'
     try:
         plt.savefig(filepath, dpi=300)
     except:
+        if raise_errors:
+            raise
         print('plot_weights Error: Unable to store plot in '+filepath)
 
 def plot_recorded(savefolder: str, data:dict, figspecs:dict={'figsize':(6,6),'linewidth':0.5, 'figext': 'pdf'}, cell_titles:list=None):
@@ -0,0 +1,99 @@
+# PlotQueue.py
+
+'''
+Background rendering of plots for acquisition scripts.
+
+Plot jobs (a plot function with its data, figspecs and save path) are
+submitted to a process pool with a headless matplotlib backend and
+return immediately, so that the NES session and EM/CA rendering steps
+do not wait on PDF generation. Scripts call wait_for_plots() before
+exiting to make sure all pending figures have been written.
+
+Worker processes are forked, because the model scripts run at module
+level and would be re-executed by spawned workers. Where fork is not
+available, plots are rendered synchronously in the script's process.
+Plot functions are called with raise_errors=True, so a failed plot is
+reported by wait_for_plots().
+'''
+
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+
+def init_headless():
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+
+def render(func, args:tuple, kwargs:dict)->bool:
+    import matplotlib.pyplot as plt
+    try:
+        func(*args, raise_errors=True, **kwargs)
+    finally:
+        plt.close('all')
+    return True
+
+class PlotQueue:
+    def __init__(self, workers=1):
+        self.workers = workers
+        self.executor = None
+        self.synchronous = False
+        self.pending = []
+
+    def start(self):
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            print('PlotQueue: Processes cannot be forked here, rendering plots synchronously.')
+            self.synchronous = True
+            return
+        context = multiprocessing.get_context('fork')
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=init_headless)
+
+    def submit(self, description:str, func, *args, **kwargs):
+        '''
+        Queue func(*args, **kwargs) for rendering in a worker process.
+        func must take a raise_errors keyword argument.
+        '''
+        if self.executor is None and not self.synchronous:
+            self.start()
+        if self.synchronous:
+            future = Future()
+            try:
+                future.set_result(render(func, args, kwargs))
+            except Exception as e:
+                future.set_exception(e)
+        else:
+            future = self.executor.submit(render, func, args, kwargs)
+        self.pending.append( (description, future) )
+
+    def wait_all(self)->bool:
+        '''
+        Wait for all pending plot jobs. Returns False if any job failed.
+        '''
+        success = True
+        for description, future in self.pending:
+            try:
+                future.result()
+            except Exception as e:
+                print('PlotQueue Error: %s failed: %s' % (description, str(e)))
+                success = False
+        self.pending = []
+        return success
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+# Shared queue used by the vbpcommon helpers of a script.
+plot_queue = None
+
+def get_plot_queue(workers=1)->PlotQueue:
+    global plot_queue
+    if plot_queue is None:
+        plot_queue = PlotQueue(workers)
+    return plot_queue
+
+def wait_for_plots()->bool:
+    if plot_queue is None:
+        return True
+    success = plot_queue.wait_all()
+    plot_queue.shutdown()
+    return success
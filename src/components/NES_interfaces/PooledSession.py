@@ -0,0 +1,151 @@
+# PooledSession.py
+
+'''
+Pooled HTTP session layer for the NES client, with per-endpoint latency
+statistics.
+
+Without it, every module-level requests call made by the client opens
+a new connection to the API host, and connection setup dominates the
+latency of small requests such as status polls. When installed:
+- Module-level requests calls (requests.get, requests.post, ...) to the
+  API base URL are sent through one shared requests.Session, whose
+  HTTPAdapter keeps persistent connections. At most max_connections
+  are open at once, further requests wait for a free connection. The
+  session is shared by all simulations that the script creates.
+- The latency of every request to the API base URL is recorded per
+  endpoint, including requests made through other Session objects.
+
+Install it before creating the client, as vbpcommon.ClientFromArgs()
+does with pooled=True.
+'''
+
+import json
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+import requests.api
+from requests.adapters import HTTPAdapter
+
+class EndpointStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_s = 0.0
+        self.max_s = 0.0
+        self.min_s = None
+
+    def add(self, elapsed_s:float, error:bool):
+        self.count += 1
+        if error:
+            self.errors += 1
+        self.total_s += elapsed_s
+        self.max_s = max(self.max_s, elapsed_s)
+        self.min_s = elapsed_s if self.min_s is None else min(self.min_s, elapsed_s)
+
+    def to_dict(self)->dict:
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'mean_ms': 1000.0*self.total_s/self.count if self.count > 0 else None,
+            'min_ms': 1000.0*self.min_s if self.min_s is not None else None,
+            'max_ms': 1000.0*self.max_s,
+            'total_s': self.total_s,
+        }
+
+class PooledSession:
+    def __init__(self, base_url:str, max_connections=16):
+        self.base_url = base_url.rstrip('/')
+        self.max_connections = max_connections
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections, pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+        self.original_request = None
+        self.original_send = None
+
+    def matches(self, url:str)->bool:
+        return url.startswith(self.base_url)
+
+    def endpoint(self, url:str)->str:
+        return urlsplit(url).path or '/'
+
+    def record(self, url:str, elapsed_s:float, error:bool):
+        endpoint = self.endpoint(url)
+        with self.stats_lock:
+            if endpoint not in self.stats:
+                self.stats[endpoint] = EndpointStats()
+            self.stats[endpoint].add(elapsed_s, error)
+
+    def install(self):
+        if self.original_request is not None:
+            return
+        pooled = self
+        original_request = requests.api.request
+        original_send = requests.Session.send
+
+        def request(method, url, **kwargs):
+            if not pooled.matches(url):
+                return original_request(method, url, **kwargs)
+            return pooled.session.request(method=method, url=url, **kwargs)
+
+        def send(session, prepared, **kwargs):
+            if not pooled.matches(prepared.url):
+                return original_send(session, prepared, **kwargs)
+            t_start = time.perf_counter()
+            try:
+                response = original_send(session, prepared, **kwargs)
+            except Exception:
+                pooled.record(prepared.url, time.perf_counter()-t_start, True)
+                raise
+            pooled.record(prepared.url, time.perf_counter()-t_start, response.status_code >= 400)
+            return response
+
+        self.original_request = original_request
+        self.original_send = original_send
+        requests.api.request = request
+        requests.request = request
+        requests.Session.send = send
+
+    def uninstall(self):
+        if self.original_request is None:
+            return
+        requests.api.request = self.original_request
+        requests.request = self.original_request
+        requests.Session.send = self.original_send
+        self.original_request = None
+        self.original_send = None
+        self.session.close()
+
+    def latency_stats(self)->dict:
+        with self.stats_lock:
+            return { endpoint: stats.to_dict() for endpoint, stats in self.stats.items() }
+
+    def latency_report(self)->str:
+        lines = [ '%-40s %8s %6s %10s %10s %10s' % ('Endpoint', 'Count', 'Errors', 'Mean ms', 'Min ms', 'Max ms') ]
+        for endpoint, stats in sorted(self.latency_stats().items()):
+            lines.append('%-40s %8d %6d %10.1f %10.1f %10.1f' % (endpoint, stats['count'], stats['errors'], stats['mean_ms'], stats['min_ms'], stats['max_ms']))
+        return '\n'.join(lines)
+
+    def save_latency_stats(self, file:str):
+        with open(file, 'w') as f:
+            json.dump(self.latency_stats(), f, indent=2)
+
+# Shared pooled session of a script, see install_pooled_session().
+pooled_session = None
+
+def base_url(host:str, port:int, usehttps:bool)->str:
+    return '%s://%s:%d' % ('https' if usehttps else 'http', host, port)
+
+def install_pooled_session(host:str, port:int, usehttps:bool, max_connections=16)->PooledSession:
+    global pooled_session
+    if pooled_session is None:
+        pooled_session = PooledSession(base_url(host, port, usehttps), max_connections)
+        pooled_session.install()
+    return pooled_session
+
+def get_pooled_session()->PooledSession:
+    return pooled_session
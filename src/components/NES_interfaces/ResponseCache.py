@@ -0,0 +1,270 @@
+# ResponseCache.py
+
+'''
+Client-side disk cache of NES responses that depend only on a saved
+model: GetConnectome, GetAbstractConnectome and GetSomaPositions.
+
+Entries are keyed by a hash of the saved model name, the request method
+and its parameters (timing parameters such as Pause_s are ignored).
+Each response is stored as a block-compressed pickle in the cache
+folder, and an SQLite index keeps the model name, size and last access
+time of every entry. When the total size exceeds max_bytes, the least
+recently used entries are evicted.
+
+Cached responses are only valid while the saved model is unchanged.
+Every cache folder is recorded in a registry file in the home directory
+(REGISTRY_FILE), and invalidate_saved_model(name) removes the entries of
+name from all registered caches. Scripts that save models call it right
+after ModelSave(), whether or not they use a cache themselves, so that
+regrowing a model under the same name (e.g. by a reservoir script)
+cannot leave stale responses of the old model in a cache.
+CachedSimulation.ModelSave() does the same.
+
+CachedSimulation wraps a NES simulation:
+- After ModelLoad(name) or ModelSave(name), the simulation holds that
+  saved model, and cacheable requests are answered from the cache when
+  possible.
+- Any other call (e.g. SetSpecificAPTimes, RunAndWait with STDP) may
+  change the model, so later requests go to the server until the next
+  ModelLoad or ModelSave.
+- ModelLoad of a model that already has cache entries is deferred until
+  a request needs the server, so re-analysis of a finished batch can be
+  done without any server round trips.
+'''
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from .common.BlockCompression import dump_pickled, load_pickled
+
+IGNORED_PARAMETERS = ('Pause_s', 'timeout_s')
+DEFAULT_MAX_BYTES = 2 << 30
+REGISTRY_FILE = os.path.join(os.path.expanduser('~'), '.nesvbp_response_caches')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    modelname TEXT NOT NULL,
+    method TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_modelname ON entries (modelname);
+CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access);
+'''
+
+class ResponseCache:
+    def __init__(self, folder:str, max_bytes=DEFAULT_MAX_BYTES, codec='fast'):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.codec = codec
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(folder, exist_ok=True)
+        # Requests may be made from worker threads, e.g. by AsyncMonitor.
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(os.path.join(folder, 'index.sqlite'), timeout=30.0, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        register_cache_folder(folder)
+
+    def cache_key(self, modelname:str, method:str, args:tuple, kwargs:dict)->str:
+        parameters = { k: v for k, v in kwargs.items() if k not in IGNORED_PARAMETERS }
+        request = json.dumps([ modelname, method, list(args), parameters ], sort_keys=True, default=str)
+        return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+    def entry_file(self, key:str)->str:
+        return os.path.join(self.folder, key+'.blz')
+
+    def get(self, modelname:str, method:str, args:tuple, kwargs:dict):
+        '''
+        Returns the cached response, or None.
+        '''
+        key = self.cache_key(modelname, method, args, kwargs)
+        with self.lock:
+            row = self.conn.execute('SELECT key FROM entries WHERE key=?', (key,)).fetchone()
+            if row is None or not os.path.exists(self.entry_file(key)):
+                self.misses += 1
+                return None
+            with self.conn:
+                self.conn.execute('UPDATE entries SET last_access=? WHERE key=?', (time.time(), key))
+            self.hits += 1
+        return load_pickled(self.entry_file(key))
+
+    def put(self, modelname:str, method:str, args:tuple, kwargs:dict, response):
+        key = self.cache_key(modelname, method, args, kwargs)
+        tmpfile = self.entry_file(key)+'.%d.%d.tmp' % (os.getpid(), threading.get_ident())
+        dump_pickled(response, tmpfile, codec=self.codec)
+        os.replace(tmpfile, self.entry_file(key))
+        with self.lock:
+            with self.conn:
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO entries (key, modelname, method, size, last_access) VALUES (?, ?, ?, ?, ?)',
+                    (key, modelname, method, os.path.getsize(self.entry_file(key)), time.time()))
+            self.evict()
+
+    def has_model(self, modelname:str)->bool:
+        with self.lock:
+            return self.conn.execute('SELECT 1 FROM entries WHERE modelname=? LIMIT 1', (modelname,)).fetchone() is not None
+
+    def remove(self, keys:list):
+        with self.lock:
+            with self.conn:
+                self.conn.executemany('DELETE FROM entries WHERE key=?', [ (key,) for key in keys ])
+        for key in keys:
+            if os.path.exists(self.entry_file(key)):
+                os.remove(self.entry_file(key))
+
+    def invalidate(self, modelname:str):
+        '''
+        Removes all entries of a saved model, e.g. when it is overwritten.
+        '''
+        with self.lock:
+            keys = [ key for (key,) in self.conn.execute('SELECT key FROM entries WHERE modelname=?', (modelname,)) ]
+        self.remove(keys)
+
+    def total_bytes(self)->int:
+        with self.lock:
+            return self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def evict(self):
+        with self.lock:
+            total = self.total_bytes()
+            if total <= self.max_bytes:
+                return
+            evicted = []
+            for key, size in self.conn.execute('SELECT key, size FROM entries ORDER BY last_access').fetchall():
+                evicted.append(key)
+                total -= size
+                if total <= self.max_bytes:
+                    break
+            self.remove(evicted)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def stats(self)->dict:
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': self.conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0],
+                'bytes': self.total_bytes(),
+            }
+
+class CachedSimulation:
+    def __init__(self, sim, cache:ResponseCache):
+        self.sim = sim
+        self.cache = cache
+        self.modelname = None # Saved model that the simulation holds, if known.
+        self.pending_load = None # ModelLoad call deferred until needed.
+
+    def load_pending(self):
+        if self.pending_load is not None:
+            args, kwargs = self.pending_load
+            self.pending_load = None
+            self.sim.ModelLoad(*args, **kwargs)
+
+    def ModelLoad(self, name:str, *args, **kwargs):
+        if self.cache.has_model(name):
+            self.pending_load = ((name,)+args, kwargs)
+        else:
+            self.pending_load = None
+            response = self.sim.ModelLoad(name, *args, **kwargs)
+        self.modelname = name
+        return None if self.pending_load is not None else response
+
+    def ModelSave(self, name:str, *args, **kwargs):
+        self.load_pending()
+        response = self.sim.ModelSave(name, *args, **kwargs)
+        invalidate_saved_model(name)
+        self.modelname = name
+        return response
+
+    def cached_request(self, method:str, args:tuple, kwargs:dict):
+        if self.modelname is not None:
+            response = self.cache.get(self.modelname, method, args, kwargs)
+            if response is not None:
+                return response
+        self.load_pending()
+        response = getattr(self.sim, method)(*args, **kwargs)
+        if self.modelname is not None:
+            self.cache.put(self.modelname, method, args, kwargs, response)
+        return response
+
+    def GetConnectome(self, *args, **kwargs):
+        return self.cached_request('GetConnectome', args, kwargs)
+
+    def GetAbstractConnectome(self, *args, **kwargs):
+        return self.cached_request('GetAbstractConnectome', args, kwargs)
+
+    def GetSomaPositions(self, *args, **kwargs):
+        return self.cached_request('GetSomaPositions', args, kwargs)
+
+    def __getattr__(self, name:str):
+        attr = getattr(self.sim, name)
+        if not callable(attr):
+            return attr
+        def call(*args, **kwargs):
+            self.load_pending()
+            # Only reading calls leave the saved model unchanged.
+            if not name.startswith('Get'):
+                self.modelname = None
+            return attr(*args, **kwargs)
+        return call
+
+def registered_cache_folders()->list:
+    if not os.path.exists(REGISTRY_FILE):
+        return []
+    with open(REGISTRY_FILE, 'r') as f:
+        return [ line.strip() for line in f if line.strip() ]
+
+def register_cache_folder(folder:str):
+    folder = os.path.abspath(folder)
+    try:
+        if folder not in registered_cache_folders():
+            with open(REGISTRY_FILE, 'a') as f:
+                f.write(folder+'\n')
+    except Exception as e:
+        print('Warning: ResponseCache: Unable to register cache folder (saved models will not invalidate it): '+str(e))
+
+def invalidate_saved_model(modelname:str):
+    '''
+    Removes cached responses of modelname from all registered caches.
+    Call after every ModelSave(modelname). Caches whose folder no longer
+    exists are skipped.
+    '''
+    for folder in registered_cache_folders():
+        if not os.path.exists(os.path.join(folder, 'index.sqlite')):
+            continue
+        try:
+            if response_cache is not None and os.path.abspath(response_cache.folder) == folder:
+                response_cache.invalidate(modelname)
+            else:
+                cache = ResponseCache(folder)
+                cache.invalidate(modelname)
+                cache.close()
+        except Exception as e:
+            print('Warning: ResponseCache: Unable to invalidate %s in %s: %s' % (modelname, folder, str(e)))
+
+# Shared cache of a script, see get_response_cache().
+response_cache = None
+
+def get_response_cache(folder:str, max_bytes=DEFAULT_MAX_BYTES)->ResponseCache:
+    global response_cache
+    if response_cache is None:
+        response_cache = ResponseCache(folder, max_bytes)
+    return response_cache
+
+def cached_simulation(sim, folder:str, max_bytes=DEFAULT_MAX_BYTES):
+    '''
+    Wraps sim in a CachedSimulation using the shared cache in folder.
+    Returns sim unchanged if folder is None.
+    '''
+    if folder is None or isinstance(sim, CachedSimulation):
+        return sim
+    return CachedSimulation(sim, get_response_cache(folder, max_bytes))
@@ -0,0 +1,158 @@
+# SegmentedRecording.py
+
+'''
+Retrieval of God's eye recordings in time windows, streamed into a
+trace store (see TraceStore.py) instead of one GetRecording() payload
+held in memory after a long run.
+
+run_and_record_segmented() runs the simulation in segments of
+segment_ms. RunAndWait() of each segment is made in a background
+thread. As soon as a segment is done, the next one is started and the
+recording of the finished one is retrieved while the next runs on the
+server. The new samples (those after the last stored sample) of the
+selected neurons are converted and written to a chunk of the trace
+store in another thread, so at most one retrieved segment is held in
+memory besides the one being received. Spike times are retrieved once
+at the end.
+
+If GetRecording() returns all samples since the recording was started
+instead of those of the last run (its first sample is at or before the
+last stored one), every retrieval would download the whole recording
+again. This is reported, and the recording is then retrieved only once
+after the last segment. If samples are missing between segments, e.g.
+because the server does not return a finished segment while the next
+one runs, or they cover less than the runtime, an exception is raised;
+run with overlap=False then.
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from .KGTRecords import extract_t_Vm_array, extract_spiketimes_csr
+from .TraceStore import TraceStore, TraceStoreWriter
+
+class SegmentWriter:
+    def __init__(self, folder:str, neuron_ids=None, dt_ms:float=None):
+        self.folder = folder
+        self.neuron_ids = None if neuron_ids is None else np.asarray(neuron_ids, dtype=np.int64)
+        self.writer = None
+        self.dt_ms = dt_ms
+        self.t_start_ms = None
+
+    def store(self, recording_dict:dict)->bool:
+        '''
+        Converts one GetRecording() response and appends its new samples.
+        Returns True if the response repeats samples that were already
+        stored, i.e. the recording is returned cumulatively.
+        '''
+        if not isinstance(recording_dict, dict) or recording_dict.get('StatusCode') != 0:
+            raise Exception('SegmentedRecording: Recorded activity content not usable.')
+        t_ms, Vm, neuron_ids = extract_t_Vm_array(data=recording_dict['Recording'], free_source=True)
+        if t_ms is None:
+            raise Exception('SegmentedRecording: No membrane potential data in recording.')
+        if self.neuron_ids is None:
+            self.neuron_ids = neuron_ids
+        if self.writer is None:
+            self.writer = TraceStoreWriter(self.folder, self.neuron_ids)
+        t_end_ms = self.writer.t_end_ms
+        cumulative = t_end_ms is not None and len(t_ms) > 0 and t_ms[0] <= t_end_ms
+        new = self.writer.new_samples(t_ms)
+        t_new = t_ms[new]
+        if len(t_new) == 0:
+            raise Exception('SegmentedRecording: The recording of a finished segment has no new samples.')
+        if t_end_ms is not None and len(t_new) > 0 and self.dt_ms is not None and t_new[0] - t_end_ms > 1.5*self.dt_ms:
+            raise Exception('SegmentedRecording: Samples between %.3f and %.3f ms are missing from the recording.' % (t_end_ms, t_new[0]))
+        if len(t_ms) > 1:
+            self.dt_ms = float(np.median(np.diff(t_ms)))
+        if self.t_start_ms is None:
+            self.t_start_ms = float(t_new[0])
+        self.writer.append(t_new, self.select_rows(Vm[:, new], neuron_ids))
+        return cumulative
+
+    def check_span(self, runtime_ms:float):
+        '''
+        Raises an exception if the stored samples cover less than runtime_ms.
+        '''
+        if self.writer is None or self.dt_ms is None:
+            return
+        span_ms = self.writer.t_end_ms - self.t_start_ms
+        if span_ms < runtime_ms - 2.0*self.dt_ms:
+            raise Exception('SegmentedRecording: Stored samples cover %.3f of %.3f ms.' % (span_ms, runtime_ms))
+
+    def select_rows(self, Vm:np.ndarray, neuron_ids:np.ndarray)->np.ndarray:
+        '''
+        Rows of Vm in the order of self.neuron_ids. Neurons missing from
+        the recording get NaN rows.
+        '''
+        if np.array_equal(neuron_ids, self.neuron_ids):
+            return Vm
+        selected = np.full((len(self.neuron_ids), Vm.shape[1]), np.nan, dtype=np.float32)
+        row_of_id = { int(n): row for row, n in enumerate(neuron_ids) }
+        for row, n in enumerate(self.neuron_ids):
+            if int(n) in row_of_id:
+                selected[row] = Vm[row_of_id[int(n)]]
+        return selected
+
+    def finalize(self, spikes_dict:dict=None):
+        if self.writer is None:
+            raise Exception('SegmentedRecording: No recording was stored.')
+        offsets, times = None, None
+        if spikes_dict and spikes_dict.get('StatusCode') == 0:
+            _, offsets, times = extract_spiketimes_csr(data=spikes_dict['SpikeTimes'], neuron_ids=self.neuron_ids, free_source=True)
+        self.writer.finalize(offsets, times)
+
+def segment_durations(runtime_ms:float, segment_ms:float)->list:
+    num_full = int(runtime_ms // segment_ms)
+    durations = [ segment_ms ]*num_full
+    if runtime_ms - num_full*segment_ms > 1e-9:
+        durations.append(runtime_ms - num_full*segment_ms)
+    return durations
+
+def run_and_record_segmented(sim, runtime_ms:float, segment_ms:float, folder:str, Dt_ms:float=None, timeout_s=100.0, neuron_ids=None, spikes=True, overlap=True)->TraceStore:
+    '''
+    Runs sim for runtime_ms in segments of segment_ms and stores the
+    recording of neuron_ids (default all recorded neurons) in the trace
+    store folder. Recording must have been set up (e.g. RecordAll(-1))
+    before. With overlap=True, the recording of a segment is retrieved
+    while the next segment runs. Returns the TraceStore opened on folder.
+    '''
+    def run_segment(duration_ms:float):
+        if Dt_ms is None:
+            sim.RunAndWait(Runtime_ms=duration_ms, timeout_s=timeout_s)
+        else:
+            sim.RunAndWait(Runtime_ms=duration_ms, Dt_ms=Dt_ms, timeout_s=timeout_s)
+
+    segmentwriter = SegmentWriter(folder, neuron_ids, Dt_ms)
+    runner = ThreadPoolExecutor(max_workers=1)
+    converter = ThreadPoolExecutor(max_workers=1)
+    durations = segment_durations(runtime_ms, segment_ms)
+    cumulative = False
+    pending = None
+    try:
+        running = runner.submit(run_segment, durations[0])
+        for segment in range(len(durations)):
+            running.result()
+            last = segment == len(durations)-1
+            if overlap and not last:
+                running = runner.submit(run_segment, durations[segment+1])
+            if pending is not None and not cumulative:
+                cumulative = pending.result() # Only one segment is converted at a time.
+                if cumulative and not last:
+                    print('SegmentedRecording: Warning - GetRecording() returns the whole recording, retrieving it once after the last segment.')
+            if last or not cumulative:
+                if pending is not None:
+                    pending.result()
+                recording_dict = sim.GetRecording()
+                pending = converter.submit(segmentwriter.store, recording_dict)
+                del recording_dict
+            if not overlap and not last:
+                running = runner.submit(run_segment, durations[segment+1])
+        if pending is not None:
+            pending.result()
+    finally:
+        runner.shutdown(wait=True)
+        converter.shutdown(wait=True)
+    segmentwriter.check_span(runtime_ms)
+
+    segmentwriter.finalize(sim.GetSpikeTimes() if spikes else None)
+    return TraceStore(folder)
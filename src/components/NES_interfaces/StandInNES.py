@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+# StandInNES.py
+
+'''
+Local stand-in for the BrainGenix API and NES server, for offline
+benchmarking and regression testing of the Python side of the pipeline.
+
+Server:
+
+    python3 StandInNES.py -Port 8001 -Latency_ms 20 -FailureRate 0.01
+
+serves the subset of NES calls that the model scripts use (simulation
+create/delete, Netmorph start/status/run, GetConnectome,
+GetAbstractConnectome, GetSomaPositions, RunAndWait, GetRecording,
+GetSpikeTimes, ModelSave/ModelLoad, model building calls and VSDA
+render stubs, including a small image stack for GetImageStack and
+GetImage). Responses are synthetic, generated reproducibly from
+the seed and the model name, or recorded: if the -Recorded folder has
+a file <method>.json, its content is returned for that method.
+Each call is delayed by the configured latency (plus jitter), and fails
+with the configured probability, so that client-side throughput work
+and error handling can be measured reproducibly.
+
+Client:
+
+StandInClient has the interface of NES.Client.Client as used by the
+scripts (IsReady, CreateSimulation, GetResourceStatus, ...), and the
+simulations it creates forward every method call to the server over
+HTTP. vbpcommon.ClientFromArgs(..., standin=True) returns one.
+
+Protocol: POST /Call with JSON {SimID, HandleID, Method, Args, Kwargs},
+returning {StatusCode, Result} or {StatusCode, Error}. Objects created
+by calls such as AddLIFCNeuron or AddVSDAEM are returned as handles
+{'__handle__': kind, 'ID': n}, whose own methods are called by HandleID.
+'''
+
+import argparse
+import base64
+import json
+import os
+import random
+import threading
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+
+# ===== Server side
+
+class StandInConfig:
+    def __init__(self,
+        latency_ms=0.0,
+        jitter_ms=0.0,
+        failure_rate=0.0,
+        fail_methods:list=None,
+        recorded:str=None,
+        netmorph_seconds=5.0,
+        num_neurons=100,
+        seed=0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self.fail_methods = fail_methods # None means all methods can fail.
+        self.recorded = recorded
+        self.netmorph_seconds = netmorph_seconds
+        self.num_neurons = num_neurons
+        self.seed = seed
+
+class StandInSimulation:
+    def __init__(self, sim_id:int, name:str):
+        self.ID = sim_id
+        self.name = name
+        self.modelname = name
+        self.netmorph_start = None
+        self.runtime_ms = 0.0
+        self.dt_ms = 1.0
+
+class StandInBackend:
+    '''
+    Holds the simulations and saved models, and answers calls.
+    '''
+    def __init__(self, config:StandInConfig):
+        self.config = config
+        self.lock = threading.Lock()
+        self.rng = random.Random(config.seed)
+        self.simulations = {}
+        self.saved_models = {}
+        self.handles = {}
+        self.next_id = 0
+        self.calls = {}
+
+    def new_id(self)->int:
+        with self.lock:
+            self.next_id += 1
+            return self.next_id
+
+    def model_rng(self, sim:StandInSimulation)->np.random.Generator:
+        return np.random.default_rng([ self.config.seed, zlib.crc32(sim.modelname.encode('utf-8')) ])
+
+    def delay_and_maybe_fail(self, method:str):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            jitter = self.rng.uniform(0.0, self.config.jitter_ms)
+            fail = self.rng.random() < self.config.failure_rate
+        delay_ms = self.config.latency_ms + jitter
+        if delay_ms > 0:
+            time.sleep(delay_ms/1000.0)
+        if fail and (self.config.fail_methods is None or method in self.config.fail_methods):
+            raise Exception('StandInNES: Injected failure in %s.' % method)
+
+    def recorded_response(self, method:str):
+        if self.config.recorded is None:
+            return None
+        path = os.path.join(self.config.recorded, method+'.json')
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def call(self, sim_id, handle_id, method:str, args:list, kwargs:dict):
+        self.delay_and_maybe_fail(method)
+        recorded = self.recorded_response(method)
+        if recorded is not None:
+            return recorded
+        if handle_id is not None:
+            return self.handle_call(handle_id, method, args, kwargs)
+        if sim_id is None:
+            return self.client_call(method, args, kwargs)
+        if sim_id not in self.simulations:
+            raise Exception('StandInNES: Unknown simulation ID %s.' % str(sim_id))
+        sim = self.simulations[sim_id]
+        handler = getattr(self, 'sim_'+method, None)
+        if handler is None:
+            return self.new_handle(method)
+        return handler(sim, *args, **kwargs)
+
+    def new_handle(self, kind:str)->dict:
+        handle = { '__handle__': kind, 'ID': self.new_id() }
+        self.handles[handle['ID']] = handle
+        return handle
+
+    # --- Client calls
+
+    def client_call(self, method:str, args:list, kwargs:dict):
+        if method == 'CreateSimulation':
+            sim_id = self.new_id()
+            self.simulations[sim_id] = StandInSimulation(sim_id, kwargs.get('Name', 'Simulation%d' % sim_id))
+            return { 'ID': sim_id }
+        if method == 'IsReady':
+            return True
+        if method == 'GetResourceStatus':
+            return { 'StatusCode': 0, 'NumResidentSimulations': len(self.simulations), 'Calls': dict(self.calls) }
+        return None
+
+    # --- Handle calls (VSDA, visualizer and model building objects)
+
+    def handle_call(self, handle_id, method:str, args:list, kwargs:dict):
+        if method == 'SaveImageStack':
+            return [ 0, 0, 0 ]
+        if method == 'GetImageStack':
+            return [ 'standin/%d/Slice%d_X%d_Y%d.png' % (handle_id, z, x, y) for z in range(2) for x in range(2) for y in range(2) ]
+        if method == 'GetImage':
+            return base64.encodebytes(b'\x89PNG\r\n\x1a\n'+str(args[0]).encode('utf-8')).decode('ascii')
+        if method == 'GetNeuroglancerDatasetURL':
+            return 'http://localhost/standin/%d' % handle_id
+        if method == 'GetDatasetHandle':
+            return 'standin-%d' % handle_id
+        return None
+
+    # --- Simulation calls
+
+    def sim_DeleteResidentByID(self, sim, **kwargs):
+        del self.simulations[sim.ID]
+        return { 'StatusCode': 0 }
+
+    def sim_ModelSave(self, sim, name:str, **kwargs):
+        self.saved_models[name] = sim.modelname
+        return { 'StatusCode': 0 }
+
+    def sim_ModelLoad(self, sim, name:str, **kwargs):
+        if name not in self.saved_models:
+            raise Exception('StandInNES: No saved model %s.' % name)
+        sim.modelname = self.saved_models[name]
+        return { 'StatusCode': 0 }
+
+    def sim_Netmorph_Start(self, sim, modelcontent:str, **kwargs):
+        sim.netmorph_start = time.time()
+        sim.modelname = sim.name+'-%08x' % zlib.crc32(modelcontent.encode('utf-8'))
+        return [ '/tmp/standin/netmorph/%d' % sim.ID, 0 ]
+
+    def sim_Netmorph_GetStatus(self, sim, **kwargs):
+        if sim.netmorph_start is None:
+            return [ 0.0, 'None' ]
+        percent = 100.0*(time.time()-sim.netmorph_start)/max(self.config.netmorph_seconds, 1e-6)
+        if percent >= 100.0:
+            return [ 100.0, 'Done' ]
+        return [ percent, 'Running' ]
+
+    def sim_Netmorph_RunAndWait(self, sim, modelcontent:str, **kwargs):
+        outputdir, errcode = self.sim_Netmorph_Start(sim, modelcontent)
+        time.sleep(self.config.netmorph_seconds)
+        return { 'Success': True, 'NetmorphStatus': 'Done', 'NetmorphOutputDirectory': outputdir }
+
+    def connection_lists(self, sim)->tuple:
+        rng = self.model_rng(sim)
+        N = self.config.num_neurons
+        counts = rng.integers(0, max(2, N//5), N)
+        targets = [ rng.integers(0, N, c) for c in counts ]
+        types = [ np.where(rng.random(c) < 0.8, 1, 2) for c in counts ]
+        return rng, targets, types
+
+    def sim_GetConnectome(self, sim, **kwargs):
+        rng, targets, types = self.connection_lists(sim)
+        return {
+            'StatusCode': 0,
+            'ConnectionTargets': [ t.tolist() for t in targets ],
+            'ConnectionTypes': [ t.tolist() for t in types ],
+            'ConnectionWeights': [ rng.random(len(t)).tolist() for t in targets ],
+            'ConnectionGPeakSum': [ (10.0*rng.random(len(t))).tolist() for t in targets ],
+            'NumReceptors': [ rng.integers(1, 6, len(t)).tolist() for t in targets ],
+        }
+
+    def sim_GetAbstractConnectome(self, sim, **kwargs):
+        rng, targets, types = self.connection_lists(sim)
+        N = self.config.num_neurons
+        prepost = [ [ pre, int(post), int(rng.integers(1, 6)) ] for pre in range(N) for post in targets[pre] ]
+        return {
+            'StatusCode': 0,
+            'PrePostNumReceptors': prepost,
+            'Regions': { 'In': list(range(N//2)), 'Out': list(range(N//2, N)) },
+            'Types': [ 'pyramidal' if i % 5 else 'interneuron' for i in range(N) ],
+        }
+
+    def sim_GetSomaPositions(self, sim, **kwargs):
+        rng = self.model_rng(sim)
+        return { 'StatusCode': 0, 'SomaCenters': (rng.random((self.config.num_neurons, 3))*100.0-50.0).tolist() }
+
+    def sim_GetBoundingBox(self, sim, **kwargs):
+        return [ [ -50.0, -50.0, -50.0 ], [ 50.0, 50.0, 50.0 ] ]
+
+    def sim_RunAndWait(self, sim, Runtime_ms:float, Dt_ms:float=None, **kwargs):
+        sim.runtime_ms += Runtime_ms
+        if Dt_ms is not None:
+            sim.dt_ms = Dt_ms
+        return { 'StatusCode': 0 }
+
+    def sim_GetRecording(self, sim, **kwargs):
+        rng = self.model_rng(sim)
+        t_ms = np.arange(0.0, sim.runtime_ms, sim.dt_ms)
+        Vm = -60.0 + np.cumsum(rng.normal(0.0, 0.5, (self.config.num_neurons, len(t_ms))), axis=1)
+        return {
+            'StatusCode': 0,
+            'Recording': {
+                't_ms': t_ms.tolist(),
+                'neurons': { str(n): { 'Vm_mV': Vm[n].tolist() } for n in range(self.config.num_neurons) },
+            }
+        }
+
+    def sim_GetSpikeTimes(self, sim, **kwargs):
+        rng = self.model_rng(sim)
+        spikes = {}
+        for n in range(self.config.num_neurons):
+            num = rng.poisson(sim.runtime_ms/100.0)
+            spikes[str(n)] = { 'tSpike_ms': np.sort(rng.random(num)*sim.runtime_ms).tolist() }
+        return { 'StatusCode': 0, 'SpikeTimes': spikes }
+
+def make_handler(backend:StandInBackend):
+    class StandInHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def reply(self, code:int, content:dict):
+            body = json.dumps(content).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/Health':
+                self.reply(200, { 'StatusCode': 0 })
+            else:
+                self.reply(404, { 'StatusCode': 1, 'Error': 'Unknown path '+self.path })
+
+        def do_POST(self):
+            if self.path != '/Call':
+                self.reply(404, { 'StatusCode': 1, 'Error': 'Unknown path '+self.path })
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                result = backend.call(request.get('SimID'), request.get('HandleID'), request['Method'], request.get('Args', []), request.get('Kwargs', {}))
+                self.reply(200, { 'StatusCode': 0, 'Result': result })
+            except Exception as e:
+                self.reply(500, { 'StatusCode': 1, 'Error': str(e) })
+
+        def log_message(self, format, *args):
+            pass
+
+    return StandInHandler
+
+def start_server(config:StandInConfig, host='localhost', port=8001)->ThreadingHTTPServer:
+    '''
+    Starts the stand-in server in a background thread, e.g. for use in
+    benchmarks. Call shutdown() on the returned server to stop it.
+    '''
+    server = ThreadingHTTPServer((host, port), make_handler(StandInBackend(config)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# ===== Client side
+
+def encode_argument(obj):
+    '''
+    JSON encoding of call arguments that are not plain data, such as
+    configuration objects, handles and numpy arrays.
+    '''
+    if isinstance(obj, StandInHandle):
+        return { '__handle__': obj.kind, 'ID': obj.ID }
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if hasattr(obj, '__dict__'):
+        return vars(obj)
+    return str(obj)
+
+class StandInCaller:
+    def __init__(self, url:str, timeout_s:float=None):
+        self.url = url
+        self.timeout_s = timeout_s
+
+    def call(self, sim_id, handle_id, method:str, args:tuple, kwargs:dict):
+        import requests # Module-level call, so that a PooledSession applies.
+        body = json.dumps({
+            'SimID': sim_id,
+            'HandleID': handle_id,
+            'Method': method,
+            'Args': list(args),
+            'Kwargs': kwargs,
+        }, default=encode_argument)
+        response = requests.post(self.url+'/Call', data=body, headers={ 'Content-Type': 'application/json' }, timeout=self.timeout_s)
+        content = response.json()
+        if content['StatusCode'] != 0:
+            raise Exception('NES error: %s' % content.get('Error'))
+        return self.wrap(content['Result'])
+
+    def wrap(self, result):
+        if isinstance(result, dict) and '__handle__' in result:
+            return StandInHandle(self, result['__handle__'], result['ID'])
+        return result
+
+class StandInHandle:
+    def __init__(self, caller:StandInCaller, kind:str, handle_id:int):
+        self.caller = caller
+        self.kind = kind
+        self.ID = handle_id
+
+    def __getattr__(self, method:str):
+        if method.startswith('__'):
+            raise AttributeError(method)
+        return lambda *args, **kwargs: self.caller.call(None, self.ID, method, args, kwargs)
+
+class StandInSimulationClient:
+    def __init__(self, caller:StandInCaller, sim_id:int):
+        self.caller = caller
+        self.ID = sim_id
+
+    def __getattr__(self, method:str):
+        if method.startswith('__'):
+            raise AttributeError(method)
+        return lambda *args, **kwargs: self.caller.call(self.ID, None, method, args, kwargs)
+
+class StandInClient:
+    def __init__(self, host='localhost', port=8001, usehttps=False, timeout_s:float=None):
+        self.url = '%s://%s:%d' % ('https' if usehttps else 'http', host, port)
+        self.caller = StandInCaller(self.url, timeout_s)
+
+    def IsReady(self)->bool:
+        import requests
+        try:
+            return requests.get(self.url+'/Health', timeout=5.0).status_code == 200
+        except Exception:
+            return False
+
+    def CreateSimulation(self, SimulationCfg):
+        result = self.caller.call(None, None, 'CreateSimulation', (), { 'Name': getattr(SimulationCfg, 'Name', None) })
+        return StandInSimulationClient(self.caller, result['ID'])
+
+    def __getattr__(self, method:str):
+        if method.startswith('__'):
+            raise AttributeError(method)
+        return lambda *args, **kwargs: self.caller.call(None, None, method, args, kwargs)
+
+if __name__ == '__main__':
+    Parser = argparse.ArgumentParser(description="Local stand-in for the BrainGenix API and NES server")
+    Parser.add_argument("-Host", default="localhost", type=str, help="Host to serve on")
+    Parser.add_argument("-Port", default=8001, type=int, help="Port number to serve on")
+    Parser.add_argument("-Latency_ms", default=0.0, type=float, help="Latency added to each call")
+    Parser.add_argument("-Jitter_ms", default=0.0, type=float, help="Maximum random jitter added to the latency")
+    Parser.add_argument("-FailureRate", default=0.0, type=float, help="Probability that a call fails")
+    Parser.add_argument("-FailMethods", default="", type=str, help="Comma separated methods that may fail (default all)")
+    Parser.add_argument("-Recorded", default=None, type=str, help="Folder with recorded <method>.json responses")
+    Parser.add_argument("-NetmorphSeconds", default=5.0, type=float, help="Duration of a Netmorph run")
+    Parser.add_argument("-Neurons", default=100, type=int, help="Number of neurons in synthetic models")
+    Parser.add_argument("-Seed", default=0, type=int, help="Random seed of synthetic responses and failures")
+    Args = Parser.parse_args()
+
+    config = StandInConfig(
+        latency_ms=Args.Latency_ms,
+        jitter_ms=Args.Jitter_ms,
+        failure_rate=Args.FailureRate,
+        fail_methods=[ m for m in Args.FailMethods.split(',') if m ] or None,
+        recorded=Args.Recorded,
+        netmorph_seconds=Args.NetmorphSeconds,
+        num_neurons=Args.Neurons,
+        seed=Args.Seed)
+    server = ThreadingHTTPServer((Args.Host, Args.Port), make_handler(StandInBackend(config)))
+    print('NES stand-in serving on %s:%d' % (Args.Host, Args.Port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,115 @@
+# StimulusProtocol.py
+
+'''
+Compiles stimulation protocols into the (t, neuron) pairs that are sent
+to NES with SetSpecificAPTimes().
+
+A protocol is built from specifications instead of nested loops:
+- add(neurons, times_ms) stimulates every neuron at every time.
+- add_cycle(groups, stim_times_ms, repeats, repeat_interval_ms, offset_ms)
+  gives stimulus s to groups[s % len(groups)] (e.g. one pattern or cue
+  per training stimulus) and repeats the whole schedule.
+
+compile() returns NumPy arrays of times and neuron IDs, sorted by time
+and then neuron, with duplicates removed, and checks that all times are
+within the run window. upload() sends the pairs in chunks of at most
+max_pairs per request, in time order. Protocols up to that size are
+sent in a single request, as before.
+
+Example (training and cue schedules of autoassociative_connectome.py):
+
+    protocol = StimulusProtocol(runtime_ms=T)
+    protocol.add_cycle(patternstims, training_stim, repeats, repeatinterval)
+    protocol.add_cycle(cuestims, training_stim, repeats, repeatinterval, offset_ms=batchinterval)
+    protocol.upload(MySim)
+'''
+
+import numpy as np
+
+MAX_PAIRS_PER_REQUEST = 50000
+
+class StimulusProtocol:
+    def __init__(self, runtime_ms:float=None):
+        '''
+        If runtime_ms is given, compile() requires all stimulus times to
+        be in [0, runtime_ms).
+        '''
+        self.runtime_ms = runtime_ms
+        self.times = []
+        self.neurons = []
+        self.compiled = None
+
+    def add(self, neurons, times_ms):
+        neurons = np.asarray(neurons, dtype=np.int64).ravel()
+        times_ms = np.asarray(times_ms, dtype=np.float64).ravel()
+        self.times.append(np.repeat(times_ms, len(neurons)))
+        self.neurons.append(np.tile(neurons, len(times_ms)))
+        self.compiled = None
+
+    def add_cycle(self, groups:list, stim_times_ms, repeats=1, repeat_interval_ms=0.0, offset_ms=0.0):
+        '''
+        Stimulus s at stim_times_ms[s] goes to the neurons in
+        groups[s % len(groups)]. The schedule is repeated repeats times,
+        every repeat_interval_ms, starting at offset_ms.
+        '''
+        stim_times_ms = np.asarray(stim_times_ms, dtype=np.float64)
+        starts = offset_ms + repeat_interval_ms*np.arange(repeats)
+        for g in range(len(groups)):
+            group_times = stim_times_ms[g::len(groups)]
+            self.add(groups[g], (starts[:, None] + group_times[None, :]).ravel())
+
+    def compile(self)->tuple:
+        '''
+        Returns (times_ms, neurons), sorted by time then neuron, without
+        duplicate pairs.
+        '''
+        if self.compiled is not None:
+            return self.compiled
+        if len(self.times) == 0:
+            self.compiled = (np.zeros(0, dtype=np.float64), np.zeros(0, dtype=np.int64))
+            return self.compiled
+        times_ms = np.concatenate(self.times)
+        neurons = np.concatenate(self.neurons)
+        order = np.lexsort((neurons, times_ms))
+        times_ms = times_ms[order]
+        neurons = neurons[order]
+        keep = np.ones(len(times_ms), dtype=bool)
+        keep[1:] = (times_ms[1:] != times_ms[:-1]) | (neurons[1:] != neurons[:-1])
+        times_ms = times_ms[keep]
+        neurons = neurons[keep]
+
+        if len(neurons) > 0 and neurons.min() < 0:
+            raise Exception('StimulusProtocol: Negative neuron ID in stimulation protocol.')
+        if self.runtime_ms is not None:
+            outside = int(((times_ms < 0) | (times_ms >= self.runtime_ms)).sum())
+            if outside > 0:
+                raise Exception('StimulusProtocol: %d stimulus times outside run window [0, %s) ms.' % (outside, str(self.runtime_ms)))
+        self.compiled = (times_ms, neurons)
+        return self.compiled
+
+    def __len__(self)->int:
+        return len(self.compile()[0])
+
+    def pairs(self, start=0, stop=None)->list:
+        '''
+        Returns compiled pairs as a list of (t_ms, neuron) tuples of plain
+        Python numbers, as SetSpecificAPTimes() expects.
+        '''
+        times_ms, neurons = self.compile()
+        return list(zip(times_ms[start:stop].tolist(), neurons[start:stop].tolist()))
+
+    def upload(self, sim, max_pairs=MAX_PAIRS_PER_REQUEST)->int:
+        '''
+        Sends the protocol with SetSpecificAPTimes(), in chunks of at most
+        max_pairs (None for a single request). Returns the number of
+        requests made.
+        '''
+        num_pairs = len(self)
+        if max_pairs is None or num_pairs <= max_pairs:
+            sim.SetSpecificAPTimes(self.pairs())
+            return 1
+        num_requests = 0
+        for start in range(0, num_pairs, max_pairs):
+            sim.SetSpecificAPTimes(self.pairs(start, start+max_pairs))
+            num_requests += 1
+        return num_requests
@@ -0,0 +1,210 @@
+# TraceStore.py
+
+'''
+Memory-mapped storage of God's eye recorded membrane potentials and spikes.
+
+A trace store is a folder containing:
+- Vm.npy: dense (neurons x samples) float32 Vm matrix.
+- t_ms.npy: float64 time base of the samples.
+- spikes_offsets.npy, spikes_times.npy: spike trains in CSR form, the
+  spikes of row i are spikes_times[spikes_offsets[i]:spikes_offsets[i+1]].
+- traces.json: sidecar with the neuron ID of each row, the time base
+  (number of samples, start, end and dt if uniform) and file names.
+
+Readers memory-map the .npy files, so that subsets of neurons and time
+windows can be sliced without loading the rest of the recording.
+This replaces the groundtruth-Vm.pkl pickle, existing pickles can be
+converted once with convert_pickled_to_trace_store().
+
+TraceStoreWriter builds a trace store from successive time windows
+(e.g. of a segmented run), keeping only one window in memory at a time.
+'''
+
+import json
+import os
+import shutil
+import numpy as np
+
+from .common.BlockCompression import load_pickled
+
+SIDECAR_FILE = 'traces.json'
+
+def save_trace_store(folder:str, t_ms, Vm, neuron_ids=None, spikes_offsets=None, spikes_times=None):
+    os.makedirs(folder, exist_ok=True)
+    t_ms = np.asarray(t_ms, dtype=np.float64)
+    Vm = np.asarray(Vm, dtype=np.float32)
+    if Vm.ndim != 2 or Vm.shape[1] != len(t_ms):
+        raise Exception('save_trace_store: Vm must be neurons x samples, matching t_ms.')
+    if neuron_ids is None:
+        neuron_ids = np.arange(Vm.shape[0])
+    np.save(os.path.join(folder, 'Vm.npy'), Vm)
+    np.save(os.path.join(folder, 't_ms.npy'), t_ms)
+    has_spikes = spikes_offsets is not None and spikes_times is not None
+    if has_spikes:
+        np.save(os.path.join(folder, 'spikes_offsets.npy'), np.asarray(spikes_offsets, dtype=np.int64))
+        np.save(os.path.join(folder, 'spikes_times.npy'), np.asarray(spikes_times, dtype=np.float64))
+
+    write_sidecar(folder, t_ms, neuron_ids, has_spikes)
+
+def write_sidecar(folder:str, t_ms:np.ndarray, neuron_ids, has_spikes:bool):
+    dt = np.diff(t_ms)
+    uniform = len(dt) > 0 and np.allclose(dt, dt[0])
+    sidecar = {
+        'version': 1,
+        'neuron_ids': [ int(n) for n in neuron_ids ],
+        'num_samples': int(len(t_ms)),
+        't_start_ms': float(t_ms[0]) if len(t_ms) > 0 else None,
+        't_end_ms': float(t_ms[-1]) if len(t_ms) > 0 else None,
+        'dt_ms': float(dt[0]) if uniform else None,
+        'Vm_dtype': 'float32',
+        'has_spikes': has_spikes,
+    }
+    with open(os.path.join(folder, SIDECAR_FILE), 'w') as f:
+        json.dump(sidecar, f, indent=2)
+
+def spikes_cells_to_csr(spikes_cells:list)->tuple:
+    counts = np.array([ len(train) for train in spikes_cells ], dtype=np.int64)
+    offsets = np.zeros(len(spikes_cells)+1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    if len(spikes_cells) == 0:
+        return offsets, np.zeros(0, dtype=np.float64)
+    times = np.concatenate([ np.asarray(train, dtype=np.float64) for train in spikes_cells ])
+    return offsets, times
+
+def is_trace_store(path:str)->bool:
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, SIDECAR_FILE))
+
+class TraceStore:
+    '''
+    Read-only, memory-mapped access to a trace store.
+    '''
+    def __init__(self, folder:str):
+        self.folder = folder
+        with open(os.path.join(folder, SIDECAR_FILE), 'r') as f:
+            self.sidecar = json.load(f)
+        self.neuron_ids = np.array(self.sidecar['neuron_ids'], dtype=np.int64)
+        self.row_of_id = { n: row for row, n in enumerate(self.sidecar['neuron_ids']) }
+        self.Vm = np.load(os.path.join(folder, 'Vm.npy'), mmap_mode='r')
+        self.t_ms = np.load(os.path.join(folder, 't_ms.npy'), mmap_mode='r')
+        self.spikes_offsets = None
+        self.spikes_times = None
+        if self.sidecar['has_spikes']:
+            self.spikes_offsets = np.load(os.path.join(folder, 'spikes_offsets.npy'), mmap_mode='r')
+            self.spikes_times = np.load(os.path.join(folder, 'spikes_times.npy'), mmap_mode='r')
+
+    def rows(self, neuron_ids=None)->np.ndarray:
+        if neuron_ids is None:
+            return np.arange(len(self.neuron_ids))
+        return np.array([ self.row_of_id[int(n)] for n in neuron_ids ], dtype=np.int64)
+
+    def sample_range(self, t_range_ms:tuple=None)->tuple:
+        if t_range_ms is None:
+            return 0, len(self.t_ms)
+        dt_ms = self.sidecar['dt_ms']
+        if dt_ms:
+            # Uniform time base, no need to touch t_ms.
+            t0_ms = self.sidecar['t_start_ms']
+            start = int(np.ceil((t_range_ms[0]-t0_ms)/dt_ms - 1e-9))
+            stop = int(np.ceil((t_range_ms[1]-t0_ms)/dt_ms - 1e-9))
+            return max(0, start), min(len(self.t_ms), max(0, stop))
+        start = int(np.searchsorted(self.t_ms, t_range_ms[0], side='left'))
+        stop = int(np.searchsorted(self.t_ms, t_range_ms[1], side='left'))
+        return start, stop
+
+    def read(self, neuron_ids=None, t_range_ms:tuple=None)->tuple:
+        '''
+        Returns (t_ms, Vm) for the given neuron IDs (default all) and time
+        window [t_start, t_end) (default all). Only the requested part of
+        the Vm matrix is read from disk.
+        '''
+        start, stop = self.sample_range(t_range_ms)
+        if neuron_ids is None:
+            Vm = np.array(self.Vm[:, start:stop])
+        else:
+            Vm = np.array(self.Vm[self.rows(neuron_ids), start:stop])
+        return np.array(self.t_ms[start:stop]), Vm
+
+    def spikes(self, neuron_ids=None, t_range_ms:tuple=None)->list:
+        '''
+        Returns a list of spike time arrays, one for each requested neuron.
+        '''
+        if self.spikes_offsets is None:
+            return None
+        trains = []
+        for row in self.rows(neuron_ids):
+            train = self.spikes_times[self.spikes_offsets[row]:self.spikes_offsets[row+1]]
+            if t_range_ms is not None:
+                train = train[(train >= t_range_ms[0]) & (train < t_range_ms[1])]
+            trains.append(np.array(train))
+        return trains
+
+class TraceStoreWriter:
+    '''
+    Appends time windows of Vm (neurons x samples, rows in the order of
+    neuron_ids) to chunk files in folder/chunks. finalize() assembles
+    Vm.npy one chunk at a time and writes the rest of the trace store.
+    '''
+    def __init__(self, folder:str, neuron_ids):
+        self.folder = folder
+        self.neuron_ids = np.asarray(neuron_ids, dtype=np.int64)
+        self.chunkfolder = os.path.join(folder, 'chunks')
+        self.chunks = []
+        self.num_samples = 0
+        self.t_end_ms = None # Time of the last stored sample.
+        os.makedirs(self.chunkfolder, exist_ok=True)
+
+    def append(self, t_ms, Vm):
+        '''
+        Samples at or before the last stored sample are skipped, so that
+        overlapping windows can be appended.
+        '''
+        t_ms = np.asarray(t_ms, dtype=np.float64)
+        new = self.new_samples(t_ms)
+        t_ms = t_ms[new]
+        Vm = Vm[:, new]
+        if len(t_ms) == 0:
+            return
+        if Vm.shape[0] != len(self.neuron_ids):
+            raise Exception('TraceStoreWriter: Vm rows do not match neuron_ids.')
+        chunk = os.path.join(self.chunkfolder, '%05d' % len(self.chunks))
+        np.save(chunk+'_t_ms.npy', t_ms)
+        np.save(chunk+'_Vm.npy', np.asarray(Vm, dtype=np.float32))
+        self.chunks.append(chunk)
+        self.num_samples += len(t_ms)
+        self.t_end_ms = float(t_ms[-1])
+
+    def new_samples(self, t_ms:np.ndarray)->np.ndarray:
+        if self.t_end_ms is None:
+            return np.ones(len(t_ms), dtype=bool)
+        return t_ms > self.t_end_ms
+
+    def finalize(self, spikes_offsets=None, spikes_times=None):
+        Vm = np.lib.format.open_memmap(os.path.join(self.folder, 'Vm.npy'), mode='w+', dtype=np.float32, shape=(len(self.neuron_ids), self.num_samples))
+        t_ms = np.zeros(self.num_samples, dtype=np.float64)
+        start = 0
+        for chunk in self.chunks:
+            chunk_t_ms = np.load(chunk+'_t_ms.npy')
+            Vm[:, start:start+len(chunk_t_ms)] = np.load(chunk+'_Vm.npy', mmap_mode='r')
+            t_ms[start:start+len(chunk_t_ms)] = chunk_t_ms
+            start += len(chunk_t_ms)
+        Vm.flush()
+        del Vm
+        np.save(os.path.join(self.folder, 't_ms.npy'), t_ms)
+        has_spikes = spikes_offsets is not None and spikes_times is not None
+        if has_spikes:
+            np.save(os.path.join(self.folder, 'spikes_offsets.npy'), np.asarray(spikes_offsets, dtype=np.int64))
+            np.save(os.path.join(self.folder, 'spikes_times.npy'), np.asarray(spikes_times, dtype=np.float64))
+        write_sidecar(self.folder, t_ms, self.neuron_ids, has_spikes)
+        shutil.rmtree(self.chunkfolder)
+
+def convert_pickled_to_trace_store(pklfile:str, folder:str):
+    '''
+    One-time conversion of a groundtruth-Vm.pkl (or .pkl.blz) file with
+    {t_ms, Vm_cells, spikes_cells}. Rows are numbered by their order in
+    the pickle, as neuron IDs were not stored there.
+    '''
+    data = load_pickled(pklfile)
+    spikes_offsets, spikes_times = None, None
+    if data.get('spikes_cells'):
+        spikes_offsets, spikes_times = spikes_cells_to_csr(data['spikes_cells'])
+    save_trace_store(folder, data['t_ms'], data['Vm_cells'], None, spikes_offsets, spikes_times)
@@ -0,0 +1,138 @@
+# BlockCompression.py
+
+'''
+Block-parallel compression of large payloads (pickled acquisition data,
+recordings, connection matrices).
+
+The payload is split into fixed-size blocks that are compressed
+independently on a thread pool (zlib and lzma release the GIL, so this
+scales with the number of cores). Because the blocks are independent,
+they can also be decompressed in parallel when loading.
+
+File layout:
+
+  MAGIC | block | block | ... | index (JSON) | index offset (uint64) | MAGIC
+
+The index holds the codec, the raw payload size and the file offset,
+compressed length and raw length of every block.
+
+Codecs:
+  'none'  No compression (still block indexed).
+  'fast'  zlib level 1, for acquisition scripts that must not block.
+  'zlib'  zlib level 6, the default.
+  'high'  lzma preset 6, highest ratio, slowest.
+  'gzip'  gzip members, whose concatenation is itself a valid gzip file.
+'''
+
+import gzip
+import json
+import lzma
+import os
+import pickle
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+BLOCK_MAGIC = b'BGBLK001'
+BLOCK_FOOTER = struct.Struct('<Q8s')
+BLOCK_SIZE = 4 << 20
+
+CODECS = {
+    'none': (lambda b: b, lambda b: b),
+    'fast': (lambda b: zlib.compress(b, 1), zlib.decompress),
+    'zlib': (lambda b: zlib.compress(b, 6), zlib.decompress),
+    'high': (lambda b: lzma.compress(b, preset=6), lzma.decompress),
+    'gzip': (lambda b: gzip.compress(b, compresslevel=6), gzip.decompress),
+}
+
+def default_workers()->int:
+    return os.cpu_count() or 1
+
+def check_codec(codec:str):
+    if codec not in CODECS:
+        raise Exception('BlockCompression: Unknown codec %s, expected one of %s.' % (str(codec), str(list(CODECS.keys()))))
+
+def compress(data:bytes, codec:str)->bytes:
+    return CODECS[codec][0](data)
+
+def decompress(data:bytes, codec:str)->bytes:
+    return CODECS[codec][1](data)
+
+def parallel_compress(blocks:list, codec='zlib', workers:int=None)->list:
+    '''
+    Compress a list of independent blocks on a thread pool, preserving order.
+    '''
+    check_codec(codec)
+    if workers is None: workers = default_workers()
+    if workers <= 1 or len(blocks) <= 1:
+        return [ compress(block, codec) for block in blocks ]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda block: compress(block, codec), blocks))
+
+def parallel_decompress(blocks:list, codec='zlib', workers:int=None)->list:
+    check_codec(codec)
+    if workers is None: workers = default_workers()
+    if workers <= 1 or len(blocks) <= 1:
+        return [ decompress(block, codec) for block in blocks ]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda block: decompress(block, codec), blocks))
+
+def split_blocks(payload:bytes, block_size=BLOCK_SIZE)->list:
+    view = memoryview(payload)
+    return [ view[start:start+block_size] for start in range(0, len(payload), block_size) ]
+
+def write_block_compressed(payload:bytes, file:str, codec='zlib', block_size=BLOCK_SIZE, workers:int=None):
+    blocks = split_blocks(payload, block_size)
+    compressed = parallel_compress(blocks, codec, workers)
+    index = {
+        'version': 1,
+        'codec': codec,
+        'block_size': block_size,
+        'raw_size': len(payload),
+        'blocks': [],
+    }
+    with open(file, 'wb') as f:
+        f.write(BLOCK_MAGIC)
+        for block, cblock in zip(blocks, compressed):
+            index['blocks'].append({ 'offset': f.tell(), 'length': len(cblock), 'raw_length': len(block) })
+            f.write(cblock)
+        index_offset = f.tell()
+        f.write(json.dumps(index).encode('utf-8'))
+        f.write(BLOCK_FOOTER.pack(index_offset, BLOCK_MAGIC))
+
+def is_block_compressed(file:str)->bool:
+    with open(file, 'rb') as f:
+        return f.read(len(BLOCK_MAGIC)) == BLOCK_MAGIC
+
+def read_block_index(f)->dict:
+    f.seek(-BLOCK_FOOTER.size, 2)
+    footer_pos = f.tell()
+    index_offset, magic = BLOCK_FOOTER.unpack(f.read(BLOCK_FOOTER.size))
+    if magic != BLOCK_MAGIC:
+        raise Exception('BlockCompression: Missing block index.')
+    f.seek(index_offset)
+    return json.loads(f.read(footer_pos-index_offset).decode('utf-8'))
+
+def read_block_compressed(file:str, workers:int=None)->bytes:
+    with open(file, 'rb') as f:
+        index = read_block_index(f)
+        cblocks = []
+        for block in index['blocks']:
+            f.seek(block['offset'])
+            cblocks.append(f.read(block['length']))
+    payload = b''.join(parallel_decompress(cblocks, index['codec'], workers))
+    if len(payload) != index['raw_size']:
+        raise Exception('BlockCompression: Payload size mismatch in %s.' % file)
+    return payload
+
+def dump_pickled(obj, file:str, codec='zlib', block_size=BLOCK_SIZE, workers:int=None):
+    write_block_compressed(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL), file, codec, block_size, workers)
+
+def load_pickled(file:str, workers:int=None):
+    '''
+    Loads a block-compressed pickle or a plain pickle file.
+    '''
+    if is_block_compressed(file):
+        return pickle.loads(read_block_compressed(file, workers))
+    with open(file, 'rb') as f:
+        return pickle.load(f)
@@ -0,0 +1,275 @@
+# ExpsDB.py
+
+'''
+Storage backend of the experiments database used by the vbpcommon
+InitExpDB/UpdateExpsDB/GetMostRecentDBEntry* functions.
+
+Entries are kept in an SQLite file next to the path that the scripts
+were given with -ExpsDB (./ExpsDB.json -> ./ExpsDB.sqlite). Each entry
+is one row with its key (e.g. 'reservoir', 'connectome', 'acquisition'),
+the IN and OUT modelname and the JSON encoded {IN, OUT} entry. Adding
+an entry is a single INSERT instead of a rewrite of the whole file, and
+the most recent entry for a (key, modelname) is found with an index.
+
+When a database is opened, the entries of an existing ExpsDB.json are
+imported in their original order. The number of entries imported per
+key and the modification time of the file are recorded, so entries that
+other tools append to the JSON file later are imported the next time a
+script opens the database. The JSON file itself is never written by the
+scripts: entries they add are only in the SQLite database. Anything that
+reads ExpsDB.json needs an export first:
+
+    python3 ExpsDB.py ExpsDB.sqlite ExpsDB.json
+
+(or export_json() from Python), which writes the database out in the
+original format and records the exported file as imported.
+
+Concurrent writers: the database is opened in WAL mode, so readers do
+not block writers. Every write is a BEGIN IMMEDIATE transaction, which
+takes the SQLite write lock (an OS-level file lock) before anything is
+read, so parallel sample processes are serialized by SQLite instead of
+clobbering each other. A writer waits up to BUSY_TIMEOUT_S for the lock
+and retries with backoff after that, it never proceeds without it.
+append_entries() adds many entries in one transaction.
+'''
+
+import json
+import os
+import random
+import sqlite3
+from contextlib import contextmanager
+from pathlib import Path
+from time import sleep
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL,
+    modelname_in TEXT,
+    modelname_out TEXT,
+    entry TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_key_in ON entries (key, modelname_in, id);
+CREATE INDEX IF NOT EXISTS entries_key_out ON entries (key, modelname_out, id);
+CREATE TABLE IF NOT EXISTS imports (
+    jsonfile TEXT PRIMARY KEY,
+    mtime REAL
+);
+CREATE TABLE IF NOT EXISTS imported_keys (
+    jsonfile TEXT NOT NULL,
+    key TEXT NOT NULL,
+    num_entries INTEGER,
+    PRIMARY KEY (jsonfile, key)
+);
+'''
+
+SQLITE_SUFFIXES = ('.sqlite', '.db')
+
+BUSY_TIMEOUT_S = 30.0
+WRITE_RETRIES = 10
+
+# Open connections by database path, reused by repeated calls in a script.
+# Connections are not shared with forked child processes, see open_exps_db().
+connections = {}
+
+def sqlite_path(dbfile:str)->str:
+    if dbfile.endswith(SQLITE_SUFFIXES):
+        return dbfile
+    return str(Path(dbfile).with_suffix('.sqlite'))
+
+def json_path(dbfile:str)->str:
+    if dbfile.endswith(SQLITE_SUFFIXES):
+        return str(Path(dbfile).with_suffix('.json'))
+    return dbfile
+
+def modelname_column(part:dict):
+    if not isinstance(part, dict) or 'modelname' not in part:
+        return None
+    modelname = part['modelname']
+    if isinstance(modelname, str):
+        return modelname
+    return json.dumps(modelname)
+
+def entry_row(key:str, entry:dict)->tuple:
+    return (
+        key,
+        modelname_column(entry.get('IN')),
+        modelname_column(entry.get('OUT')),
+        json.dumps(entry),
+    )
+
+@contextmanager
+def write_transaction(conn:sqlite3.Connection):
+    '''
+    Holds the database write lock for the duration of the block and
+    commits at the end, or rolls back if the block raises.
+    '''
+    for attempt in range(WRITE_RETRIES):
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            break
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e) and 'busy' not in str(e):
+                raise
+            if attempt == WRITE_RETRIES-1:
+                raise Exception('ExpsDB: Unable to obtain database write lock: '+str(e))
+            sleep(random.uniform(0.05, 0.5)*(attempt+1))
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+def record_import(conn:sqlite3.Connection, jsonfile:str, DBcontent:dict, mtime:float):
+    '''
+    Call within a write transaction.
+    '''
+    conn.executemany('INSERT OR REPLACE INTO imported_keys (jsonfile, key, num_entries) VALUES (?, ?, ?)',
+        [ (jsonfile, key, len(entries)) for key, entries in DBcontent.items() ])
+    conn.execute('INSERT OR REPLACE INTO imports (jsonfile, mtime) VALUES (?, ?)', (jsonfile, mtime))
+
+def import_json(conn:sqlite3.Connection, jsonfile:str)->int:
+    '''
+    Imports the entries of a JSON experiments database {key: [entries]}
+    that were not imported before, i.e. those appended to the lists of
+    each key since the last import. Returns the number of entries
+    imported, 0 if the file is unchanged or does not exist. If the file
+    has fewer entries for a key than were imported, it was rewritten,
+    and it is not imported from until it is replaced by export_json().
+    The check is made while holding the write lock, so that concurrently
+    starting processes import each entry only once.
+    '''
+    if not os.path.exists(jsonfile):
+        return 0
+    jsonfile = os.path.abspath(jsonfile)
+    mtime = os.path.getmtime(jsonfile)
+    row = conn.execute('SELECT mtime FROM imports WHERE jsonfile=?', (jsonfile,)).fetchone()
+    if row is not None and row[0] == mtime:
+        return 0
+    try:
+        with open(jsonfile, 'r') as f:
+            DBcontent = json.load(f)
+    except Exception as e:
+        print('ExpsDB: Warning - Unable to import %s, will retry when next opened: %s' % (jsonfile, str(e)))
+        return 0
+    with write_transaction(conn):
+        row = conn.execute('SELECT mtime FROM imports WHERE jsonfile=?', (jsonfile,)).fetchone()
+        if row is not None and row[0] == mtime:
+            return 0
+        imported = dict(conn.execute('SELECT key, num_entries FROM imported_keys WHERE jsonfile=?', (jsonfile,)).fetchall())
+        rewritten = [ key for key, num_entries in imported.items() if len(DBcontent.get(key, [])) < num_entries ]
+        if len(rewritten) > 0:
+            print('ExpsDB: WARNING - %s has fewer %s entries than were imported from it. It was rewritten and is NOT imported. Replace it with export_json() and add its new entries again.' % (jsonfile, ', '.join(rewritten)))
+            conn.execute('INSERT OR REPLACE INTO imports (jsonfile, mtime) VALUES (?, ?)', (jsonfile, mtime))
+            return 0
+        rows = [ entry_row(key, entry) for key, entries in DBcontent.items() for entry in entries[imported.get(key, 0):] ]
+        conn.executemany('INSERT INTO entries (key, modelname_in, modelname_out, entry) VALUES (?, ?, ?, ?)', rows)
+        record_import(conn, jsonfile, DBcontent, mtime)
+    if len(rows) > 0:
+        print('Imported %d entries from %s into experiments database.' % (len(rows), jsonfile))
+    return len(rows)
+
+def open_exps_db(dbfile:str)->sqlite3.Connection:
+    dbpath = sqlite_path(dbfile)
+    if dbpath in connections:
+        pid, conn = connections[dbpath]
+        if pid == os.getpid():
+            import_json(conn, json_path(dbfile))
+            return conn
+    # Transactions are managed explicitly by write_transaction().
+    conn = sqlite3.connect(dbpath, timeout=BUSY_TIMEOUT_S, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    with write_transaction(conn):
+        for statement in SCHEMA.split(';'):
+            if statement.strip():
+                conn.execute(statement)
+    import_json(conn, json_path(dbfile))
+    connections[dbpath] = (os.getpid(), conn)
+    return conn
+
+def close_exps_db(dbfile:str):
+    pid, conn = connections.pop(sqlite_path(dbfile), (None, None))
+    if pid == os.getpid():
+        conn.close()
+
+def append_entry(dbfile:str, key:str, entry:dict)->int:
+    '''
+    Adds one entry and returns its row ID.
+    '''
+    conn = open_exps_db(dbfile)
+    with write_transaction(conn):
+        cursor = conn.execute('INSERT INTO entries (key, modelname_in, modelname_out, entry) VALUES (?, ?, ?, ?)', entry_row(key, entry))
+    return cursor.lastrowid
+
+def append_entries(dbfile:str, keyed_entries:list)->int:
+    '''
+    Adds a list of (key, entry) pairs in a single transaction, either
+    all of them are stored or none. Returns the number of entries added.
+    '''
+    rows = [ entry_row(key, entry) for key, entry in keyed_entries ]
+    if len(rows) == 0:
+        return 0
+    conn = open_exps_db(dbfile)
+    with write_transaction(conn):
+        conn.executemany('INSERT INTO entries (key, modelname_in, modelname_out, entry) VALUES (?, ?, ?, ?)', rows)
+    return len(rows)
+
+def most_recent_entry(dbfile:str, key:str, modelfromIN:bool, modelname)->dict:
+    '''
+    Returns the most recently added entry with key and the modelname
+    in its IN (modelfromIN=True) or OUT part, or None if there is none.
+    '''
+    conn = open_exps_db(dbfile)
+    column = 'modelname_in' if modelfromIN else 'modelname_out'
+    row = conn.execute(
+        'SELECT entry FROM entries WHERE key=? AND %s=? ORDER BY id DESC LIMIT 1' % column,
+        (key, modelname_column({'modelname': modelname}))).fetchone()
+    if row is None:
+        return None
+    return json.loads(row[0])
+
+def count_entries(dbfile:str, key:str=None)->int:
+    conn = open_exps_db(dbfile)
+    if key is None:
+        return conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+    return conn.execute('SELECT COUNT(*) FROM entries WHERE key=?', (key,)).fetchone()[0]
+
+def load_all(dbfile:str)->dict:
+    '''
+    Returns the whole database as {key: [entries]}, in the layout of
+    the original ExpsDB.json.
+    '''
+    return entries_by_key(open_exps_db(dbfile))
+
+def entries_by_key(conn:sqlite3.Connection)->dict:
+    DBcontent = {}
+    for key, entry in conn.execute('SELECT key, entry FROM entries ORDER BY id'):
+        DBcontent.setdefault(key, []).append(json.loads(entry))
+    return DBcontent
+
+def export_json(dbfile:str, jsonfile:str):
+    '''
+    Writes the whole database to jsonfile in the layout of the original
+    ExpsDB.json, for tools that read the JSON file. The exported file is
+    recorded as imported, so its entries are not imported again. The
+    write lock is held throughout, so no other process imports the file
+    before it is recorded.
+    '''
+    conn = open_exps_db(dbfile)
+    with write_transaction(conn):
+        DBcontent = entries_by_key(conn)
+        tmpfile = jsonfile+'.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump(DBcontent, f, indent=2)
+        os.replace(tmpfile, jsonfile)
+        record_import(conn, os.path.abspath(jsonfile), DBcontent, os.path.getmtime(jsonfile))
+
+if __name__ == '__main__':
+    import argparse
+    Parser = argparse.ArgumentParser(description="Export the experiments database to a JSON file")
+    Parser.add_argument("dbfile", type=str, help="Experiments database, e.g. ExpsDB.sqlite")
+    Parser.add_argument("jsonfile", type=str, help="JSON file to write, e.g. ExpsDB.json")
+    Args = Parser.parse_args()
+    export_json(Args.dbfile, Args.jsonfile)
+    print('Exported %d entries to %s.' % (count_entries(Args.dbfile), Args.jsonfile))
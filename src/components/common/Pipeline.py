@@ -0,0 +1,235 @@
+# Pipeline.py
+
+'''
+Cached, dependency-aware runner for multi-stage model scripts, e.g.
+reservoir -> connectome -> acquisition(s).
+
+Each Stage is a command (usually one of the model scripts) with:
+- input_files: files whose content determines the result (the script
+  itself, the Netmorph model file, ...),
+- after: names of stages whose results it uses,
+- output_paths: files or folders that must exist for a cached result
+  to be reused (saved model names on the NES server cannot be checked
+  from here and are trusted from the cache record).
+
+The key of a stage is a hash of its command, the content of its input
+files and the keys of the stages it comes after, so a change anywhere
+upstream also invalidates everything downstream. Keys of completed
+stages are kept in a JSON cache file. When the pipeline runs, stages
+with an unchanged key and existing outputs are skipped (unless a stage
+before them has to run), and all stages whose dependencies are done
+are run in parallel (up to max_parallel), each with its output in a
+log file.
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+def file_hash(filepath:str)->str:
+    if not os.path.exists(filepath):
+        return 'missing'
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+class Stage:
+    def __init__(self, name:str, command:list, input_files:list=None, after:list=None, output_paths:list=None, outputs:dict=None):
+        self.name = name
+        self.command = [ str(c) for c in command ]
+        self.input_files = input_files or []
+        self.after = after or []
+        self.output_paths = output_paths or []
+        self.outputs = outputs or {} # Recorded with the stage, e.g. saved model names.
+
+    def key(self, after_keys:list)->str:
+        content = {
+            'command': self.command,
+            'inputs': { f: file_hash(f) for f in self.input_files },
+            'after': after_keys,
+        }
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+class Pipeline:
+    def __init__(self, cachefile:str, logfolder:str, max_parallel=2):
+        self.cachefile = cachefile
+        self.logfolder = logfolder
+        self.max_parallel = max_parallel
+        self.stages = {}
+        self.cache_lock = threading.Lock()
+        self.cache = self.load_cache()
+
+    def load_cache(self)->dict:
+        if not os.path.exists(self.cachefile):
+            return {}
+        try:
+            with open(self.cachefile, 'r') as f:
+                return json.load(f)
+        except Exception as e:
+            print('Pipeline: Unreadable cache file, running all stages: '+str(e))
+            return {}
+
+    def save_cache(self):
+        with self.cache_lock:
+            tmpfile = self.cachefile+'.tmp'
+            with open(tmpfile, 'w') as f:
+                json.dump(self.cache, f, indent=2)
+            os.replace(tmpfile, self.cachefile)
+
+    def add(self, stage:Stage):
+        for name in stage.after:
+            if name not in self.stages:
+                raise Exception('Pipeline: Stage %s comes after unknown stage %s.' % (stage.name, name))
+        self.stages[stage.name] = stage
+
+    def keys(self)->dict:
+        # Stages are added after their dependencies, so insertion order is topological.
+        keys = {}
+        for name, stage in self.stages.items():
+            keys[name] = stage.key([ keys[a] for a in stage.after ])
+        return keys
+
+    def is_cached(self, stage:Stage, key:str)->bool:
+        record = self.cache.get(stage.name)
+        if record is None or record['key'] != key:
+            return False
+        return all(os.path.exists(p) for p in stage.output_paths)
+
+    def run_stage(self, stage:Stage, key:str)->bool:
+        os.makedirs(self.logfolder, exist_ok=True)
+        logfile = os.path.join(self.logfolder, stage.name+'.log')
+        print('Pipeline: Running %s (log: %s)' % (stage.name, logfile))
+        with open(logfile, 'w') as log:
+            result = subprocess.run(stage.command, stdout=log, stderr=subprocess.STDOUT)
+        if result.returncode != 0:
+            print('Pipeline: Stage %s failed with exit code %d.' % (stage.name, result.returncode))
+            return False
+        missing = [ p for p in stage.output_paths if not os.path.exists(p) ]
+        if len(missing) > 0:
+            print('Pipeline: Stage %s did not produce %s.' % (stage.name, str(missing)))
+            return False
+        with self.cache_lock:
+            self.cache[stage.name] = {
+                'key': key,
+                'command': stage.command,
+                'outputs': stage.outputs,
+                'output_paths': stage.output_paths,
+                'completed': datetime.now().strftime('%Y%m%d%H%M%S'),
+            }
+        self.save_cache()
+        print('Pipeline: Completed %s' % stage.name)
+        return True
+
+    def run(self, force:list=None)->dict:
+        '''
+        Runs the pipeline. Stages named in force, and all stages after
+        them, are run even if their results are cached.
+        Returns { stage name: 'cached' | 'completed' | 'failed' | 'blocked' }.
+        '''
+        force = force or []
+        keys = self.keys()
+        status = {}
+        for name, stage in self.stages.items():
+            # A stage is re-run whenever a stage before it is re-run.
+            if name in force or not all(status.get(a) == 'cached' for a in stage.after):
+                continue
+            if self.is_cached(stage, keys[name]):
+                status[name] = 'cached'
+                print('Pipeline: Skipping %s, cached result of %s' % (name, self.cache[name]['completed']))
+
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_parallel) as executor:
+            while True:
+                for name, stage in self.stages.items():
+                    if name in status or name in running.values():
+                        continue
+                    if any(status.get(a) in ('failed', 'blocked') for a in stage.after):
+                        status[name] = 'blocked'
+                        print('Pipeline: Not running %s, an earlier stage failed.' % name)
+                    elif all(status.get(a) in ('cached', 'completed') for a in stage.after):
+                        running[executor.submit(self.run_stage, stage, keys[name])] = name
+                if len(running) == 0:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        status[name] = 'completed' if future.result() else 'failed'
+                    except Exception as e:
+                        print('Pipeline: Stage %s could not be run: %s' % (name, str(e)))
+                        status[name] = 'failed'
+        return status
+
+def print_status(status:dict):
+    for name, state in status.items():
+        print('  %-30s %s' % (name, state))
+
+def vbp_model_pipeline(Args, scripts:dict, python:str, max_parallel=2)->Pipeline:
+    '''
+    Builds the reservoir -> connectome -> acquisition pipeline of a model
+    folder (the current directory), as in its Run.sh. scripts gives the
+    'reservoir', 'connectome' and 'acquisition' script names. There is
+    one acquisition stage for each of Args.Resolutions, these run in
+    parallel once the tuned model exists.
+    '''
+    connection = [ '-Host', Args.Host, '-Port', Args.Port ]
+    if Args.UseHTTPS:
+        connection += [ '-UseHTTPS', 'True' ]
+    shared_inputs = [ 'vbpcommon.py' ]
+    tunedmodelname = Args.modelname+'-tuned'
+
+    pipeline = Pipeline('pipeline_cache.json', 'output/pipeline-logs', max_parallel)
+    pipeline.add(Stage(
+        'reservoir',
+        [ python, scripts['reservoir'] ] + connection + [ '-modelfile', Args.modelfile, '-modelname', Args.modelname ],
+        input_files=[ scripts['reservoir'], Args.modelfile ] + shared_inputs,
+        outputs={ 'modelname': Args.modelname }))
+    pipeline.add(Stage(
+        'connectome',
+        [ python, scripts['connectome'] ] + connection + [ '-modelname', Args.modelname ],
+        input_files=[ scripts['connectome'] ] + shared_inputs,
+        after=[ 'reservoir' ],
+        outputs={ 'modelname': tunedmodelname }))
+
+    options = [ '-RenderEM', '-SubdivideSize', Args.SubdivideSize ]
+    for flag in ('Neuroglancer', 'Segmentation', 'Meshes', 'RenderCA', 'DownloadEM'):
+        if getattr(Args, flag):
+            options.append('-'+flag)
+    if Args.NeuroglancerURLBase:
+        options += [ '-NeuroglancerURLBase', Args.NeuroglancerURLBase ]
+    for resolution_um in Args.Resolutions:
+        savefolder = 'output/pipeline-%s-%sum' % (tunedmodelname, str(resolution_um))
+        pipeline.add(Stage(
+            'acquisition-%sum' % str(resolution_um),
+            [ python, scripts['acquisition'] ] + connection + [ '-modelname', tunedmodelname, '-Resolution_um', resolution_um, '-savefolder', savefolder ] + options,
+            input_files=[ scripts['acquisition'] ] + shared_inputs,
+            after=[ 'connectome' ],
+            output_paths=[ savefolder+'/ChallengeOutput/EMRegions/0/Data' ] if Args.DownloadEM else [],
+            outputs={ 'savefolder': savefolder }))
+    return pipeline
+
+def vbp_pipeline_args(description:str, modelfile:str, modelname:str):
+    Parser = argparse.ArgumentParser(description=description)
+    Parser.add_argument("-Host", default="localhost", type=str, help="Host to connect to")
+    Parser.add_argument("-Port", default=8000, type=int, help="Port number to connect to")
+    Parser.add_argument("-UseHTTPS", default=False, type=bool, help="Enable or disable HTTPS")
+    Parser.add_argument("-modelfile", default=modelfile, type=str, help="File to read model instructions from (def: %s)" % modelfile)
+    Parser.add_argument("-modelname", default=modelname, type=str, help="Name of neuronal circuit model to save (def: %s)" % modelname)
+    Parser.add_argument("-Resolutions", default=[ 0.1 ], type=float, nargs='+', help="Acquire a data set at each of these resolutions in microns (def: 0.1)")
+    Parser.add_argument("-SubdivideSize", default=10, type=int, help="Amount to subdivide region in (def: 10)")
+    Parser.add_argument("-Neuroglancer", action='store_true', help="Generate the Neuroglancer verison of the dataset for EM images")
+    Parser.add_argument("-NeuroglancerURLBase", default=None, type=str, help="Force a different URL base for the generated Neuroglancer URL")
+    Parser.add_argument("-Segmentation", action='store_true', help="Generate EM segmentation images (e.g. for Neuroglancer)")
+    Parser.add_argument("-Meshes", action='store_true', help="Generate Mesh data for Neuroglancer")
+    Parser.add_argument("-RenderCA", action='store_true', help="Enable or disable Calcium imaging rendering")
+    Parser.add_argument("-DownloadEM", action="store_true", help="Enable downloading of EM Images")
+    Parser.add_argument("-maxparallel", default=2, type=int, help="Maximum number of stages running at once (def: 2)")
+    Parser.add_argument("-force", default=[], type=str, nargs='*', help="Run these stages (and those after them) even if cached, e.g. connectome")
+    return Parser.parse_args()
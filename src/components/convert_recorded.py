@@ -0,0 +1,30 @@
+#!../../venv/bin/python
+# A little tool to convert recorded data pickles (groundtruth-Vm.pkl)
+# into memory-mapped trace stores that visualize_recorded.py and
+# analysis scripts can slice without loading everything.
+#
+# Remember, this needs: source BrainEmulationChallenge/venv/bin/activate
+
+import argparse
+import os
+
+from NES_interfaces.TraceStore import convert_pickled_to_trace_store
+
+Parser = argparse.ArgumentParser(description="Convert recorded data pickle to trace store")
+Parser.add_argument("-f", type=str, help="Data file path (groundtruth-Vm.pkl or .pkl.blz)")
+Parser.add_argument("-o", type=str, help="Trace store folder (default: next to the pickle)")
+Args = Parser.parse_args()
+
+if not Args.f:
+    datapath = input('Data path: ')
+    Args.f = str(datapath)
+
+if not os.path.exists(Args.f):
+    print('File not found at '+str(Args.f))
+    exit(1)
+
+if not Args.o:
+    Args.o = os.path.join(os.path.dirname(Args.f), 'groundtruth-Vm')
+
+convert_pickled_to_trace_store(Args.f, Args.o)
+print('Converted %s to trace store %s.' % (Args.f, Args.o))
@@ -10,6 +10,9 @@ from json import JSONEncoder
 import numpy as np
 import pickle
 import gzip
+import struct
+
+from .common.BlockCompression import check_codec, compress, decompress, split_blocks, parallel_compress, parallel_decompress, dump_pickled, load_pickled, is_block_compressed
 
 class NumpyArrayEncoder(JSONEncoder):
     def default(self, obj):
@@ -31,10 +34,268 @@ def recreate_nparrays(data:dict)->dict:
 	# Other data remains untouched.
 	return data
 
-def save_acq_data(data:dict, file:str):
+# -- Chunked acquisition data container: -------------------------------------
+#
+# A container file (.acq) stores each recording stream of an acquisition
+# dict (time base, Vm per neuron, electrode sites, calcium stacks) as a
+# separately compressed sequence of chunks along its time axis:
+#
+#   MAGIC | chunk | chunk | ... | index (JSON) | index offset (uint64) | MAGIC
+#
+# The index lists, for each stream, its path in the acquisition dict,
+# dtype, shape, time axis, time base stream and the file offset, length
+# and sample range of every chunk. Leaves that are not numeric arrays
+# are pickled as single objects. Streams can be read lazily and by time
+# range through Acq_Container. Streams saved with codec 'none' are stored
+# contiguously and can be memory-mapped. The codec can be chosen per
+# stream (see common/BlockCompression.py), and chunks are compressed and
+# decompressed in parallel on a thread pool.
+
+ACQ_MAGIC = b'BGACQ001'
+ACQ_FOOTER = struct.Struct('<Q8s')
+ACQ_CHUNK_BYTES = 1 << 20 # Target uncompressed size of a chunk.
+
+def as_numeric_array(value):
+	'''
+	Returns value as a numeric ndarray, or None if it is not a regular
+	numeric array (e.g. ragged lists, strings, dicts).
+	'''
+	if isinstance(value, np.ndarray):
+		return value if value.dtype.kind in 'biuf' else None
+	if not isinstance(value, (list, tuple)) or len(value)==0:
+		return None
+	try:
+		arr = np.asarray(value)
+	except ValueError:
+		return None
+	if arr.dtype.kind not in 'biuf':
+		return None
+	return arr
+
+def find_time_base(data:dict, parents:list, arr:np.ndarray)->tuple:
+	'''
+	Find the nearest 't_ms' in this dict or its ancestors whose length
+	matches an axis of arr. Prefers the last axis (e.g. sites x samples).
+	Returns (time base path, time axis), or (None, 0) if none matches.
+	'''
+	if arr.ndim==0:
+		return None, 0
+	for level in range(len(parents), -1, -1):
+		node = data
+		for key in parents[:level]:
+			node = node[key]
+		if 't_ms' in node:
+			num_t = len(node['t_ms'])
+			for axis in (arr.ndim-1, 0):
+				if arr.shape[axis]==num_t:
+					return parents[:level]+['t_ms'], axis
+	return None, 0
+
+def split_chunks(arr:np.ndarray, axis:int)->list:
+	'''
+	Split arr along axis into chunks of about ACQ_CHUNK_BYTES.
+	Returns a list of (start, stop) sample ranges.
+	'''
+	num_samples = arr.shape[axis] if arr.ndim>0 else 1
+	if num_samples==0:
+		return [ (0, 0) ]
+	bytes_per_sample = max(1, arr.nbytes // num_samples)
+	step = max(1, ACQ_CHUNK_BYTES // bytes_per_sample)
+	return [ (start, min(start+step, num_samples)) for start in range(0, num_samples, step) ]
+
+def flatten_acq_data(data:dict, parents:list=None)->list:
+	'''
+	Returns a list of (path, value) leaves of a nested acquisition dict.
+	Empty dicts are returned as leaves so that the structure is preserved.
+	'''
+	if parents is None: parents = []
+	leaves = []
+	for key in data:
+		value = data[key]
+		if isinstance(value, dict) and len(value)>0:
+			leaves += flatten_acq_data(value, parents+[key])
+		else:
+			leaves.append( (parents+[key], value) )
+	return leaves
+
+def stream_name(path:list)->str:
+	return '/'.join([ str(key) for key in path ])
+
+def save_acq_container(data:dict, file:str, codec='zlib', stream_codecs:dict=None, workers:int=None):
+	'''
+	stream_codecs optionally maps stream names (e.g. 'functional/calcium_0/jGCaMP8')
+	to codecs that override codec, e.g. 'fast' for large calcium stacks.
+	'''
+	if stream_codecs is None: stream_codecs = {}
+	check_codec(codec)
+	for stream_codec in stream_codecs.values():
+		check_codec(stream_codec)
+	index = { 'version': 1, 'streams': {} }
+	with open(file, 'wb') as f:
+		f.write(ACQ_MAGIC)
+		for path, value in flatten_acq_data(data):
+			arr = as_numeric_array(value)
+			if arr is None:
+				pkl_data = pickle.dumps(value)
+				index['streams'][stream_name(path)] = {
+					'path': path,
+					'kind': 'object',
+					'codec': 'zlib',
+					'offset': f.tell(),
+					'length': f.write(compress(pkl_data, 'zlib')),
+				}
+				continue
+			name = stream_name(path)
+			name_codec = stream_codecs.get(name, codec)
+			time_base, time_axis = find_time_base(data, path[:-1], arr)
+			if path[-1]=='t_ms': time_base, time_axis = None, 0
+			if name_codec=='none':
+				# Contiguous storage so that the stream can be memory-mapped.
+				ranges = [ (0, arr.shape[time_axis] if arr.ndim>0 else 1) ]
+			else:
+				ranges = split_chunks(arr, time_axis)
+			raw_chunks = []
+			for start, stop in ranges:
+				chunk = arr if arr.ndim==0 else np.take(arr, range(start, stop), axis=time_axis)
+				raw_chunks.append(np.ascontiguousarray(chunk).tobytes())
+			chunks = []
+			for (start, stop), cchunk in zip(ranges, parallel_compress(raw_chunks, name_codec, workers)):
+				offset = f.tell()
+				length = f.write(cchunk)
+				chunks.append( { 'offset': offset, 'length': length, 'start': start, 'stop': stop } )
+			index['streams'][name] = {
+				'path': path,
+				'kind': 'array',
+				'dtype': arr.dtype.str,
+				'shape': list(arr.shape),
+				'time_axis': time_axis,
+				'time_base': stream_name(time_base) if time_base is not None else None,
+				'codec': name_codec,
+				'chunks': chunks,
+			}
+		index_offset = f.tell()
+		f.write(json.dumps(index).encode('utf-8'))
+		f.write(ACQ_FOOTER.pack(index_offset, ACQ_MAGIC))
+
+def is_acq_container(file:str)->bool:
+	with open(file, 'rb') as f:
+		return f.read(len(ACQ_MAGIC))==ACQ_MAGIC
+
+class Acq_Container:
+	'''
+	Lazy reader for .acq container files. Only the index is read when
+	opening, streams are decompressed on demand, and only the chunks that
+	overlap a requested sample or time range are read.
+	'''
+	def __init__(self, file:str, workers:int=None):
+		self.file = file
+		self.workers = workers
+		with open(file, 'rb') as f:
+			f.seek(-ACQ_FOOTER.size, 2)
+			footer_pos = f.tell()
+			index_offset, magic = ACQ_FOOTER.unpack(f.read(ACQ_FOOTER.size))
+			if magic!=ACQ_MAGIC:
+				raise Exception('Acq_Container: %s is not an acquisition container.' % file)
+			f.seek(index_offset)
+			self.index = json.loads(f.read(footer_pos-index_offset).decode('utf-8'))
+		self.streams = self.index['streams']
+
+	def list_streams(self)->list:
+		return list(self.streams.keys())
+
+	def read_chunk(self, f, chunk:dict, codec:str)->bytes:
+		f.seek(chunk['offset'])
+		return decompress(f.read(chunk['length']), codec)
+
+	def read(self, stream:str, sample_range:tuple=None, mmap=False):
+		'''
+		Read a stream, or only the samples [start, stop) along its time axis.
+		With mmap=True, a stream saved with codec 'none' is returned as a
+		read-only np.memmap instead of being read into memory.
+		'''
+		entry = self.streams[stream]
+		if entry['kind']=='object':
+			with open(self.file, 'rb') as f:
+				return pickle.loads(self.read_chunk(f, entry, entry['codec']))
+		dtype = np.dtype(entry['dtype'])
+		shape = entry['shape']
+		axis = entry['time_axis']
+		num_samples = shape[axis] if len(shape)>0 else 1
+		start, stop = (0, num_samples) if sample_range is None else sample_range
+		start, stop = max(0, start), min(num_samples, stop)
+		if mmap:
+			if entry['codec']!='none':
+				raise Exception('Acq_Container: Stream %s is compressed and cannot be memory-mapped.' % stream)
+			arr = np.memmap(self.file, dtype=dtype, mode='r', offset=entry['chunks'][0]['offset'], shape=tuple(shape))
+			if len(shape)==0 or sample_range is None: return arr
+			return np.take(arr, range(start, stop), axis=axis)
+		selected = [ chunk for chunk in entry['chunks'] if chunk['stop']>start and chunk['start']<stop ]
+		cchunks = []
+		with open(self.file, 'rb') as f:
+			for chunk in selected:
+				f.seek(chunk['offset'])
+				cchunks.append(f.read(chunk['length']))
+		parts = []
+		for chunk, raw in zip(selected, parallel_decompress(cchunks, entry['codec'], self.workers)):
+			chunk_shape = list(shape)
+			if len(shape)>0: chunk_shape[axis] = chunk['stop']-chunk['start']
+			data = np.frombuffer(raw, dtype=dtype).reshape(chunk_shape)
+			if len(shape)==0: return data.copy()
+			lo = max(start, chunk['start'])-chunk['start']
+			hi = min(stop, chunk['stop'])-chunk['start']
+			parts.append(np.take(data, range(lo, hi), axis=axis))
+		if len(parts)==0:
+			empty_shape = list(shape)
+			empty_shape[axis] = 0
+			return np.zeros(empty_shape, dtype=dtype)
+		return np.concatenate(parts, axis=axis)
+
+	def read_time_range(self, stream:str, t_start_ms:float, t_end_ms:float)->tuple:
+		'''
+		Read the samples of a stream with time stamps in [t_start_ms, t_end_ms).
+		Returns (t_ms, samples).
+		'''
+		time_base = self.streams[stream]['time_base']
+		if time_base is None:
+			if stream.split('/')[-1]=='t_ms':
+				time_base = stream
+			else:
+				raise Exception('Acq_Container: Stream %s has no time base.' % stream)
+		t_ms = self.read(time_base)
+		start = int(np.searchsorted(t_ms, t_start_ms, side='left'))
+		stop = int(np.searchsorted(t_ms, t_end_ms, side='left'))
+		return t_ms[start:stop], self.read(stream, sample_range=(start, stop))
+
+	def to_dict(self)->dict:
+		'''
+		Read everything and rebuild the original acquisition dict.
+		Numeric lists are returned as numpy arrays.
+		'''
+		data = {}
+		for stream, entry in self.streams.items():
+			node = data
+			for key in entry['path'][:-1]:
+				node = node.setdefault(key, {})
+			node[entry['path'][-1]] = self.read(stream)
+		return data
+
+def save_acq_data(data:dict, file:str, codec='zlib', workers:int=None):
+	'''
+	The file extension selects the format:
+	.acq: chunked container, see save_acq_container().
+	.blz: block-compressed pickle with a block index, see common/BlockCompression.py.
+	.gz:  gzip-compressed pickle, compressed block-parallel into gzip members.
+	other: plain pickle.
+	'''
+	if file[-4:]=='.acq':
+		save_acq_container(data, file, codec=codec, workers=workers)
+		return
+	if file[-4:]=='.blz':
+		dump_pickled(data, file, codec=codec, workers=workers)
+		return
 	if file[-3:]=='.gz':
 		pkl_data = pickle.dumps(data)
-		gzpkl_data = gzip.compress(pkl_data)
+		gzpkl_data = b''.join(parallel_compress(split_blocks(pkl_data), 'gzip', workers))
 		with open(file, 'wb') as f:
 			f.write(gzpkl_data)
 		return
@@ -43,7 +304,19 @@ def save_acq_data(data:dict, file:str):
 	with open(file, 'wb') as f:
 		pickle.dump(data, f)
 
-def load_acq_data(file:str)->dict:
+def load_acq_data(file:str, lazy=False, workers:int=None):
+	'''
+	Loads .acq containers and .blz block-compressed pickles as well as
+	existing .pkl and .pkl.gz files.
+	With lazy=True and a container, returns an Acq_Container for per-stream
+	and per-time-range reads instead of reading everything.
+	'''
+	if is_acq_container(file):
+		container = Acq_Container(file, workers=workers)
+		if lazy: return container
+		return container.to_dict()
+	if is_block_compressed(file):
+		return load_pickled(file, workers=workers)
 	if file[-3:]=='.gz':
 		with open(file, 'rb') as f:
 			gzpkl_data = f.read()
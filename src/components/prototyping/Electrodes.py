@@ -6,7 +6,63 @@ Definitions of simulated electrodes.
 '''
 
 import numpy as np
+from scipy.spatial import cKDTree
+from scipy.sparse import csr_matrix
 #from .System import System
+from .Sample_Store import Chunked_Sample_Store, open_sample_store
+
+class Probe_Geometry:
+	'''
+	Site layout on a planar probe shank, such as a Neuropixels-class probe.
+	Sites are arranged in rows along the shank and columns across its
+	width, with every other row shifted across by stagger_um (as in the
+	checkerboard layout of Neuropixels 1.0).
+	Site offsets are in um in the shank coordinate system:
+	(across the shank width, normal to the shank face, along the shank
+	from the tip toward the end).
+	'''
+	def __init__(self,
+		num_rows=480,
+		num_columns=2,
+		row_pitch_um=20.0,
+		column_pitch_um=32.0,
+		stagger_um=16.0,
+		tip_offset_um=20.0,
+		width_direction=(1.0, 0.0, 0.0)):
+
+		self.num_rows = num_rows
+		self.num_columns = num_columns
+		self.row_pitch_um = row_pitch_um
+		self.column_pitch_um = column_pitch_um
+		self.stagger_um = stagger_um
+		self.tip_offset_um = tip_offset_um
+		self.width_direction = width_direction
+
+	def num_sites(self)->int:
+		return self.num_rows*self.num_columns
+
+	def site_offsets_um(self)->np.ndarray:
+		'''
+		Returns a (num_sites, 3) array of site offsets in shank coordinates,
+		ordered by row from the tip, then by column.
+		'''
+		rows, cols = np.meshgrid(np.arange(self.num_rows), np.arange(self.num_columns), indexing='ij')
+		rows, cols = rows.ravel(), cols.ravel()
+		across_um = cols*self.column_pitch_um + (rows % 2)*self.stagger_um
+		across_um = across_um - 0.5*((self.num_columns-1)*self.column_pitch_um + self.stagger_um)
+		along_um = self.tip_offset_um + rows*self.row_pitch_um
+		return np.stack([across_um, np.zeros(len(rows)), along_um], axis=1)
+
+	def to_dict(self)->dict:
+		return {
+			'num_rows': self.num_rows,
+			'num_columns': self.num_columns,
+			'row_pitch_um': self.row_pitch_um,
+			'column_pitch_um': self.column_pitch_um,
+			'stagger_um': self.stagger_um,
+			'tip_offset_um': self.tip_offset_um,
+			'width_direction': list(self.width_direction),
+		}
 
 class Recording_Electrode:
 	def __init__(self, specs:dict, system_ref):
@@ -21,22 +77,32 @@ class Recording_Electrode:
 			'sites': [ (0, 0, 0), ], # A single site at the tip.
 			'noise_level': 0,
 			'sensitivity_dampening': 2.0,
+			'influence_radius_um': None, # None means all neurons affect all sites.
+			'probe': None, # A Probe_Geometry replaces 'sites' with its layout.
+			'sample_store': None, # Folder for chunked on-disk samples instead of lists.
+			'sample_dtype': 'int16',
+			'sample_lsb_mV': 0.001,
+			'sample_chunk': 4096,
 		}
 		self.specs.update(specs)
 
 		self.id = specs['id']
 		self.tip_position = np.array(specs['tip_position'])
 		self.end_position = np.array(specs['end_position'])
-		self.sites = specs['sites']
+		self.probe = self.specs['probe']
+		self.sites = specs['sites'] if self.probe is None else self.probe.site_offsets_um().tolist()
 		self.noise_level = specs['noise_level']
 		self.system_ref = system_ref
 
 		self.site_locations_xyz_um = [] # In system coordinate system.
-		self.neuron_refs = []
-		self.neuron_soma_to_site_distances_squared_um = [] # [ (d_s1n1, d_s1n2, ...), (d_s2n1, d_s2n2, ...), ...]
+		self.influence_radius_um = self.specs['influence_radius_um']
+		self.neuron_refs = [] # Only neurons within influence radius of at least one site.
+		self.site_neuron_candidates = [] # [ (n_a, n_b, ...), ...] Indices into neuron_refs for each site.
+		self.neuron_soma_to_site_distances_squared_um = [] # [ (d_s1na, d_s1nb, ...), (d_s2nc, ...), ...]
 
-		self.t_recorded_ms = []	# [ t0, t1, ... ]
+		self.t_recorded_ms = []	# [ t0, t1, ... ], not used with a sample store
 		self.E_mV = [] 			# [ [E1(t0), E1(t1), ...], [E2(t0), E2(t1), ...], ...]
+		self.sample_store = None
 
 		self.init_system_coord_site_locations()
 		self.init_neuron_references_and_distances()
@@ -58,32 +124,133 @@ class Recording_Electrode:
 		sysloc_um = self.tip_position + vec_to_add
 		return sysloc_um
 
+	def shank_frame(self)->np.ndarray:
+		'''
+		Returns the 3x3 matrix with rows (across, normal, along) that maps
+		shank coordinates to system coordinate directions. The along axis
+		points from tip to end, the across axis is the probe's width
+		direction made orthogonal to the shank.
+		'''
+		along = self.end_position - self.tip_position
+		along = along / np.linalg.norm(along)
+		across = np.array(self.probe.width_direction, dtype=float)
+		across = across - np.dot(across, along)*along
+		across = across / np.linalg.norm(across)
+		normal = np.cross(along, across)
+		return np.stack([across, normal, along])
+
 	def init_system_coord_site_locations(self):
+		if self.probe is not None:
+			# Batched conversion of all probe sites at once.
+			sites_xyz_um = self.tip_position + np.asarray(self.sites) @ self.shank_frame()
+			self.site_locations_xyz_um = list(sites_xyz_um)
+			return
 		for site in self.sites:
 			self.site_locations_xyz_um.append(self.electrode_coords_to_system_coords(site))
 
+	def find_site_neuron_candidates(self, soma_xyz_um:np.ndarray, sites_xyz_um:np.ndarray)->list:
+		'''
+		Returns a list with an array of neuron indices for each site,
+		holding the neurons with soma centers within the influence radius.
+		A KD-tree over soma centers keeps this independent of the total
+		number of neurons in the system.
+		'''
+		num_neurons = len(soma_xyz_um)
+		if self.influence_radius_um is None:
+			return [ np.arange(num_neurons) for site in sites_xyz_um ]
+		if num_neurons == 0:
+			return [ np.zeros(0, dtype=int) for site in sites_xyz_um ]
+		tree = cKDTree(soma_xyz_um)
+		candidates = tree.query_ball_point(sites_xyz_um, r=self.influence_radius_um)
+		return [ np.sort(np.array(c, dtype=int)) for c in candidates ]
+
 	def init_neuron_references_and_distances(self):
-		# TODO: We could improve efficiency by filtering so that only neurons
-		#       close enough are included.
-		self.neuron_refs = self.system_ref.get_all_neurons()
-		for i in range(len(self.site_locations_xyz_um)):
-			site_distances_um = []
-			for n in self.neuron_refs:
-				soma_xyz_um = np.array(n.get_cell_center())
-				dist = np.linalg.norm(soma_xyz_um-self.site_locations_xyz_um[i])
-				site_distances_um.append(dist*dist)
-			self.neuron_soma_to_site_distances_squared_um.append(site_distances_um)
+		all_neurons = self.system_ref.get_all_neurons()
+		soma_xyz_um = np.array([ n.get_cell_center() for n in all_neurons ], dtype=float).reshape(-1, 3)
+		sites_xyz_um = np.array(self.site_locations_xyz_um, dtype=float).reshape(-1, 3)
+		candidates = self.find_site_neuron_candidates(soma_xyz_um, sites_xyz_um)
+
+		# Keep references only to neurons that affect at least one site.
+		used = np.unique(np.concatenate(candidates)) if len(candidates) > 0 else np.zeros(0, dtype=int)
+		self.neuron_refs = [ all_neurons[n_i] for n_i in used ]
+		for i in range(len(sites_xyz_um)):
+			diff_um = soma_xyz_um[candidates[i]] - sites_xyz_um[i]
+			self.neuron_soma_to_site_distances_squared_um.append(np.einsum('nk,nk->n', diff_um, diff_um))
+			self.site_neuron_candidates.append(np.searchsorted(used, candidates[i]))
+		self.init_gain_matrix()
+
+	def init_gain_matrix(self):
+		'''
+		Precompute the sparse sites x neurons gain matrix so that the field
+		potential at all sites is a single mat-vec with the population Vm
+		vector. Neurons within 1 um (squared distance <= 1.0) contribute their
+		full Vm, all others are attenuated by the squared distance. Everything
+		is scaled by the sensitivity dampening.
+		'''
+		num_sites = len(self.site_neuron_candidates)
+		rows, cols, gains = [], [], []
+		for i in range(num_sites):
+			d2_um = self.neuron_soma_to_site_distances_squared_um[i]
+			rows.append(np.full(len(d2_um), i))
+			cols.append(self.site_neuron_candidates[i])
+			gains.append(np.where(d2_um <= 1.0, 1.0, 1.0/np.maximum(d2_um, 1.0)))
+		if num_sites == 0:
+			rows, cols, gains = [np.zeros(0, dtype=int)], [np.zeros(0, dtype=int)], [np.zeros(0)]
+		self.gain = csr_matrix(
+			(np.concatenate(gains)/self.specs['sensitivity_dampening'], (np.concatenate(rows), np.concatenate(cols))),
+			shape=(num_sites, len(self.neuron_refs)))
 
 	def init_records(self):
-		for i in range(len(self.sites)):
-			self.E_mV.append([])
+		if self.specs['sample_store'] is not None:
+			metadata = {
+				'tip_position': self.tip_position.tolist(),
+				'end_position': self.end_position.tolist(),
+				'probe': self.probe.to_dict() if self.probe is not None else None,
+				'site_locations_xyz_um': np.asarray(self.site_locations_xyz_um).tolist(),
+				'noise_level': self.noise_level,
+				'sensitivity_dampening': self.specs['sensitivity_dampening'],
+				'influence_radius_um': self.influence_radius_um,
+			}
+			self.sample_store = Chunked_Sample_Store(
+				folder=self.specs['sample_store'],
+				probe_id=self.id,
+				num_sites=len(self.sites),
+				dtype=self.specs['sample_dtype'],
+				lsb_mV=self.specs['sample_lsb_mV'],
+				chunk_samples=self.specs['sample_chunk'],
+				metadata=metadata)
+		else:
+			for i in range(len(self.sites)):
+				self.E_mV.append([])
+		self.noise_block_size = 1024
+		self.noise_cache = np.zeros((0, len(self.sites)))
+		self.noise_idx = 0
+
+	def refill_noise_cache(self):
+		'''
+		Draw noise for a block of recording steps at once, uniform in
+		[-0.5, 0.5) * noise_level, as in add_noise().
+		'''
+		r = np.random.rand(self.noise_block_size, len(self.sites)) - 0.5
+		self.noise_cache = r*self.noise_level
+		self.noise_idx = 0
 
 	def add_noise(self)->float:
-		r_pos = np.random.rand() # TODO: More efficient to cache a bunch.
+		r_pos = np.random.rand()
 		r = r_pos - 0.5
 		noise_mV = r*self.noise_level
 		return noise_mV
 
+	def add_noise_all_sites(self)->np.ndarray:
+		if self.noise_idx >= len(self.noise_cache):
+			self.refill_noise_cache()
+		noise_mV = self.noise_cache[self.noise_idx]
+		self.noise_idx += 1
+		return noise_mV
+
+	def get_population_Vm(self)->np.ndarray:
+		return np.fromiter((n.Vm_mV for n in self.neuron_refs), dtype=float, count=len(self.neuron_refs))
+
 	def electric_field_potential(self, site_idx:int)->float:
 		# TODO: We can do a lot to improve the realism of this calculation
 		#       of the effect of overlapping electric fields.
@@ -91,25 +258,49 @@ class Recording_Electrode:
 		Calculate the electric field potential at the electrode site as
 		a combination of the effects of nearby neurons.
 		'''
-		Ei_mV = 0
-		site_distances_um = self.neuron_soma_to_site_distances_squared_um[site_idx]
-		for n_i in range(len(self.neuron_refs)):
-			Vm = self.neuron_refs[n_i].Vm_mV
-			if site_distances_um[n_i] <= 1.0:
-				Ein_mV = Vm
-			else:
-				Ein_mV = Vm / site_distances_um[n_i]
-			Ei_mV += (Ein_mV/self.specs['sensitivity_dampening'])
+		Ei_mV = float(self.gain[site_idx].dot(self.get_population_Vm())[0])
 		Ei_mV += self.add_noise()
 		return Ei_mV
 
+	def electric_field_potentials(self)->np.ndarray:
+		'''
+		Calculate the electric field potential at all electrode sites in
+		one mat-vec of the gain matrix with the population Vm vector.
+		'''
+		E_mV = self.gain.dot(self.get_population_Vm())
+		if self.noise_level != 0:
+			E_mV += self.add_noise_all_sites()
+		return E_mV
+
 	def record(self, t_ms:float):
+		E_mV = self.electric_field_potentials()
+		if self.sample_store is not None:
+			# The sample times are kept in the store, see get_t_recorded_ms().
+			self.sample_store.append(t_ms, E_mV)
+			return
 		self.t_recorded_ms.append(t_ms)
-		for i in range(len(self.site_locations_xyz_um)):
-			Ei_mV = self.electric_field_potential(i)
-			self.E_mV[i].append(Ei_mV)
+		for i in range(len(self.E_mV)):
+			self.E_mV[i].append(float(E_mV[i]))
+
+	def get_t_recorded_ms(self):
+		'''
+		Sample times recorded so far. With a sample store they are read
+		from the store as a read-only memory-mapped array.
+		'''
+		if self.sample_store is not None:
+			self.sample_store.flush()
+			return open_sample_store(self.sample_store.folder)[1]
+		return self.t_recorded_ms
 
 	def get_recording(self)->dict:
+		'''
+		With a sample store, the samples stay on disk and the store folder
+		is returned instead, see Sample_Store.read_sample_store().
+		'''
 		data = {}
+		if self.sample_store is not None:
+			self.sample_store.close()
+			data['sample_store'] = self.sample_store.folder
+			return data
 		data['E'] = self.E_mV
 		return data
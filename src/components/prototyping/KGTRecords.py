@@ -11,6 +11,8 @@ from matplotlib.colors import ListedColormap
 import matplotlib.gridspec as gridspec
 from PIL import Image
 
+from .Sample_Store import read_sample_store
+
 def plot_recorded(savefolder: str, data:dict, figspecs:dict={'figsize':(6,6),'linewidth':0.5}):
     if 't_ms' not in data:
         raise Exception('plot_recorded: Missing t_ms record.')
@@ -43,13 +45,17 @@ def plot_recorded(savefolder: str, data:dict, figspecs:dict={'figsize':(6,6),'li
 def plot_electrodes(savefolder: str, data:dict, figspecs:dict={'figsize':(6,6),'linewidth':0.5,'figext':'pdf'}):
     if 't_ms' not in data:
         raise Exception('plot_electrodes: Missing t_ms record.')
-    t_ms = data['t_ms']
     matchlen = len('electrode')
     for k in data.keys():
         if k[0:matchlen] == 'electrode':
 
             electrode_data = data[k]
-            E_mV = electrode_data['E']
+            if 'sample_store' in electrode_data:
+                stored = read_sample_store(electrode_data['sample_store'])
+                t_ms, E_mV = stored['t_ms'], stored['E']
+            else:
+                t_ms = data['t_ms']
+                E_mV = electrode_data['E']
 
             fig = plt.figure(figsize=figspecs['figsize'])
             gs = fig.add_gridspec(len(E_mV),1, hspace=0)
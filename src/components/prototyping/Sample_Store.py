@@ -0,0 +1,145 @@
+# Sample_Store.py
+
+'''
+Chunked on-disk storage of multi-site electrode samples.
+
+A store is a folder containing:
+- header.json: per-probe metadata (probe ID, geometry, site locations,
+  sample dtype, int16 scaling, chunk size, number of samples written).
+- samples.bin: raw samples x sites matrix in int16 or float32, written
+  one chunk at a time (interleaved by site, as in Neuropixels .bin files).
+- t_ms.bin: float64 time stamps of the samples.
+
+Samples are buffered in a preallocated chunk in memory and appended to
+disk whenever the chunk is full, so long recordings with hundreds of
+sites never accumulate in Python lists. Reading uses np.memmap, so any
+subset of sites and time window can be sliced without loading the rest.
+'''
+
+import json
+import os
+import numpy as np
+
+HEADER_FILE = 'header.json'
+SAMPLES_FILE = 'samples.bin'
+TIME_FILE = 't_ms.bin'
+
+class Chunked_Sample_Store:
+	def __init__(self,
+		folder:str,
+		probe_id:str,
+		num_sites:int,
+		dtype='int16',
+		lsb_mV=0.001,
+		chunk_samples=4096,
+		metadata:dict=None):
+		'''
+		With dtype int16, samples are stored as round(E_mV/lsb_mV), clipped
+		to the int16 range. With dtype float32, samples are stored in mV.
+		'''
+		if dtype not in ('int16', 'float32'):
+			raise Exception('Chunked_Sample_Store: Unsupported sample dtype %s.' % str(dtype))
+		self.folder = folder
+		self.probe_id = probe_id
+		self.num_sites = num_sites
+		self.dtype = np.dtype(dtype)
+		self.lsb_mV = lsb_mV
+		self.chunk_samples = chunk_samples
+		self.metadata = metadata if metadata is not None else {}
+
+		self.buffer = np.zeros((chunk_samples, num_sites), dtype=self.dtype)
+		self.t_buffer = np.zeros(chunk_samples, dtype=np.float64)
+		self.buffered = 0
+		self.num_samples = 0
+		self.num_chunks = 0
+
+		os.makedirs(folder, exist_ok=True)
+		open(os.path.join(folder, SAMPLES_FILE), 'wb').close()
+		open(os.path.join(folder, TIME_FILE), 'wb').close()
+		self.write_header()
+
+	def to_stored(self, E_mV:np.ndarray)->np.ndarray:
+		if self.dtype == np.int16:
+			return np.clip(np.rint(E_mV/self.lsb_mV), -32768, 32767)
+		return E_mV
+
+	def append(self, t_ms:float, E_mV:np.ndarray):
+		self.buffer[self.buffered] = self.to_stored(E_mV)
+		self.t_buffer[self.buffered] = t_ms
+		self.buffered += 1
+		if self.buffered == self.chunk_samples:
+			self.flush()
+
+	def flush(self):
+		if self.buffered == 0: return
+		with open(os.path.join(self.folder, SAMPLES_FILE), 'ab') as f:
+			f.write(self.buffer[:self.buffered].tobytes())
+		with open(os.path.join(self.folder, TIME_FILE), 'ab') as f:
+			f.write(self.t_buffer[:self.buffered].tobytes())
+		self.num_samples += self.buffered
+		self.num_chunks += 1
+		self.buffered = 0
+		self.write_header()
+
+	def header(self)->dict:
+		return {
+			'probe_id': self.probe_id,
+			'num_sites': self.num_sites,
+			'num_samples': self.num_samples,
+			'dtype': self.dtype.name,
+			'lsb_mV': self.lsb_mV if self.dtype == np.int16 else None,
+			'chunk_samples': self.chunk_samples,
+			'num_chunks': self.num_chunks,
+			'layout': 'samples_x_sites',
+			'metadata': self.metadata,
+		}
+
+	def write_header(self):
+		with open(os.path.join(self.folder, HEADER_FILE), 'w') as f:
+			json.dump(self.header(), f, indent=2)
+
+	def close(self):
+		self.flush()
+		self.write_header()
+
+def load_sample_store_header(folder:str)->dict:
+	with open(os.path.join(folder, HEADER_FILE), 'r') as f:
+		return json.load(f)
+
+def open_sample_store(folder:str)->tuple:
+	'''
+	Returns (header, t_ms, samples), where t_ms and samples are read-only
+	memory maps. samples has shape (num_samples, num_sites) in the stored
+	dtype, use samples_to_mV() to convert a slice.
+	'''
+	header = load_sample_store_header(folder)
+	num_samples = header['num_samples']
+	if num_samples == 0:
+		return header, np.zeros(0), np.zeros((0, header['num_sites']), dtype=header['dtype'])
+	t_ms = np.memmap(os.path.join(folder, TIME_FILE), dtype=np.float64, mode='r', shape=(num_samples,))
+	samples = np.memmap(os.path.join(folder, SAMPLES_FILE), dtype=header['dtype'], mode='r', shape=(num_samples, header['num_sites']))
+	return header, t_ms, samples
+
+def samples_to_mV(header:dict, samples:np.ndarray)->np.ndarray:
+	if header['dtype'] == 'int16':
+		return samples.astype(np.float32)*header['lsb_mV']
+	return np.asarray(samples, dtype=np.float32)
+
+def read_sample_store(folder:str, sites=None, t_range_ms:tuple=None)->dict:
+	'''
+	Read a subset of sites and a time window [t_start, t_end) from a store.
+	Returns { 't_ms': [...], 'E': sites x samples array in mV }, matching
+	the layout of Recording_Electrode.get_recording().
+	'''
+	header, t_ms, samples = open_sample_store(folder)
+	i_start, i_end = 0, len(t_ms)
+	if t_range_ms is not None:
+		i_start = int(np.searchsorted(t_ms, t_range_ms[0], side='left'))
+		i_end = int(np.searchsorted(t_ms, t_range_ms[1], side='left'))
+	selected = samples[i_start:i_end]
+	if sites is not None:
+		selected = selected[:, sites]
+	return {
+		't_ms': np.array(t_ms[i_start:i_end]),
+		'E': samples_to_mV(header, selected).T,
+	}
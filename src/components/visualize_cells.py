@@ -15,6 +15,8 @@ from mpl_toolkits.mplot3d import Axes3D  # needed for 3D projection
 #from matplotlib.animation import FuncAnimation, PillowWriter
 from mpl_toolkits.mplot3d.art3d import Poly3DCollection
 
+from common.BlockCompression import load_pickled
+
 Parser = argparse.ArgumentParser(description="Visualize cells from acquisition")
 Parser.add_argument("-f", type=str, help="Data file path")
 Parser.add_argument("-c", type=str, help="Connections file path")
@@ -273,8 +275,7 @@ if Args.Ring:
 
 
 if Args.c:
-    with open(Args.c, 'rb') as f:
-        connectionmatrix = pickle.load(f)
+    connectionmatrix = load_pickled(Args.c)
     print('Loaded connections.')
 else:
     connectionmatrix = None
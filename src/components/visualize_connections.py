@@ -9,10 +9,11 @@
 import numpy as np
 import argparse
 import os
-import pickle
 import matplotlib.pyplot as plt
 #from matplotlib.animation import FuncAnimation, PillowWriter
 
+from common.BlockCompression import load_pickled
+
 Parser = argparse.ArgumentParser(description="Visualize connections from acquisition")
 Parser.add_argument("-f", type=str, help="Data file path")
 Parser.add_argument("-x", default=12, type=float, help="Figure width (inches)")
@@ -27,8 +28,7 @@ if not os.path.exists(Args.f):
     print('File not found at '+str(Args.f))
     exit(1)
 
-with open(Args.f, 'rb') as f:
-    data = pickle.load(f)
+data = load_pickled(Args.f)
 
 print('Loaded data.')
 
@@ -9,12 +9,14 @@
 import numpy as np
 import argparse
 import os
-import pickle
 import matplotlib.pyplot as plt
 from matplotlib.animation import FuncAnimation, PillowWriter
 
+from common.BlockCompression import load_pickled
+from NES_interfaces.TraceStore import TraceStore, is_trace_store
+
 Parser = argparse.ArgumentParser(description="Visualize recorded data from acquisition")
-Parser.add_argument("-f", type=str, help="Data file path")
+Parser.add_argument("-f", type=str, help="Data file path (pickle, CSV or groundtruth-Vm trace store folder)")
 Parser.add_argument("-t1", type=str, help="Start time")
 Parser.add_argument("-t2", type=str, help="End time")
 Parser.add_argument("-x", default=18, type=float, help="Figure width (inches)")
@@ -51,9 +53,16 @@ if Args.csv:
         spikes_cells.append( list(subset['spike_time_ms']) )
     print('Loaded spikes.')
 
+elif is_trace_store(Args.f):
+    # Memory-mapped, only the plotted neurons and time window are read.
+    store = TraceStore(Args.f)
+    t_ms = store.t_ms
+    Vm_cells = store.Vm
+    spikes_cells = store.spikes()
+    print('Opened trace store.')
+
 else:
-    with open(Args.f, 'rb') as f:
-        data_dict = pickle.load(f)
+    data_dict = load_pickled(Args.f)
     print('Loaded data.')
     t_ms = data_dict['t_ms']
     Vm_cells = data_dict['Vm_cells']
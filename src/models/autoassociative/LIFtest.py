@@ -20,8 +20,10 @@ import json
 import os
 
 import vbpcommon as vbp
+from NES_interfaces.ResponseCache import invalidate_saved_model
 #from BrainGenix.BG_API import BG_API_Setup
 #from NES_interfaces.KGTRecords import plot_recorded
+from NES_interfaces.StimulusProtocol import StimulusProtocol
 import BrainGenix.NES as NES
 import BrainGenix
 
@@ -39,6 +41,8 @@ Parser.add_argument("-Autoassociative", action="store_true", help="Autoassociati
 Parser.add_argument("-Patterns", default=1, type=int, help="Number of patterns")
 Parser.add_argument("-Dt", default=1.0, type=float, help="Simulation step size in ms")
 Parser.add_argument("-T", type=float, help="Simulation time in ms")
+Parser.add_argument("-PooledHTTP", action="store_true", help="Reuse persistent HTTP connections and report request latencies")
+Parser.add_argument("-StandIn", action="store_true", help="Connect to a local NES stand-in server at Host:Port")
 Args = Parser.parse_args()
 
 # Initialize data collection for entry in DB file
@@ -51,7 +55,7 @@ DBdata = vbp.InitExpDB(
     _initOUT = {
     })
 
-ClientCfg, ClientInstance = vbp.ClientFromArgs(DBdata, Args)
+ClientCfg, ClientInstance = vbp.ClientFromArgs(DBdata, Args, pooled=Args.PooledHTTP, standin=Args.StandIn)
 
 SimulationCfg, MySim = vbp.NewSimulation(DBdata, ClientInstance, 'LIFCtest', Seed=Args.Seed)
 print('Simulation created')
@@ -542,6 +546,7 @@ else:
 
 
         MySim.ModelSave('LIFtest')
+        invalidate_saved_model('LIFtest')
         print('Model saved')
 
     else:
@@ -676,6 +681,7 @@ else:
         print('Made LIFC Receptors')
 
         MySim.ModelSave('LIFtest')
+        invalidate_saved_model('LIFtest')
         print('Model saved')
 
 
@@ -709,22 +715,11 @@ if Args.Autoassociative:
     repeatinterval = 2*batchinterval
     repeats = int(T // repeatinterval)
 
-    timeneuronpairs_list = []
-    for n in range(numneurons):
-        for r in range(repeats):
-            for s in range(len(training_stim)):
-                p = s % numpatterns
-                if n in pattern_neurons[p]:
-                    timeneuronpairs_list.append( (training_stim[s]+repeatinterval*r, n) )
-
-    for n in range(numneurons):
-        for r in range(repeats):
-            for s in range(len(training_stim)):
-                p = s % numpatterns
-                if n in cue_neurons[p]:
-                    timeneuronpairs_list.append( (training_stim[s]+repeatinterval*r+batchinterval, n)  )
-
-    MySim.SetSpecificAPTimes(timeneuronpairs_list)
+    # Only neurons with IDs below numneurons are stimulated.
+    protocol = StimulusProtocol(runtime_ms=T)
+    protocol.add_cycle([ [ n for n in patt_n if n < numneurons ] for patt_n in pattern_neurons ], training_stim, repeats, repeatinterval)
+    protocol.add_cycle([ [ n for n in cue_n if n < numneurons ] for cue_n in cue_neurons ], training_stim, repeats, repeatinterval, offset_ms=batchinterval)
+    protocol.upload(MySim)
     print('Simulation stimulation specified')
 
 else:
@@ -787,4 +782,6 @@ if not vbp.PlotAndStoreConnections(connections_after_dict, 'output', 'after', {
 if not vbp.PlotAndStoreConnections(connections_after_dict, 'output', 'after_conductance', { 'figsize': (6,6), 'linewidth': 0.5, 'figext': 'pdf', }, usematrix='conductance'):
     vbp.ErrorToDB(DBdata, 'File error: Failed to store plots of connectivity conductance')
 
+vbp.PrintRequestStats()
+
 print('Done')
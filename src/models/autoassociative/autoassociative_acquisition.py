@@ -52,6 +52,7 @@ Parser.add_argument("-SubdivideSize", default=5, type=int, help="Amount to subdi
 Parser.add_argument("-UseHTTPS", default=False, type=bool, help="Enable or disable HTTPS")
 Parser.add_argument("-DownloadEM", action="store_true", help="Enable downloading of EM Images")
 Parser.add_argument("-ExpsDB", default="./ExpsDB.json", type=str, help="Path to experiments database JSON file")
+Parser.add_argument("-savefolder", default=None, type=str, help="Front-end output folder (def: timestamped folder in output/)")
 Args = Parser.parse_args()
 
 if Args.simID:
@@ -169,7 +170,10 @@ else:
 
 
 # Prepare front-end output folder
-savefolder = 'output/'+datetime.now().strftime('%Y%m%d%H%M%S.%f')+'-acquisition'
+if Args.savefolder:
+    savefolder = Args.savefolder
+else:
+    savefolder = 'output/'+datetime.now().strftime('%Y%m%d%H%M%S.%f')+'-acquisition'
 vbp.AddOutputToDB(DBdata, 'output_folder', savefolder)
 
 TotalEMRenders:int = 0
@@ -440,7 +444,7 @@ if not tempexcludeactivitytest and not Args.simID:
     try:
         recording_dict = MySim.GetRecording()
 
-        if not vbp.PlotAndStoreRecordedActivity(recording_dict, savefolder, figspecs):
+        if not vbp.PlotAndStoreRecordedActivity(recording_dict, savefolder, figspecs, async_plots=True):
             vbp.ErrorToDB(DBdata, 'File error: Failed to store plots of recorded activity')
     except:
         vbp.ErrorToDB(DBdata, 'NES error: Failed to retrieve recorded activity')
@@ -747,6 +751,10 @@ if (Args.RenderEM):
 
 # ----------------------------------------------------
 
+# Wait for figures rendered in the background
+if not vbp.WaitForPlots():
+    vbp.ErrorToDB(DBdata, 'File error: Failed to store plots of recorded activity')
+
 # Update experiments database file with results
 vbp.UpdateExpsDB(DBdata)
 
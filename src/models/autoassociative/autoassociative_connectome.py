@@ -33,6 +33,10 @@ from sys import path
 from pathlib import Path
 path.insert(0, str(Path(__file__).parent.parent.parent)+'/components')
 from NES_interfaces.KGTRecords import plot_weights
+from NES_interfaces.Connectome import prepost_pyramidal_AMPA
+from NES_interfaces.ResponseCache import cached_simulation, invalidate_saved_model
+from NES_interfaces.StimulusProtocol import StimulusProtocol
+from NES_interfaces.SegmentedRecording import run_and_record_segmented
 
 
 # Handle Arguments for Host, Port, etc
@@ -50,6 +54,10 @@ Parser.add_argument("-Patterns", default=2, type=int, help="Number of patterns t
 Parser.add_argument("-Dt", default=1.0, type=float, help="Simulation step size in ms")
 Parser.add_argument("-STDP", action="store_true", help="Enable STDP")
 Parser.add_argument("-T", type=float, help="Simulation time in ms")
+Parser.add_argument("-ResponseCache", default=None, type=str, help="Folder of connectome response cache of saved models (def: None, no cache)")
+Parser.add_argument("-ResponseCacheMB", default=2048, type=int, help="Maximum size of response cache in MB (def: 2048)")
+Parser.add_argument("-SegmentMs", default=0.0, type=float, help="Run and retrieve recordings in segments of this many ms (def: 0, one run)")
+Parser.add_argument("-NoSegmentOverlap", action="store_true", help="Retrieve the recording of a segment before running the next one")
 Args = Parser.parse_args()
 
 if Args.DoBlend:
@@ -111,6 +119,9 @@ try:
 except:
     vbp.ErrorExit(DBdata, 'NES error: Failed to create simulation')
 
+# Soma positions and connectome of the loaded model can come from the response cache.
+MySim = cached_simulation(MySim, Args.ResponseCache, Args.ResponseCacheMB << 20)
+
 MySim.SetLIFCAbstractedFunctional(_AbstractedFunctional=True) # needs to be called before building LIFC receptors
 MySim.SetLIFCPreciseSpikeTimes(_UsePreciseSpikeTimes=(Args.Dt > 0.2))
 MySim.SetSTDP(_DoSTDP=Args.STDP)
@@ -156,28 +167,7 @@ try:
 except:
     vbp.ErrorExit(DBdata, 'NES error: failed to receive model connectome')
 
-def get_prepost_pyramidal_AMPA(connections_dict:dict)->tuple:
-    numneurons = len(connections_dict["ConnectionGPeakSum"])
-    # Find pyramidal neurons
-    types = connections_dict['ConnectionTypes']
-    pyramidal = []
-    for pre in range(numneurons):
-        for i in range(len(types[pre])):
-            if types[pre][i] == 1: # AMPA
-                pyramidal.append(pre)
-                break
-    # Get pyramidal prepost combined AMPA peak conductances
-    targets = connections_dict['ConnectionTargets']
-    gpeaksummatrix = np.zeros((numneurons, numneurons))
-    gpeaksum = connections_dict['ConnectionGPeakSum']
-    for pre in pyramidal:
-        for i in range(len(gpeaksum[pre])):
-            if types[pre][i] == 1: # AMPA
-                post = targets[pre][i]
-                gpeaksummatrix[pre][post] += gpeaksum[pre][i]
-    return pyramidal, gpeaksummatrix
-
-pyramidal, gpeaksummatrix = get_prepost_pyramidal_AMPA(connections_before_dict)
+pyramidal, gpeaksummatrix = prepost_pyramidal_AMPA(connections_before_dict)
 proportiontargetgpeaksum = gpeaksummatrix / PREPOSTGPEAKSUMTARGET
 attargetgpeaksum = (gpeaksummatrix >= PREPOSTGPEAKSUMTARGET) # array of True/False
 plot_weights(proportiontargetgpeaksum, 'output', 'autoassociative_reservoir_proptarget', FIGSPECS)
@@ -216,22 +206,11 @@ batchinterval = batchduration + 100
 repeatinterval = 2*batchinterval
 repeats = int(T // repeatinterval)
 
-timeneuronpairs_list = []
-for n in range(len(pyramidal)):
-    for r in range(repeats):
-        for s in range(len(training_stim)):
-            p = s % Args.Patterns
-            if n in patternstims[p]:
-                timeneuronpairs_list.append( (training_stim[s]+repeatinterval*r, n) )
-
-for n in range(len(pyramidal)):
-    for r in range(repeats):
-        for s in range(len(training_stim)):
-            p = s % Args.Patterns
-            if n in cuestims[p]:
-                timeneuronpairs_list.append( (training_stim[s]+repeatinterval*r+batchinterval, n)  )
-
-MySim.SetSpecificAPTimes(timeneuronpairs_list)
+# Only neurons with IDs below len(pyramidal) are stimulated.
+protocol = StimulusProtocol(runtime_ms=T)
+protocol.add_cycle([ [ n for n in p_stim if n < len(pyramidal) ] for p_stim in patternstims ], training_stim, repeats, repeatinterval)
+protocol.add_cycle([ [ n for n in c_stim if n < len(pyramidal) ] for c_stim in cuestims ], training_stim, repeats, repeatinterval, offset_ms=batchinterval)
+protocol.upload(MySim)
 print('Simulation stimulation specified')
 
 connectome_before_dict = MySim.GetConnectome()
@@ -242,21 +221,32 @@ if not vbp.PlotAndStoreConnections(connectome_before_dict, 'output', 'autoassoc_
 
 # Run simulation and record membrane potential
 MySim.RecordAll(-1)
-MySim.RunAndWait(Runtime_ms=T, Dt_ms=Args.Dt, timeout_s=100.0)
-print('Functional stimulation completed')
-
-recording_dict = MySim.GetRecording()
-print('Recorded data retrieved')
-spikes_dict = MySim.GetSpikeTimes()
-print('Spike times retrieved')
-
-#with open('output/raw.json', 'w') as f:
-#    json.dump(recording_dict, f)
-#with open('output/spikes.json', 'w') as f:
-#    json.dump(spikes_dict, f)
-
-if not vbp.PlotAndStoreRecordedActivity(recording_dict, 'output', FIGSPECS, spikes_dict):
-    vbp.ErrorToDB(DBdata, 'File error: Failed to store plots of recorded activity')
+if Args.SegmentMs > 0:
+    # Each segment's recording is streamed into the trace store while the next segment runs.
+    try:
+        store = run_and_record_segmented(MySim, T, Args.SegmentMs, 'output/groundtruth-Vm', Dt_ms=Args.Dt, timeout_s=100.0, overlap=not Args.NoSegmentOverlap)
+    except Exception as e:
+        vbp.ErrorExit(DBdata, 'NES error: Segmented run and recording failed: '+str(e))
+    print('Functional stimulation completed, recorded data and spike times retrieved')
+
+    if not vbp.PlotStoredActivity(store, 'output', FIGSPECS):
+        vbp.ErrorToDB(DBdata, 'File error: Failed to store plots of recorded activity')
+else:
+    MySim.RunAndWait(Runtime_ms=T, Dt_ms=Args.Dt, timeout_s=100.0)
+    print('Functional stimulation completed')
+
+    recording_dict = MySim.GetRecording()
+    print('Recorded data retrieved')
+    spikes_dict = MySim.GetSpikeTimes()
+    print('Spike times retrieved')
+
+    #with open('output/raw.json', 'w') as f:
+    #    json.dump(recording_dict, f)
+    #with open('output/spikes.json', 'w') as f:
+    #    json.dump(spikes_dict, f)
+
+    if not vbp.PlotAndStoreRecordedActivity(recording_dict, 'output', FIGSPECS, spikes_dict):
+        vbp.ErrorToDB(DBdata, 'File error: Failed to store plots of recorded activity')
 print('Data plot saved as PDF')
 
 connectome_after_dict = MySim.GetConnectome()
@@ -270,6 +260,7 @@ if not vbp.PlotAndStoreConnections(connectome_after_dict, 'output', 'autoassoc_c
 tunedmodelname = Args.modelname+"-tuned"
 try:
     MySim.ModelSave(tunedmodelname)
+    invalidate_saved_model(tunedmodelname)
     vbp.AddOutputToDB(DBdata,'modelname', tunedmodelname)
     print("Saved modified model on server as: "+tunedmodelname)
 except:
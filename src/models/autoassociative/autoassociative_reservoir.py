@@ -19,7 +19,6 @@
 
 scriptversion='0.1.0'
 
-import numpy as np
 #from datetime import datetime
 from time import sleep
 #import json
@@ -29,11 +28,13 @@ import argparse
 
 import vbpcommon as vbp
 from BrainGenix.BG_API import NES
+from NES_interfaces.ResponseCache import invalidate_saved_model
 
 from sys import path
 from pathlib import Path
 path.insert(0, str(Path(__file__).parent.parent.parent)+'/components')
 from NES_interfaces.KGTRecords import plot_weights
+from NES_interfaces.Connectome import prepost_pyramidal_AMPA
 
 # Handle Arguments for Host, Port, etc
 Parser = argparse.ArgumentParser(description="BrainGenix-API Simple Python Test Script")
@@ -172,6 +173,7 @@ print(" -- Netmorph output files directory is "+str(RunResponse["NetmorphOutputD
 # Save model at the NES server
 try:
     MySim.ModelSave(Args.modelname)
+    invalidate_saved_model(Args.modelname)
     print(" -- Neuronal Circuit Model saved as "+Args.modelname)
 except:
     vbp.ErrorExit(DBdata, 'NES error: Model save failed')
@@ -215,28 +217,7 @@ try:
 except:
     vbp.ErrorExit(DBdata, 'NES error: failed to receive model connectome')
 
-def get_prepost_pyramidal_AMPA(connections_dict:dict)->tuple:
-    numneurons = len(connections_dict["ConnectionGPeakSum"])
-    # Find pyramidal neurons
-    types = connections_dict['ConnectionTypes']
-    pyramidal = []
-    for pre in range(numneurons):
-        for i in range(len(types[pre])):
-            if types[pre][i] == 1: # AMPA
-                pyramidal.append(pre)
-                break
-    # Get pyramidal prepost combined AMPA peak conductances
-    targets = connections_dict['ConnectionTargets']
-    gpeaksummatrix = np.zeros((numneurons, numneurons))
-    gpeaksum = connections_dict['ConnectionGPeakSum']
-    for pre in pyramidal:
-        for i in range(len(gpeaksum[pre])):
-            if types[pre][i] == 1: # AMPA
-                post = targets[pre][i]
-                gpeaksummatrix[pre][post] += gpeaksum[pre][i]
-    return pyramidal, gpeaksummatrix
-
-pyramidal, gpeaksummatrix = get_prepost_pyramidal_AMPA(connections_before_dict)
+pyramidal, gpeaksummatrix = prepost_pyramidal_AMPA(connections_before_dict)
 proportiontargetgpeaksum = gpeaksummatrix / PREPOSTGPEAKSUMTARGET
 attargetgpeaksum = (gpeaksummatrix >= PREPOSTGPEAKSUMTARGET)
 plot_weights(proportiontargetgpeaksum, 'output', 'autoassociative_reservoir_proptarget', FIGSPECS)
@@ -29,6 +29,7 @@ import argparse
 
 import vbpcommon as vbp
 from BrainGenix.BG_API import NES
+from NES_interfaces.ResponseCache import invalidate_saved_model
 
 from sys import path
 from pathlib import Path
@@ -173,6 +174,7 @@ print(" -- Netmorph output files directory is "+str(RunResponse["NetmorphOutputD
 # # Save model at the NES server
 try:
     MySim.ModelSave(Args.modelname)
+    invalidate_saved_model(Args.modelname)
     print(" -- Neuronal Circuit Model saved as "+Args.modelname)
 except Exception as e:
     vbp.ErrorExit(DBdata, 'NES error: Model save failed. Exception: '+str(e))
@@ -22,7 +22,6 @@ import argparse
 import os
 from pathlib import Path
 import pandas as pds
-import copy
 import psutil
 import tqdm
 import random
@@ -35,6 +34,9 @@ from sys import path
 from pathlib import Path
 path.insert(0, str(Path(__file__).parent.parent.parent)+'/components')
 from NES_interfaces.KGTRecords import plot_weights
+from NES_interfaces.Connectome import prepost_pyramidal_AMPA, AbstractConnectome
+from NES_interfaces.ResponseCache import cached_simulation, invalidate_saved_model
+from NES_interfaces.AdaptiveConcurrency import AIMDController
 
 # Handle Arguments for Host, Port, etc
 # Note that the "rerunfailed" option only operates as expected if used consistently on
@@ -59,11 +61,21 @@ def get_Args():
     Parser.add_argument("-fitcpus", action="store_true", help="Fit batches to the number of logical CPUs available")
     Parser.add_argument("-deleteresident", action="store_true", help="Delete completed server-resident simulations to run more samples")
     Parser.add_argument("-batchlimit", default=0, type=int, help="Never run more than this many at once (def: 0, means no limit)")
+    Parser.add_argument("-adaptive", action="store_true", help="Adapt the number of samples running at once to server RAM and request failures, up to the batch size (def: False)")
+    Parser.add_argument("-adaptivewave", default=4, type=int, help="Adaptive waves hold this many times the number running at once (def: 4)")
+    Parser.add_argument("-adaptivestart", default=4, type=int, help="Number of samples running at once when adaptive starts (def: 4)")
+    Parser.add_argument("-adaptiveperiod", default=30.0, type=float, help="Seconds between free RAM checks of adaptive (def: 30.0)")
+    Parser.add_argument("-halvingrungs", default=0, type=int, help="Successive halving with this many rungs of increasing growth days (def: 0, grow all samples for their full days)")
+    Parser.add_argument("-halvingdays", default=3, type=int, help="Growth days of the first successive halving rung (def: 3)")
+    Parser.add_argument("-halvingeta", default=3, type=int, help="Keep the best 1/eta samples of each rung and grow them eta times longer (def: 3)")
+    Parser.add_argument("-halvingscore", default="usable_conns2", type=str, choices=["usable_conns1", "usable_conns2"], help="Label used to rank samples for promotion (def: usable_conns2)")
     Parser.add_argument("-from_sample", default=0, type=int, help="Samples starting at line (def: 0)")
     Parser.add_argument("-to_sample", default=0, type=int, help="Samples up to line (def: 0, meaning all)")
     Parser.add_argument("-RCIncludeHeap", action="store_true", help="Include slow search of heap in resource check (def: False)")
     Parser.add_argument("-rerunfailed", action="store_true", help="Auto-rerun rather than mark failed samples (def: False)")
     Parser.add_argument("-randomseed", default=20240628, type=int, help="Specify a random seed (def: 20240628, 0: auto-pick)")
+    Parser.add_argument("-ResponseCache", default=None, type=str, help="Folder of connectome response cache of saved models (def: None, no cache)")
+    Parser.add_argument("-ResponseCacheMB", default=2048, type=int, help="Maximum size of response cache in MB (def: 2048)")
     return Parser.parse_args()
 
 # Load samples parameter values from Excel file, return data frame and column identifiers
@@ -86,112 +98,20 @@ def usable_connections_method1(MySim)->int:
         print('NES error: failed to receive abstract model connectome')
         batchrun.RTfailed('getabsconn_failed', 'Response: %s, Exception: %s' % (str(response), str(e)) )
         return -1
-    PrePostNumReceptors = response['PrePostNumReceptors']
-    Regions = response['Regions']
-    NeuronTypes = response['Types']
-    def RegionByNeuronID(NeuronID:int)->str:
-        for reg in list(Regions.keys()):
-            if NeuronID in Regions[reg]:
-                return reg
-        return 'unknown'
-
-    PreRegions = {}
-    for preidx, postidx, reccnt in PrePostNumReceptors:
-        prereg = RegionByNeuronID(preidx)
-        postreg = RegionByNeuronID(postidx)
-        if prereg not in PreRegions:
-            PreRegions[prereg] = {}
-        if postreg not in PreRegions[prereg]:
-            PreRegions[prereg][postreg] = 1
-        else:
-            PreRegions[prereg][postreg] += 1
-
-    Neuron2RegionMap = {}
-    for reg in Regions:
-        for n in Regions[reg]:
-            Neuron2RegionMap[n] = reg
-
-    def SetAll(TheList:list, Value:int):
-        for i in range(len(TheList)):
-            TheList[i][2] = Value
-
-    def SetOneByPost(TheList:list, PostID:int, Value:int):
-        for i in range(len(TheList)):
-            if TheList[i][1]==PostID:
-                TheList[i][2] = Value
-
-    def SetOneByPre(TheList:list, PreID:int, Value:int):
-        for i in range(len(TheList)):
-            if TheList[i][0]==PreID:
-                TheList[i][2] = Value
-
-    def PostIs(TheList:list, PostID:int)->int:
-        for i in range(len(TheList)):
-            if TheList[i][1]==PostID:
-                return TheList[i][2]
-        return 0
-
-    def PreIs(TheList:list, PreID:int)->int:
-        for i in range(len(TheList)):
-            if TheList[i][0]==PreID:
-                return TheList[i][2]
-        return 0
-    Neuron2Neuron = copy.deepcopy(PrePostNumReceptors)
-    SetAll(Neuron2Neuron, 1)
-    def ActiveInputsTo(NeuronID:int)->list:
-        res = []
-        for pre, post, active in Neuron2Neuron:
-            if active>0 and post==NeuronID:
-                res.append(pre)
-        return res
-
-    def ActiveOutputsFrom(NeuronID:int)->list:
-        res = []
-        for pre, post, active in Neuron2Neuron:
-            if active>0 and pre==NeuronID:
-                res.append(post)
-        return res
-
-    def ConnectionsFrom(SourceRegion:str, NeuronID:int)->list:
-        res = []
-        activeinputs = ActiveInputsTo(NeuronID)
-        for pre in activeinputs:
-            if Neuron2RegionMap[pre]==SourceRegion:
-                res.append(pre)
-        return res
-
-    def EliminateByPost(NeuronID:int):
-        SetOneByPost(Neuron2Neuron, NeuronID, 0)
-
-    def EliminateByPre(NeuronID:int):
-        SetOneByPre(Neuron2Neuron, NeuronID, 0)
+    Neuron2Neuron = AbstractConnectome(response)
 
+    # In neurons without active inputs from other In neurons are not on
+    # usable paths, eliminate all of their input connections at once.
     print('Neurons in In population with >0 connections from other In neurons:')
-    for n in Regions['In']:
-        frompyrmid = ConnectionsFrom('In', n)
-        if len(frompyrmid)<1:
-            EliminateByPost(n)
-
-    print("Number of connections: "+str(len(Neuron2Neuron)))
-
-    def NumActive()->int:
-        num = 0
-        for pre, post, active in Neuron2Neuron:
-            if active>0:
-                num += 1
-        return num
+    InNeurons = np.asarray(response['Regions']['In'], dtype=np.int64)
+    frompyramid = Neuron2Neuron.active_input_counts('In')[InNeurons]
+    Neuron2Neuron.eliminate_by_post(InNeurons[frompyramid < 1])
 
-    def PrintActive()->str:
-        active_str = ''
-        num = 0
-        for pre, post, active in Neuron2Neuron:
-            if active>0:
-                active_str += '[%s -> %s], ' % (pre, post)
-        return active_str
+    print("Number of connections: "+str(len(Neuron2Neuron.pre)))
 
-    print("There are %d usable connections on input-to-output paths (out of %d)." % (NumActive(), len(Neuron2Neuron)))
+    print("There are %d usable connections on input-to-output paths (out of %d)." % (Neuron2Neuron.num_active(), len(Neuron2Neuron.pre)))
 
-    return NumActive()
+    return Neuron2Neuron.num_active()
 
 # --- Based on the version at the end of autoassociative_reservoir.py
 def usable_connections_method2(MySim, PREPOSTGPEAKSUMTARGET:float)->int:
@@ -206,38 +126,20 @@ def usable_connections_method2(MySim, PREPOSTGPEAKSUMTARGET:float)->int:
         batchrun.RTfailed('getconn_failed', 'Response: %s, Exception: %s' % (str(connections_before_dict), str(e)) )
         return -1
 
-    def get_prepost_pyramidal_AMPA(connections_dict:dict)->tuple:
-        numneurons = len(connections_dict["ConnectionGPeakSum"])
-        # Find pyramidal neurons
-        types = connections_dict['ConnectionTypes']
-        pyramidal = []
-        for pre in range(numneurons):
-            for i in range(len(types[pre])):
-                if types[pre][i] == 1: # AMPA
-                    pyramidal.append(pre)
-                    break
-        # Get pyramidal prepost combined AMPA peak conductances
-        targets = connections_dict['ConnectionTargets']
-        gpeaksummatrix = np.zeros((numneurons, numneurons))
-        gpeaksum = connections_dict['ConnectionGPeakSum']
-        for pre in pyramidal:
-            for i in range(len(gpeaksum[pre])):
-                if types[pre][i] == 1: # AMPA
-                    post = targets[pre][i]
-                    gpeaksummatrix[pre][post] += gpeaksum[pre][i]
-        return pyramidal, gpeaksummatrix
-
-    pyramidal, gpeaksummatrix = get_prepost_pyramidal_AMPA(connections_before_dict)
-    proportiontargetgpeaksum = gpeaksummatrix / PREPOSTGPEAKSUMTARGET
-    attargetgpeaksum = (gpeaksummatrix >= PREPOSTGPEAKSUMTARGET)
-    print('Number of pre-post pyramidal connections at target g_sum_peak: %d' % int(attargetgpeaksum.sum()))
-
-    return int(attargetgpeaksum.sum())
+    # Only the aggregated pre-post pairs are needed, not a dense N x N matrix.
+    pyramidal, (pre, post, gpeaksum) = prepost_pyramidal_AMPA(connections_before_dict, dense=False)
+    numattarget = int((gpeaksum >= PREPOSTGPEAKSUMTARGET).sum())
+    print('Number of pre-post pyramidal connections at target g_sum_peak: %d' % numattarget)
+
+    return numattarget
 
 # Return 'failed', 'completed' or 'running', percent done, check succeeded
 def evaluate_state_and_check_connectome(netmorphrun:dict, evalcriteriadata:dict)->tuple:
     global batchrun
     MySim = netmorphrun['Sim']
+    scheduler = evalcriteriadata['scheduler']
+    if scheduler is not None:
+        scheduler.poll(batchrun.ClientInstance, batchrun.runs_running())
 
     Percent = 0
     try:
@@ -256,10 +158,13 @@ def evaluate_state_and_check_connectome(netmorphrun:dict, evalcriteriadata:dict)
         return 'failed', 100.0, True
     elif NetmorphStatus == "Done":
         check_succeeded = True
+        # With a response cache, connectomes of saved models are stored for later analysis.
+        MySim = cached_simulation(MySim, evalcriteriadata['responsecache'], evalcriteriadata['responsecachebytes'])
         if evalcriteriadata['savemodels']:
             response = 'not returned'
             try:
                 response = MySim.ModelSave(netmorphrun['modelname'], Pause_s=0.1)
+                invalidate_saved_model(netmorphrun['modelname'])
                 print("Saved resulting model for run %d as %s" % (netmorphrun['runID'], netmorphrun['modelname']))
                 batchrun.RTsuccess('modelsave')
             except Exception as e:
@@ -275,49 +180,60 @@ def evaluate_state_and_check_connectome(netmorphrun:dict, evalcriteriadata:dict)
             check_succeeded = False
         netmorphrun['usable_conns1'] = result1
         netmorphrun['usable_conns2'] = result2
+        if scheduler is not None:
+            scheduler.sample_completed()
         return 'completed', 100.0, check_succeeded
 
     return 'running', Percent, True
 
+def full_growdays(df, cols, row:int)->int:
+    if 'days' in cols:
+        return int(df.iloc[row]['days'])
+    print('Missing "days" column. Using default: 21')
+    return 21
+
 def extra_prep(batchinfo:dict, idx:int, extraprepdata:dict)->bool:
-    modelname = extraprepdata['modelname']+'%04d' % idx
-    batchinfo[idx]['modelname'] = modelname  # Remember which output model belongs to this run
+    # With successive halving the samples of a rung are a subset of the rows of the data frame.
+    row = idx if extraprepdata['rows'] is None else extraprepdata['rows'][idx]
 
     # Get parameters from data frame
     # This needs to be careful, because the data might be provided in a different order of
     # parameters and some parameters might be missing, needing default values.
     df = extraprepdata['dataframe']
     cols = extraprepdata['cols'] # This is an 'Index' object with a list of strings containing column names.
-    pars = []
-    if 'days' in cols:
-        pars.append(int(df.iloc[idx]['days']))
-    else:
-        print('Missing "days" column. Using default: 21')
-        pars.append(21)
+    pars = [ full_growdays(df, cols, row) ]
+    modelsuffix = extraprepdata['modelsuffix']
+    if extraprepdata['rungdays'] is not None:
+        if extraprepdata['rungdays'] >= pars[0]:
+            modelsuffix = '' # Grows for its full days in this rung, so this is its final model.
+        pars[0] = min(pars[0], extraprepdata['rungdays'])
+    modelname = extraprepdata['modelname']+'%04d' % row + modelsuffix
+    batchinfo[idx]['modelname'] = modelname  # Remember which output model belongs to this run
+    batchinfo[idx]['row'] = row
     if 'pyramidal' in cols:
-        pyramidal = int(df.iloc[idx]['pyramidal'])
+        pyramidal = int(df.iloc[row]['pyramidal'])
     else:
         pyramidal = extraprepdata['launchdata']['EMBEDMULTIPLE']*extraprepdata['launchdata']['PATTERNSIZE']*extraprepdata['launchdata']['Patterns']
         print('Missing "pyramidal" column. Using default: %d' % pyramidal)
     pars.append(pyramidal)
     if 'interneuron' in cols:
-        interneuron = int(df.iloc[idx]['interneuron'])
+        interneuron = int(df.iloc[row]['interneuron'])
     else:
         interneuron = extraprepdata['launchdata']['PATTERNSIZE']*extraprepdata['launchdata']['Patterns']
         print('Missing "interneuron" column. Using default: %d' % interneuron)
     pars.append(interneuron)
     if 'minneuronseparation' in cols:
-        pars.append(int(df.iloc[idx]['minneuronseparation']))
+        pars.append(int(df.iloc[row]['minneuronseparation']))
     else:
         print('Missing "minneuronseparation" column. Using default: 15')
         pars.append(15)
     if 'shape.radius' in cols:
-        pars.append(int(df.iloc[idx]['shape.radius']))
+        pars.append(int(df.iloc[row]['shape.radius']))
     else:
         # V_shape = pi*r^2*h, h is either given or assumed 30 ==> r^2 = V_shape / (pi*h)
         # V_soma = 4/3*pi*r^3, assuming average soma r = 10 um ==> 4188.7902
         if 'shape.thickness' in cols:
-            h = int(df.iloc[idx]['shape.thickness'])
+            h = int(df.iloc[row]['shape.thickness'])
         else:
             h = 30
         V_all_somas = 4200 * (pyramidal + interneuron)
@@ -327,12 +243,12 @@ def extra_prep(batchinfo:dict, idx:int, extraprepdata:dict)->bool:
         print('Missing "shape.radius" column. Using default: %d' % r)
         pars.append(int(r))
     if 'shape.thickness' in cols:
-        pars.append(int(df.iloc[idx]['shape.thickness']))
+        pars.append(int(df.iloc[row]['shape.thickness']))
     else:
         print('Missing "shape.thickness" column. Using default: 30')
         pars.append(30)
     if 'dm.weight' in cols:
-        pars.append(float(df.iloc[idx]['dm.weight']))
+        pars.append(float(df.iloc[row]['dm.weight']))
     else:
         print('Missing "dm.weight" column. Using default: 0.5')
         pars.append(float(0.5))
@@ -420,10 +336,205 @@ def sample_launch_requests(netmorphrun:dict, launchdata:dict)->bool:
     return True
 
 # Update the ExpsDB.json database for all samples in the batch
+# All entries are committed in a single transaction.
 def update_experiments_database(batchinfo:dict):
+    DBdata_list = []
     for netmorphrun in batchinfo.values():
         if 'DBdata' in netmorphrun and netmorphrun['status'] != 'prepped': # only ones that were just run and completed or failed
-            vbp.UpdateExpsDB(netmorphrun['DBdata'])
+            DBdata_list.append(netmorphrun['DBdata'])
+    if not vbp.UpdateExpsDBBatch(DBdata_list):
+        print('Warning: Not all batch results were recorded in the experiments database.')
+
+# Create a BatchRun for numsamples samples and run it until all are done or the
+# batch is interrupted. This uses the configuration set up in the program steps
+# below. Returns True if the batch completed and the number of remaining runs.
+def run_batch(Args, batchname:str, numsamples:int, batchsize, from_sample=0, to_sample=0)->tuple:
+    global batchrun
+    batchrun = BatchRun(
+        host=Args.Host,
+        port=Args.Port,
+        usehttps=Args.UseHTTPS,
+        numsamples=numsamples,
+        extraprepfunc=extra_prep,
+        extraprepdata=EXTRAPREPDATA,
+        from_sample=from_sample,
+        to_sample=to_sample,
+        rerunfailed=Args.rerunfailed)
+
+    # Let's add a bit of extra tracking while we're testing large batches
+    batchrun.resource_tests['getconn'] = 0
+    batchrun.resource_tests['getconn_failed'] = 0
+    batchrun.resource_tests['getabsconn'] = 0
+    batchrun.resource_tests['getabsconn_failed'] = 0
+    batchrun.resource_tests['modelsave'] = 0
+    batchrun.resource_tests['modelsave_failed'] = 0
+    batchrun.resource_tests['launch'] = 0
+    batchrun.resource_tests['launch_failed'] = 0
+    batchrun.resource_tests['netmorphstatus'] = 0
+    batchrun.resource_tests['netmorphstatus_failed'] = 0
+
+    scheduler = EVALCRITERIADATA['scheduler']
+    if scheduler is not None:
+        scheduler.attach(batchrun)
+
+    if Args.RCIncludeHeap:
+        try:
+            batchrun.ClientInstance.SetResourceChecksIncludeHeap(IncludeHeap=Args.RCIncludeHeap)
+        except Exception as e:
+            print('Unable to set IncludeHeap. Exception: '+str(e))
+            exit(1)
+
+    batchrun.start_batch(
+        batchname=batchname,
+        batchsize=batchsize,
+        samplerequestsfunc=sample_launch_requests,
+        samplerequestsdata=LAUNCHDATA,
+        resourceslowbytes=RESOURCESLOWBYTES)
+    print('Number of Netmorph sample runs running (out of %d): %d' % (numsamples, batchrun.runs_running()))
+
+    completed_batch = batchrun.monitor_batch(
+        batchname=batchname,
+        batchsize=batchsize,
+        evalfunc=evaluate_state_and_check_connectome,
+        evalcriteriadata=EVALCRITERIADATA,
+        samplerequestsfunc=sample_launch_requests,
+        samplerequestsdata=LAUNCHDATA,
+        batchdatakeys=BATCHDATAKEYS,
+        resourceslowbytes=RESOURCESLOWBYTES,
+        deleteresident=Args.deleteresident)
+
+    print('Number of samples: %d' % numsamples)
+    print('Runs completed   : %d' % batchrun.runs_completed())
+    print('Runs failed      : %d' % batchrun.runs_failed())
+    remaining = batchrun.runs_running()+batchrun.runs_prepped()
+    print('Runs remaining   : %d' % remaining)
+
+    update_experiments_database(batchrun.batchinfo)
+    return completed_batch, remaining
+
+# Run samples from_sample up to to_sample (0: all numsamples). With -adaptive, the
+# samples are run in waves of scheduler.wave_size() samples, each a BatchRun with
+# the current limit as its batch size, and the limit is adjusted between waves.
+# Without -adaptive this is a single run_batch().
+# Returns True if all samples completed and the number of remaining runs.
+def run_samples(Args, batchname:str, numsamples:int, batchsize:int, from_sample=0, to_sample=0)->tuple:
+    scheduler = EVALCRITERIADATA['scheduler']
+    if scheduler is None:
+        return run_batch(Args, batchname, numsamples, batchsize, from_sample, to_sample)
+
+    end = to_sample if to_sample > 0 else numsamples
+    start = from_sample
+    while start < end:
+        stop = min(end, start + scheduler.wave_size())
+        print('Adaptive wave: samples %d to %d, %d running at once' % (start, stop, scheduler.limit))
+        # to_sample 0 for the last wave, as when no range is given.
+        completed_batch, remaining = run_batch(Args, batchname, numsamples, scheduler.limit, start, 0 if stop == numsamples else stop)
+        scheduler.adjust()
+        if not completed_batch or remaining > 0:
+            return completed_batch, remaining + (end - stop)
+        start = stop
+    return True, 0
+
+# Parameters that determine which samples a successive halving rung grows and for
+# how many days. They are stored in the rung file, so that a completed rung is only
+# reused by a run with the same halving parameters and sample range.
+def halving_parameters(Args, rung:int, rungdays, torun:list)->dict:
+    return {
+        'rung': rung,
+        'halvingdays': Args.halvingdays,
+        'halvingeta': Args.halvingeta,
+        'halvingscore': Args.halvingscore,
+        'from_sample': Args.from_sample,
+        'to_sample': Args.to_sample,
+        'rungdays': rungdays,
+        'rows': torun,
+    }
+
+# Returns the completed batchinfo of a rung from its rung file. Exits if the rung
+# file was made with different parameters.
+def load_rung_file(rungfile:str, parameters:dict)->dict:
+    with open(rungfile, 'r') as f:
+        rungdata = json.load(f)
+    if not isinstance(rungdata, dict) or rungdata.get('parameters') != parameters:
+        print('Error: %s was made with different successive halving parameters or samples.' % rungfile)
+        print('Stored  : %s' % str(rungdata.get('parameters') if isinstance(rungdata, dict) else None))
+        print('Current : %s' % str(parameters))
+        print('Rerun with the stored parameters, or move or delete batchinfo_completed-rung*.json.')
+        exit(1)
+    return rungdata['batchinfo']
+
+# An interrupted rung resumes from batchinfo_completed.json. Exits if the runs in it
+# are not those that this rung would make (other samples or growth days).
+def check_interrupted_rung(df, cols, torun:list, rungdays):
+    if not os.path.exists(BATCHINFOCOMPLETED):
+        return
+    with open(BATCHINFOCOMPLETED, 'r') as f:
+        interrupted = json.load(f)
+    for idx, netmorphrun in interrupted.items():
+        idx = int(idx)
+        row = netmorphrun.get('row')
+        days = None if row is None else full_growdays(df, cols, row)
+        if days is not None and rungdays is not None:
+            days = min(days, rungdays)
+        if idx >= len(torun) or row != torun[idx] or netmorphrun.get('pars', [None])[0] != days:
+            print('Error: %s holds runs of a different successive halving rung or parameters.' % BATCHINFOCOMPLETED)
+            print('Rerun with the previous parameters, or move or delete %s.' % BATCHINFOCOMPLETED)
+            exit(1)
+
+# Successive halving: All samples are grown for Args.halvingdays days and labeled.
+# Only the best 1/Args.halvingeta of them (by Args.halvingscore) are grown again,
+# for Args.halvingeta times as many days, and so on. The last of Args.halvingrungs
+# rungs grows the remaining samples for their full number of days. Samples that
+# already reached their full days in a rung are not grown again.
+# Each completed rung is kept in batchinfo_completed-rung<r>.json with the parameters
+# it was run with, so that rerunning the script resumes at the first incomplete rung.
+# Returns True if all rungs completed, the number of remaining runs, and a dict
+# with the labels of each sample row at the most days it was grown.
+def run_successive_halving(Args, df, cols, batchsize)->tuple:
+    rows = list(range(Args.from_sample, Args.to_sample if Args.to_sample > 0 else df.shape[0]))
+    results = {}
+    for rung in range(Args.halvingrungs):
+        final = rung == Args.halvingrungs-1
+        rungdays = None if final else Args.halvingdays * Args.halvingeta**rung
+        torun = [ row for row in rows if row not in results or not results[row]['full_fidelity'] ]
+        rungfile = 'batchinfo_completed-rung%d.json' % rung
+        parameters = halving_parameters(Args, rung, rungdays, torun)
+        print('Successive halving rung %d: %d samples, %d to grow for %s days' % (rung, len(rows), len(torun), 'full' if final else str(rungdays)))
+
+        completed_batchinfo = {}
+        if os.path.exists(rungfile):
+            completed_batchinfo = load_rung_file(rungfile, parameters)
+            print('...rung %d was completed before, using %s' % (rung, rungfile))
+        elif len(torun) > 0:
+            check_interrupted_rung(df, cols, torun, rungdays)
+            EXTRAPREPDATA['rows'] = torun
+            EXTRAPREPDATA['rungdays'] = rungdays
+            EXTRAPREPDATA['modelsuffix'] = '' if final else '-rung%d' % rung
+            completed_batch, remaining = run_samples(Args, 'Netmorph-%s-rung%d' % (Args.modelname, rung), len(torun), batchsize)
+            if not completed_batch or remaining > 0:
+                return False, remaining, results
+            completed_batchinfo = batchrun.get_previously_completed()
+            with open(rungfile, 'w') as f:
+                json.dump({ 'parameters': parameters, 'batchinfo': completed_batchinfo }, f)
+            os.remove(BATCHINFOCOMPLETED)
+
+        for netmorphrun in completed_batchinfo.values():
+            completed = netmorphrun['status'] == 'completed'
+            row = netmorphrun['row']
+            results[row] = {
+                'usable_conns1': netmorphrun['usable_conns1'] if completed else -1,
+                'usable_conns2': netmorphrun['usable_conns2'] if completed else -1,
+                'grown_days': netmorphrun['pars'][0],
+                'halving_rung': rung,
+                'full_fidelity': rungdays is None or full_growdays(df, cols, row) <= rungdays,
+            }
+        if final:
+            break
+
+        numpromoted = max(1, int(np.ceil(len(rows)/Args.halvingeta)))
+        ranked = sorted(rows, key=lambda row: results[row][Args.halvingscore] if row in results else -1, reverse=True)
+        rows = sorted(ranked[:numpromoted])
+    return True, 0, results
 
 # Save resulting label data for all completed runs to excel file
 # Note that this retrieves only what was stored in batchinfo_completed.json
@@ -447,6 +558,28 @@ def write_excel_with_results(batchrun, df, Args):
     print('Note that RS%d in the file name specifies the random seed used.')
     return completed_batchinfo
 
+# Save the labels of successive halving to excel file. The usable_conns labels of
+# each sample are those at grown_days, full_fidelity is True for samples grown for
+# their full number of days. Samples not in results are marked with -1.
+def write_excel_with_halving_results(results:dict, df, Args)->dict:
+    df['usable_conns1'] = -1 # add columns
+    df['usable_conns2'] = -1
+    df['grown_days'] = 0
+    df['halving_rung'] = -1
+    df['full_fidelity'] = False
+    completed_batchinfo = {}
+    for row, result in results.items():
+        for key, value in result.items():
+            df.loc[row, key] = value
+        completed_batchinfo[row] = { 'runID': row, 'usable_conns1': result['usable_conns1'], 'usable_conns2': result['usable_conns2'] }
+
+    path = Path(Args.excel)
+    labeledpath = str(path.with_suffix(""))+'-labeled-SH-RS'+str(Args.randomseed)+'.xlsx'
+    df.to_excel(labeledpath, index=False)
+    print('Results written to: '+labeledpath)
+    print('Note that RS%d in the file name specifies the random seed used.' % Args.randomseed)
+    return completed_batchinfo
+
 # ===== Start of program steps
 if __name__ == '__main__':
 
@@ -512,8 +645,11 @@ if __name__ == '__main__':
         "pars",
         "usable_conns1",
         "usable_conns2",
+        "row",
     ]
 
+    BATCHINFOCOMPLETED = 'batchinfo_completed.json'
+
     RESOURCESLOWBYTES = 2*1024*1024*1024 # 2GB
 
     Args = get_Args()
@@ -530,6 +666,9 @@ if __name__ == '__main__':
         "dataframe": df,
         "cols": cols,
         "ExpsDB": Args.ExpsDB,
+        "rows": None, # Rows of the data frame when not all are run (successive halving)
+        "rungdays": None, # Maximum growth days in a successive halving rung
+        "modelsuffix": "",
     }
 
     # Find out total conductance that needs to be possible through the combination of
@@ -542,6 +681,9 @@ if __name__ == '__main__':
     EVALCRITERIADATA = {
         "PREPOSTGPEAKSUMTARGET": PREPOSTGPEAKSUMTARGET,
         "savemodels": Args.savemodels,
+        "responsecache": Args.ResponseCache,
+        "responsecachebytes": Args.ResponseCacheMB << 20,
+        "scheduler": None,
     }
 
     modelcontent = LoadNetmorphConfiguration(Args.modelfile)
@@ -568,64 +710,24 @@ if __name__ == '__main__':
     else:
         batchsize = numsamples
 
-    batchrun = BatchRun(
-        host=Args.Host,
-        port=Args.Port,
-        usehttps=Args.UseHTTPS,
-        numsamples=numsamples,
-        extraprepfunc=extra_prep,
-        extraprepdata=EXTRAPREPDATA,
-        from_sample=Args.from_sample,
-        to_sample=Args.to_sample,
-        rerunfailed=Args.rerunfailed)
-
-    # Let's add a bit of extra tracking while we're testing large batches
-    batchrun.resource_tests['getconn'] = 0
-    batchrun.resource_tests['getconn_failed'] = 0
-    batchrun.resource_tests['getabsconn'] = 0
-    batchrun.resource_tests['getabsconn_failed'] = 0
-    batchrun.resource_tests['modelsave'] = 0
-    batchrun.resource_tests['modelsave_failed'] = 0
-    batchrun.resource_tests['launch'] = 0
-    batchrun.resource_tests['launch_failed'] = 0
-    batchrun.resource_tests['netmorphstatus'] = 0
-    batchrun.resource_tests['netmorphstatus_failed'] = 0
-
-    if Args.RCIncludeHeap:
-        try:
-            batchrun.ClientInstance.SetResourceChecksIncludeHeap(IncludeHeap=Args.RCIncludeHeap)
-        except Exception as e:
-            print('Unable to set IncludeHeap. Exception: '+str(e))
-            exit(1)
-
-    batchrun.start_batch(
-        batchname='Netmorph-'+Args.modelname,
-        batchsize=batchsize,
-        samplerequestsfunc=sample_launch_requests,
-        samplerequestsdata=LAUNCHDATA,
-        resourceslowbytes=RESOURCESLOWBYTES)
-    print('Number of Netmorph sample runs running (out of %d): %d' % (numsamples, batchrun.runs_running()))
-
-    completed_batch = batchrun.monitor_batch(
-        batchname='Netmorph-'+Args.modelname,
-        batchsize=batchsize,
-        evalfunc=evaluate_state_and_check_connectome,
-        evalcriteriadata=EVALCRITERIADATA,
-        samplerequestsfunc=sample_launch_requests,
-        samplerequestsdata=LAUNCHDATA,
-        batchdatakeys=BATCHDATAKEYS,
-        resourceslowbytes=RESOURCESLOWBYTES,
-        deleteresident=Args.deleteresident)
-
-    print('Number of samples: %d' % numsamples)
-    print('Runs completed   : %d' % batchrun.runs_completed())
-    print('Runs failed      : %d' % batchrun.runs_failed())
-    remaining = batchrun.runs_running()+batchrun.runs_prepped()
-    print('Runs remaining   : %d' % remaining)
-
-    update_experiments_database(batchrun.batchinfo)
-
-    completed_batchinfo = write_excel_with_results(batchrun, df, Args)
+    # With -adaptive, samples run in waves and the number running at once
+    # (at most batchsize) grows or shrinks with server load between waves.
+    if Args.adaptive:
+        scheduler = AIMDController(
+            initial=min(Args.adaptivestart, batchsize),
+            max_limit=batchsize,
+            period_s=Args.adaptiveperiod,
+            lowbytes=RESOURCESLOWBYTES,
+            wave_multiple=Args.adaptivewave)
+        EVALCRITERIADATA['scheduler'] = scheduler
+        print('Adaptive batch size, starting at %d, at most %d.' % (scheduler.limit, scheduler.max_limit))
+
+    if Args.halvingrungs > 1:
+        completed_batch, remaining, results = run_successive_halving(Args, df, cols, batchsize)
+        completed_batchinfo = write_excel_with_halving_results(results, df, Args)
+    else:
+        completed_batch, remaining = run_samples(Args, 'Netmorph-'+Args.modelname, numsamples, batchsize, Args.from_sample, Args.to_sample)
+        completed_batchinfo = write_excel_with_results(batchrun, df, Args)
 
     docompare = input('Shall we compare the results from the two label interpretation methods? (y/N) ')
     if docompare == 'y':
@@ -635,8 +737,13 @@ if __name__ == '__main__':
             print('%03d %05d %05d' % (netmorphrun['runID'], netmorphrun['usable_conns1'], netmorphrun['usable_conns2']))
 
     print('Inspect resource_checks.json for request success/failure tracking data.')
+    if Args.adaptive:
+        EVALCRITERIADATA['scheduler'].save_history('adaptive_schedule.json')
+        print('Adaptive batch size adjustments are in adaptive_schedule.json.')
     if remaining > 0:
         print('To complete remaining simply rerun this script.')
+    elif Args.halvingrungs > 1:
+        print('To run batch again, move or delete batchinfo_completed-rung*.json.')
     else:
         print('To run batch again, move or delete batchinfo_completed.json.')
 
@@ -10,12 +10,16 @@ import vbpcommon as vbp
 from BrainGenix.BG_API import NES
 from BrainGenix.Tools.BatchRun import BatchRun, LoadNetmorphConfiguration, ConnectClient
 
+from NES_interfaces.ResponseCache import cached_simulation, get_response_cache
+
 # Handle Arguments for Host, Port, etc
 def get_Args():
     Parser = argparse.ArgumentParser(description="Batch inspection script")
     Parser.add_argument("-Host", default="localhost", type=str, help="Host to connect to")
     Parser.add_argument("-Port", default=8000, type=int, help="Port number to connect to")
     Parser.add_argument("-UseHTTPS", default=False, type=bool, help="Enable or disable HTTPS")
+    Parser.add_argument("-ResponseCache", default=None, type=str, help="Folder of connectome response cache of saved models (def: None, no cache)")
+    Parser.add_argument("-ResponseCacheMB", default=2048, type=int, help="Maximum size of response cache in MB (def: 2048)")
     return Parser.parse_args()
 
 # Status bar helper functions
@@ -71,6 +75,7 @@ if __name__ == '__main__':
         except:
             print('NES error: Failed to create simulation')
             exit(1)
+        MySim = cached_simulation(MySim, Args.ResponseCache, Args.ResponseCacheMB << 20)
 
         # Load previously generated model
         try:
@@ -104,6 +109,8 @@ if __name__ == '__main__':
     close_statusbar(statusbar, sorted_batchinfo)
 
     print('Number of neurons in each sample:\n'+str(num_neurons))
+    if Args.ResponseCache is not None:
+        print('Response cache: '+str(get_response_cache(Args.ResponseCache).stats()))
 
     print('Done.')
     exit(0)
@@ -32,7 +32,6 @@ scriptversion='0.1.0'
 
 import numpy as np
 #from datetime import datetime
-from time import sleep
 #import json
 import base64
 import argparse
@@ -45,6 +44,9 @@ from sys import path
 from pathlib import Path
 path.insert(0, str(Path(__file__).parent.parent.parent)+'/components')
 from NES_interfaces.KGTRecords import plot_weights
+from NES_interfaces.AsyncMonitor import run_monitor
+from NES_interfaces.StandInNES import StandInClient
+from NES_interfaces.ResponseCache import invalidate_saved_model
 
 # Handle Arguments for Host, Port, etc
 Parser = argparse.ArgumentParser(description="BrainGenix-API Simple Python Test Script")
@@ -63,6 +65,11 @@ Parser.add_argument("-Patterns", default=2, type=int, help="Number of patterns t
 Parser.add_argument("-Dt", default=1.0, type=float, help="Simulation step size in ms")
 Parser.add_argument("-STDP", action="store_true", help="Enable STDP")
 Parser.add_argument("-batchsize", default=10, type=int, help="Number of Netmorph sample runs at once")
+Parser.add_argument("-maxrequests", default=8, type=int, help="Maximum number of concurrent requests while monitoring runs")
+Parser.add_argument("-requesttimeout", default=60.0, type=float, help="Timeout in seconds of each request while monitoring runs")
+Parser.add_argument("-maxstatusfailures", default=10, type=int, help="Consecutive failed status requests after which a run is given up")
+Parser.add_argument("-rundeadline", default=0.0, type=float, help="Seconds after which a run that is not done is given up (0 for no deadline)")
+Parser.add_argument("-StandIn", action="store_true", help="Connect to a local NES stand-in server at Host:Port")
 Args = Parser.parse_args()
 
 # if Args.DoBlend:
@@ -128,7 +135,10 @@ ClientCfg.Password = "Instruction"
 # Create Client Instance
 print(" -- Creating Client Instance")
 try:
-    ClientInstance = NES.Client.Client(ClientCfg)
+    if Args.StandIn:
+        ClientInstance = StandInClient(Args.Host, Args.Port, Args.UseHTTPS)
+    else:
+        ClientInstance = NES.Client.Client(ClientCfg)
     if not ClientInstance.IsReady():
         print('NES.Client error: not ready')
         exit(1)
@@ -269,44 +279,41 @@ for netmorphrun in batchinfo.values():
 
 print('Number of Netmorph sample runs running (out of %d): %d' % (batchsize, runs_running(batchinfo)))
 
-# === Loop check for runs that have completed
-
-while runs_incomplete(batchinfo):
-
-    for netmorphrun in batchinfo.values():
-        if netmorphrun['status'] == 'running':
-
-            MySim = netmorphrun['Sim']
-
-            try:
-                Percent, NetmorphStatus = MySim.Netmorph_GetStatus()
-            except Exception as e:
-                print('...failed to retrieve status for sample run %d, continuing (possible momentary comms problem)' % netmorphrun['runID'])
-                sleep(1.0)
-                continue
-
-            if NetmorphStatus == "None" or NetmorphStatus == "Failed":
-                netmorphrun['status'] = 'failed'
-                print('...a run failed')
-            elif NetmorphStatus == "Done":
-                netmorphrun['status'] = 'completed'
-                try:
-                    MySim.ModelSave(netmorphrun['modelname'])
-                    print("Saved resulting model as "+netmorphrun['modelname'])
-                except:
-                    vbp.ErrorToDB(netmorphrun['DBdata'], 'NES error: Model save failed')
-                    print('Failed to save completed model')
-
-                print('...a run completed')
-
-    sleep(1.0)
+# === Check for runs that have completed
+
+# Status requests for all running samples are made concurrently, and
+# each completed run is saved as soon as its status arrives.
+async def on_netmorph_status(calls, netmorphrun:dict, status)->str:
+    Percent, NetmorphStatus = status
+    if NetmorphStatus == "None" or NetmorphStatus == "Failed":
+        print('...a run failed')
+        return 'failed'
+    if NetmorphStatus == "Done":
+        try:
+            await calls.call(netmorphrun['Sim'].ModelSave, netmorphrun['modelname'])
+            invalidate_saved_model(netmorphrun['modelname'])
+            print("Saved resulting model as "+netmorphrun['modelname'])
+        except Exception:
+            vbp.ErrorToDB(netmorphrun['DBdata'], 'NES error: Model save failed')
+            print('Failed to save completed model')
+        print('...a run completed')
+        return 'completed'
+    return 'running'
+
+run_monitor(
+    list(batchinfo.values()),
+    lambda netmorphrun: netmorphrun['Sim'].Netmorph_GetStatus,
+    on_netmorph_status,
+    max_concurrent=Args.maxrequests,
+    timeout_s=Args.requesttimeout,
+    max_failures=Args.maxstatusfailures,
+    deadline_s=Args.rundeadline if Args.rundeadline > 0 else None)
 
 print('Runs completed: %d' % runs_completed(batchinfo))
 print('Runs failed   : %d' % runs_failed(batchinfo))
 
 
 # === Update the ExpsDB.json database for all samples in the batch
-for netmorphrun in batchinfo.values():
-    vbp.UpdateExpsDB(netmorphrun['DBdata'])
+vbp.UpdateExpsDBBatch([ netmorphrun['DBdata'] for netmorphrun in batchinfo.values() ])
 
 print(" -- Done.")
@@ -0,0 +1,32 @@
+#!../../../venv/bin/python
+# run_pipeline.py
+
+# Runs the steps of Run.sh (reservoir generation, connectome tuning and
+# data acquisition) as a cached pipeline, see components/common/Pipeline.py.
+# Steps whose scripts, model file and arguments are unchanged since
+# their last successful run are skipped. Acquisitions at several
+# resolutions (-Resolutions 0.1 0.05) run in parallel.
+#
+# Example:
+#   ./run_pipeline.py -Host localhost -Port 8030 -Resolutions 0.1 0.05
+
+from sys import path, executable
+from pathlib import Path
+
+path.insert(0, str(Path(__file__).parent.parent.parent)+'/components')
+
+from common.Pipeline import vbp_model_pipeline, vbp_pipeline_args, print_status
+
+SCRIPTS = {
+    'reservoir': 'autoassociative_reservoir.py',
+    'connectome': 'autoassociative_connectome.py',
+    'acquisition': 'autoassociative_acquisition.py',
+}
+
+if __name__ == '__main__':
+    Args = vbp_pipeline_args('autoassociative pipeline runner', 'nesvbp-autoassociative', 'autoassociative')
+    pipeline = vbp_model_pipeline(Args, SCRIPTS, executable, Args.maxparallel)
+    status = pipeline.run(force=Args.force)
+    print('Pipeline stages:')
+    print_status(status)
+    exit(0 if all(state in ('cached', 'completed') for state in status.values()) else 1)
@@ -1,8 +1,5 @@
 # Enable common components used by multiple models:
 from datetime import datetime
-from time import sleep
-import json
-import os
 from sys import path
 from pathlib import Path
 
@@ -10,11 +7,20 @@ path.insert(0, str(Path(__file__).parent.parent.parent)+'/components')
 
 import BrainGenix.NES as NES
 
-from NES_interfaces.KGTRecords import extract_t_Vm, extract_spiketimes, save_t_Vm_pickled, plot_t_Vm, save_connections_pickled, plot_weights
+from NES_interfaces.KGTRecords import extract_t_Vm_array, extract_spiketimes_csr, csr_to_spikes_cells, save_t_Vm_store, plot_t_Vm, save_connections_pickled, plot_weights
+from NES_interfaces.PlotQueue import get_plot_queue, wait_for_plots
+from NES_interfaces.Connectome import Connectome
+from NES_interfaces.PooledSession import install_pooled_session, get_pooled_session
+from NES_interfaces.StandInNES import StandInClient
+from common import ExpsDB
 
-def PlotAndStoreConnections(connections_dict:dict, savefolder:str, nameappend:str, figspecs:dict, receptor='AMPA', usematrix='weights')->bool:
-    import numpy as np
+# Above this number of neurons, recorded activity is plotted as a heatmap.
+PLOT_HEATMAP_ABOVE=32
 
+# With async_plots=True, figures are rendered in a background process
+# and the call returns once the data is stored. Call WaitForPlots()
+# before exiting.
+def PlotAndStoreConnections(connections_dict:dict, savefolder:str, nameappend:str, figspecs:dict, receptor='AMPA', usematrix='weights', async_plots=False)->bool:
     if not isinstance(connections_dict, dict):
         print('Error: Connections is not a dict')
         return False
@@ -29,42 +35,27 @@ def PlotAndStoreConnections(connections_dict:dict, savefolder:str, nameappend:st
         return False
 
     try:
-        numneurons = len(connections_dict["ConnectionTargets"])
-        weightmatrix = np.zeros((numneurons, numneurons))
-
-        type_ids = {
-            'AMPA': 1,
-            'GABA': 2,
-            'NMDA': 3,
-        }
-        type_id = type_ids[receptor]
-
-        targets = connections_dict['ConnectionTargets']
-        types = connections_dict['ConnectionTypes']
-        if usematrix=='conductance':
-            weights = connections_dict['ConnectionGPeakSum']
-        elif usematrix=='weights':
-            weights = connections_dict['ConnectionWeights']
-        else:
-            weights = connections_dict['NumReceptors']
-
-        total = 0
-        for pre in range(numneurons):
-            for i in range(len(weights[pre])):
-                if types[pre][i] == type_id:
-                    post = targets[pre][i]
-                    weightmatrix[pre][post] += weights[pre][i]
-                    total += weights[pre][i]
+        connectome = Connectome.from_nes(connections_dict).receptor(receptor)
+        total = connectome.total(usematrix)
+        weightmatrix = connectome.dense(usematrix)
 
         print('Total %s: %d' % (usematrix, total))
         save_connections_pickled(weightmatrix, savefolder, nameappend)
-        plot_weights(weightmatrix, savefolder, nameappend, figspecs)
+        if async_plots:
+            get_plot_queue().submit('connections'+nameappend, plot_weights, weightmatrix, savefolder, nameappend, figspecs)
+        else:
+            plot_weights(weightmatrix, savefolder, nameappend, figspecs)
         return True
     except Exception as e:
         print('Error: Failed to plot and store connections: '+str(e))
         return False
 
-def PlotAndStoreRecordedActivity(recording_dict:dict, savefolder:str, figspecs:dict, spikes_dict:dict=None)->bool:
+# Converts the recorded activity (and spikes) to a dense Vm array and CSR
+# spike trains, then stores and plots them. With free_source=True the
+# neuron records are removed from recording_dict and spikes_dict as they
+# are converted, to avoid holding several copies of large recordings.
+# With async_plots=True, the figure is rendered in a background process.
+def PlotAndStoreRecordedActivity(recording_dict:dict, savefolder:str, figspecs:dict, spikes_dict:dict=None, free_source=True, async_plots=False)->bool:
     if not isinstance(recording_dict, dict):
         print('Error: Recorded activity is not a dict')
         return False
@@ -93,24 +84,52 @@ def PlotAndStoreRecordedActivity(recording_dict:dict, savefolder:str, figspecs:d
             return False
 
     try:
-        t_ms, Vm_cells = extract_t_Vm(data=recording_dict["Recording"])
-        if not t_ms:
+        t_ms, Vm_cells, neuron_ids = extract_t_Vm_array(data=recording_dict["Recording"], free_source=free_source)
+        if t_ms is None or len(t_ms)==0:
             print('extract_t_Vm Error: No data to plot.')
             return False
 
         spikes_cells=None
+        offsets, times = None, None
         if spikes_dict:
-            spikes_cells = extract_spiketimes(data=spikes_dict["SpikeTimes"])
-            if not spikes_cells:
+            if len(spikes_dict["SpikeTimes"])==0:
                 print('extract_spiketimes Error: No spikes.')
+            else:
+                _, offsets, times = extract_spiketimes_csr(data=spikes_dict["SpikeTimes"], neuron_ids=neuron_ids, free_source=free_source)
+                spikes_cells = csr_to_spikes_cells(offsets, times)
 
-        save_t_Vm_pickled(t_ms, Vm_cells, savefolder, spikes_cells)
-        plot_t_Vm(t_ms, Vm_cells, savefolder, figspecs, spikes_cells=spikes_cells)
+        save_t_Vm_store(t_ms, Vm_cells, savefolder, neuron_ids, offsets, times)
+        if async_plots:
+            get_plot_queue().submit('groundtruth-Vm', plot_t_Vm, t_ms, Vm_cells, savefolder, figspecs, spikes_cells=spikes_cells, decimate=True, heatmap_above=PLOT_HEATMAP_ABOVE)
+        else:
+            plot_t_Vm(t_ms, Vm_cells, savefolder, figspecs, spikes_cells=spikes_cells, decimate=True, heatmap_above=PLOT_HEATMAP_ABOVE)
     except Exception as e:
         print('Error: Failed to plot and store recorded activity: '+str(e))
         return False
     return True
 
+# Plots activity from a trace store (e.g. written by
+# SegmentedRecording.run_and_record_segmented) using the memory-mapped
+# Vm matrix, so the recording is not converted again.
+def PlotStoredActivity(store, savefolder:str, figspecs:dict)->bool:
+    try:
+        if len(store.t_ms)==0:
+            print('PlotStoredActivity Error: No data to plot.')
+            return False
+        spikes_cells=None
+        if store.spikes_offsets is not None:
+            spikes_cells = csr_to_spikes_cells(store.spikes_offsets, store.spikes_times)
+        plot_t_Vm(store.t_ms, store.Vm, savefolder, figspecs, spikes_cells=spikes_cells, decimate=True, heatmap_above=PLOT_HEATMAP_ABOVE)
+    except Exception as e:
+        print('Error: Failed to plot stored activity: '+str(e))
+        return False
+    return True
+
+# Waits for all plots queued with async_plots=True to be written.
+# Returns False if any of them failed.
+def WaitForPlots()->bool:
+    return wait_for_plots()
+
 def InitExpDB(_ExpsDB:str, _DBkey:str, _scriptversion:str, _initIN:dict, _initOUT:dict)->dict:
     _initIN['scriptversion'] = _DBkey+'-'+_scriptversion,
     _initIN['datetime'] = datetime.now().strftime('%Y%m%d%H%M%S'),
@@ -129,76 +148,43 @@ def AddInputToDB(DBdata:dict, inkey:str, indata):
 def AddOutputToDB(DBdata:dict, outkey:str, outdata):
     DBdata['entry']['OUT'][outkey] = outdata
 
-def UnlockDB(DBdata:dict)->bool:
-    lockfile = DBdata['dbfile']+'.locked'
-    if os.path.exists(lockfile):
-        os.remove(lockfile)
-        return True
-    return False
-
-def WaitToLockDB(DBdata:dict)->bool:
-    lockfile = DBdata['dbfile']+'.locked'
-    counts = 20
-    while os.path.exists(lockfile):
-        sleep(0.1)
-        counts -= 1
-        if counts == 0:
-            return False
-    try:
-        with open(lockfile, 'w') as f:
-            f.write('Locked by %s at %s' % (DBdata['key'], DBdata['entry']['IN']['datetime']))
-    except:
-        return False
-    return True
-
-# Waits until no one else is using the experiments database file
-# by checking if a lock file is present. Then, locks access by
-# making a lock file. Then reads the current database and returns
-# the data.
-# If no database file was found returns empty data.
-# If a file error occurs returns None.
-# The lock file is removed if a file error occurred.
-# Otherwise, the lock file is removed if keeplock is False.
-def LoadExpsDB(DBdata:dict, keeplock=False)->dict:
-    WaitToLockDB(DBdata)
-    if not os.path.exists(DBdata['dbfile']):
-        if not keeplock:
-            UnlockDB(DBdata)
-        return {}
+# Returns the whole experiments database as {key: [entries]}, in the
+# layout of the original ExpsDB.json. Entries are stored by
+# common.ExpsDB, which imports new entries of an existing JSON file.
+# If a database error occurs returns None.
+def LoadExpsDB(DBdata:dict)->dict:
     try:
-        with open(DBdata['dbfile'], 'r') as f:
-            DBcontent = json.load(f)
-            if not keeplock:
-                UnlockDB(DBdata)
-            return DBcontent
-    except Exception:
-        UnlockDB(DBdata)
-        print('Error: Unable to read experiments database file '+DBdata['dbfile'])
+        return ExpsDB.load_all(DBdata['dbfile'])
+    except Exception as e:
+        print('Error: Unable to read experiments database '+DBdata['dbfile']+': '+str(e))
         return None
 
-# Loads the current database with LoadExpsDB() and adds
-# the new entry and saves the updated data to the database.
-# Finally, unlocks the database file by removing the lock file.
+# Adds the new entry to the database. This appends a single row
+# in a transaction that holds the database write lock, so that
+# concurrent scripts cannot overwrite each other's entries.
 def UpdateExpsDB(DBdata:dict)->bool:
-    DBcontent = LoadExpsDB(DBdata, keeplock=True)
-    if DBcontent is None:
-        return False
-    
-    if DBdata['key'] not in DBcontent:
-        DBcontent[DBdata['key']] = []
-
-    DBcontent[DBdata['key']].append(DBdata['entry'])
-
     try:
-        with open(DBdata['dbfile'], 'w') as f:
-            json.dump(DBcontent, f, indent=2)
+        ExpsDB.append_entry(DBdata['dbfile'], DBdata['key'], DBdata['entry'])
     except Exception as e:
-        UnlockDB(DBdata)
-        print('Error: Unable to write updated experiments database to file '+DBdata['dbfile'])
+        print('Error: Unable to write entry to experiments database '+DBdata['dbfile']+': '+str(e))
         return False
-    UnlockDB(DBdata)
     return True
 
+# Adds the entries of a list of DBdata (e.g. all samples of a batch)
+# with one transaction per database file.
+def UpdateExpsDBBatch(DBdata_list:list)->bool:
+    byfile = {}
+    for DBdata in DBdata_list:
+        byfile.setdefault(DBdata['dbfile'], []).append( (DBdata['key'], DBdata['entry']) )
+    success = True
+    for dbfile, keyed_entries in byfile.items():
+        try:
+            ExpsDB.append_entries(dbfile, keyed_entries)
+        except Exception as e:
+            print('Error: Unable to write %d entries to experiments database %s: %s' % (len(keyed_entries), dbfile, str(e)))
+            success = False
+    return success
+
 def ErrorToDB(DBdata:dict, errmsg:str):
     print(errmsg)
     if 'error' in DBdata['entry']['OUT']:
@@ -217,23 +203,16 @@ def ExitOrReturn(DBdata:dict, exit_on_error:bool, errmsg:str, returnvalue=None):
         return returnvalue
 
 def GetMostRecentDBEntry(DBdata:dict, key:str, modelfromIN:bool, modelname:str, exit_on_error=True)->dict:
-    DBcontent = LoadExpsDB(DBdata)
-    if DBcontent is None:
-        return ExitOrReturn(DBdata, exit_on_error, 'Experiments database error: File read error')
-    if len(DBcontent) == 0:
-        return ExitOrReturn(DBdata, exit_on_error, 'Experiments database error: Database is empty')
-    if key not in DBcontent:
-        return ExitOrReturn(DBdata, exit_on_error, 'Experiments database error: Key %s not in database' % str(key))
     try:
-        if modelfromIN:
-            INorOUT = 'IN'
-        else:
-            INorOUT = 'OUT'
-        for DBentry in reversed(DBcontent[key]):
-            if DBentry[INorOUT]['modelname'] == modelname:
-                return DBentry
+        DBentry = ExpsDB.most_recent_entry(DBdata['dbfile'], key, modelfromIN, modelname)
+        if DBentry is not None:
+            return DBentry
+        if ExpsDB.count_entries(DBdata['dbfile']) == 0:
+            return ExitOrReturn(DBdata, exit_on_error, 'Experiments database error: Database is empty')
+        if ExpsDB.count_entries(DBdata['dbfile'], key) == 0:
+            return ExitOrReturn(DBdata, exit_on_error, 'Experiments database error: Key %s not in database' % str(key))
     except Exception as e:
-        return ExitOrReturn(DBdata, exit_on_error, 'Experiments database error: Database format is corrupted: '+str(e))
+        return ExitOrReturn(DBdata, exit_on_error, 'Experiments database error: '+str(e))
     return ExitOrReturn(DBdata, exit_on_error, 'Experiments database error: modelname %s not in database' % str(modelname))
 
 def GetMostRecentDBEntryIN(DBdata:dict, key:str, modelfromIN:bool, modelname:str, exit_on_error=True)->dict:
@@ -252,7 +231,23 @@ def GetMostRecentDBEntryOUT(DBdata:dict, key:str, modelfromIN:bool, modelname:st
         return ExitOrReturn(DBdata, exit_on_error, 'Experiments database error: Database format is corrupted: missing OUT')
     return DBentry['OUT']
 
-def ClientFromArgs(DBdata:dict, Args):
+# With pooled=True, requests to the API host share persistent HTTP
+# connections (at most max_connections at once) across all simulations
+# of the script, and per-endpoint latencies are recorded, see
+# PrintRequestStats().
+# With standin=True, the client talks to a local NES stand-in server
+# (NES_interfaces/StandInNES.py) at Args.Host:Args.Port instead.
+def ClientFromArgs(DBdata:dict, Args, pooled=False, max_connections=16, standin=False):
+    if pooled:
+        install_pooled_session(Args.Host, Args.Port, Args.UseHTTPS, max_connections)
+
+    if standin:
+        print(" -- Creating NES stand-in client for %s:%d" % (Args.Host, Args.Port))
+        ClientInstance = StandInClient(Args.Host, Args.Port, Args.UseHTTPS)
+        if not ClientInstance.IsReady():
+            ErrorExit(DBdata, 'NES stand-in error: not ready')
+        return None, ClientInstance
+
     # Create Client Configuration For Local Simulation
     print(" -- Creating Client Configuration For Local Simulation")
     ClientCfg = NES.Client.Configuration()
@@ -275,6 +270,16 @@ def ClientFromArgs(DBdata:dict, Args):
 
     return ClientCfg, ClientInstance
 
+# Prints the per-endpoint latency statistics of the pooled session and
+# optionally saves them to a JSON file.
+def PrintRequestStats(statsfile:str=None):
+    pooled_session = get_pooled_session()
+    if pooled_session is None:
+        return
+    print(pooled_session.latency_report())
+    if statsfile is not None:
+        pooled_session.save_latency_stats(statsfile)
+
 def NewSimulation(DBdata:dict, ClientInstance, Name, Seed=0):
     # Create A New Simulation
     print(" -- Creating Simulation")
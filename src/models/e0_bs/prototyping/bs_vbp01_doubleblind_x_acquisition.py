@@ -217,7 +217,7 @@ Usage: bs_vbp01_doubleblind_x_acquisition.py [-h] [-v] [-V output] [-t ms]
        -c         Calcium imaging y-axis center position.
        -L         Load known ground-truth system (KTG) ('' means generate,
                   default: kgt.json).
-       -A         Save acquired data (default: data.pkl.gz).
+       -A         Save acquired data (default: data.pkl.gz, .acq for chunked container).
        -K         Save known ground-truth system (KTG) as file (default:
                   kgt.json).
 
@@ -90,7 +90,7 @@ Usage: bs_vbp02_translation_iv_system_identification.py [-h] [-v] [-V output] [-
        [-K file] [-E file]
 %s
        -s         Skip system identification, simply duplicate KGT.
-       -L         Load acquired data from file (default: data.pkl.gz).
+       -L         Load acquired data from file (default: data.pkl.gz, also .pkl, .acq).
        -K         Load system from file (default: kgt.json).
        -E         Save emulated system to file (default: emu.json).
 
@@ -35,6 +35,7 @@ import argparse
 import vbpcommon as vbp
 from NES_interfaces.KGTRecords import plot_recorded
 import BrainGenix.NES as NES
+from NES_interfaces.ResponseCache import invalidate_saved_model
 
 
 Parser = argparse.ArgumentParser(description="LIFCNeuron test script")
@@ -537,6 +538,7 @@ else:
         )
 
     MySim.ModelSave('LIFtest')
+    invalidate_saved_model('LIFtest')
     print('Model saved')
 
     print('Made LIFC Receptors')
@@ -27,6 +27,7 @@ import base64
 
 import vbpcommon
 from BrainGenix.BG_API import NES
+from NES_interfaces.ResponseCache import invalidate_saved_model
 
 import argparse
 # Handle Arguments for Host, Port, etc
@@ -102,6 +103,7 @@ MySim = ClientInstance.CreateSimulation(SimulationCfg)
 MySim.Netmorph_RunAndWait(modelcontent)
 
 MySim.ModelSave(Args.modelname)
+invalidate_saved_model(Args.modelname)
 
 print(" -- Neuronal Circuit Model saved as "+Args.modelname)
 
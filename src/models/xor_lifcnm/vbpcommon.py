@@ -1,16 +1,20 @@
 # Enable common components used by multiple models:
 from datetime import datetime
-from time import sleep
-import json
-import os
 from sys import path
 from pathlib import Path
 
 path.insert(0, str(Path(__file__).parent.parent.parent)+'/components')
 
-from NES_interfaces.KGTRecords import extract_t_Vm, save_t_Vm_pickled, plot_t_Vm
+from NES_interfaces.KGTRecords import extract_t_Vm_array, save_t_Vm_store, plot_t_Vm
+from NES_interfaces.PlotQueue import get_plot_queue, wait_for_plots
+from common import ExpsDB
 
-def PlotAndStoreRecordedActivity(recording_dict:dict, savefolder:str, figspecs:dict)->bool:
+# With free_source=True the neuron records are removed from recording_dict
+# as they are converted to a dense Vm array.
+# With async_plots=True, the figure is rendered in a background process
+# and the call returns once the data is stored. Call WaitForPlots()
+# before exiting.
+def PlotAndStoreRecordedActivity(recording_dict:dict, savefolder:str, figspecs:dict, free_source=True, async_plots=False)->bool:
     if not isinstance(recording_dict, dict):
         print('Error: Recorded activity is not a dict')
         return False
@@ -24,17 +28,25 @@ def PlotAndStoreRecordedActivity(recording_dict:dict, savefolder:str, figspecs:d
         print('Error: Recorded activity content not usable: '+str(e))
         return False
     try:
-        t_ms, Vm_cells = extract_t_Vm(data=recording_dict["Recording"])
-        if not t_ms:
+        t_ms, Vm_cells, neuron_ids = extract_t_Vm_array(data=recording_dict["Recording"], free_source=free_source)
+        if t_ms is None or len(t_ms)==0:
             print('plot_recorded Error: No data to plot.')
             return False
-        save_t_Vm_pickled(t_ms, Vm_cells, savefolder)
-        plot_t_Vm(t_ms, Vm_cells, savefolder, figspecs)
+        save_t_Vm_store(t_ms, Vm_cells, savefolder, neuron_ids)
+        if async_plots:
+            get_plot_queue().submit('groundtruth-Vm', plot_t_Vm, t_ms, Vm_cells, savefolder, figspecs)
+        else:
+            plot_t_Vm(t_ms, Vm_cells, savefolder, figspecs)
     except Exception as e:
         print('Error: Failed to plot and store recorded acticity: '+str(e))
         return False
     return True
 
+# Waits for all plots queued with async_plots=True to be written.
+# Returns False if any of them failed.
+def WaitForPlots()->bool:
+    return wait_for_plots()
+
 def InitExpDB(_ExpsDB:str, _DBkey:str, _scriptversion:str, _initIN:dict, _initOUT:dict)->dict:
     _initIN['scriptversion'] = _DBkey+'-'+_scriptversion,
     _initIN['datetime'] = datetime.now().strftime('%Y%m%d%H%M%S'),
@@ -53,76 +65,43 @@ def AddInputToDB(DBdata:dict, inkey:str, indata):
 def AddOutputToDB(DBdata:dict, outkey:str, outdata):
     DBdata['entry']['OUT'][outkey] = outdata
 
-def UnlockDB(DBdata:dict)->bool:
-    lockfile = DBdata['dbfile']+'.locked'
-    if os.path.exists(lockfile):
-        os.remove(lockfile)
-        return True
-    return False
-
-def WaitToLockDB(DBdata:dict)->bool:
-    lockfile = DBdata['dbfile']+'.locked'
-    counts = 20
-    while os.path.exists(lockfile):
-        sleep(0.1)
-        counts -= 1
-        if counts == 0:
-            return False
-    try:
-        with open(lockfile, 'w') as f:
-            f.write('Locked by %s at %s' % (DBdata['key'], DBdata['entry']['IN']['datetime']))
-    except:
-        return False
-    return True
-
-# Waits until no one else is using the experiments database file
-# by checking if a lock file is present. Then, locks access by
-# making a lock file. Then reads the current database and returns
-# the data.
-# If no database file was found returns empty data.
-# If a file error occurs returns None.
-# The lock file is removed if a file error occurred.
-# Otherwise, the lock file is removed if keeplock is False.
-def LoadExpsDB(DBdata:dict, keeplock=False)->dict:
-    WaitToLockDB(DBdata)
-    if not os.path.exists(DBdata['dbfile']):
-        if not keeplock:
-            UnlockDB(DBdata)
-        return {}
+# Returns the whole experiments database as {key: [entries]}, in the
+# layout of the original ExpsDB.json. Entries are stored by
+# common.ExpsDB, which imports new entries of an existing JSON file.
+# If a database error occurs returns None.
+def LoadExpsDB(DBdata:dict)->dict:
     try:
-        with open(DBdata['dbfile'], 'r') as f:
-            DBcontent = json.load(f)
-            if not keeplock:
-                UnlockDB(DBdata)
-            return DBcontent
-    except Exception:
-        UnlockDB(DBdata)
-        print('Error: Unable to read experiments database file '+DBdata['dbfile'])
+        return ExpsDB.load_all(DBdata['dbfile'])
+    except Exception as e:
+        print('Error: Unable to read experiments database '+DBdata['dbfile']+': '+str(e))
         return None
 
-# Loads the current database with LoadExpsDB() and adds
-# the new entry and saves the updated data to the database.
-# Finally, unlocks the database file by removing the lock file.
+# Adds the new entry to the database. This appends a single row
+# in a transaction that holds the database write lock, so that
+# concurrent scripts cannot overwrite each other's entries.
 def UpdateExpsDB(DBdata:dict)->bool:
-    DBcontent = LoadExpsDB(DBdata, keeplock=True)
-    if DBcontent is None:
-        return False
-    
-    if DBdata['key'] not in DBcontent:
-        DBcontent[DBdata['key']] = []
-
-    DBcontent[DBdata['key']].append(DBdata['entry'])
-
     try:
-        with open(DBdata['dbfile'], 'w') as f:
-            json.dump(DBcontent, f, indent=2)
+        ExpsDB.append_entry(DBdata['dbfile'], DBdata['key'], DBdata['entry'])
     except Exception as e:
-        UnlockDB(DBdata)
-        print('Error: Unable to write updated experiments database to file '+DBdata['dbfile'])
+        print('Error: Unable to write entry to experiments database '+DBdata['dbfile']+': '+str(e))
         return False
-    UnlockDB(DBdata)
     return True
 
+# Adds the entries of a list of DBdata (e.g. all samples of a batch)
+# with one transaction per database file.
+def UpdateExpsDBBatch(DBdata_list:list)->bool:
+    byfile = {}
+    for DBdata in DBdata_list:
+        byfile.setdefault(DBdata['dbfile'], []).append( (DBdata['key'], DBdata['entry']) )
+    success = True
+    for dbfile, keyed_entries in byfile.items():
+        try:
+            ExpsDB.append_entries(dbfile, keyed_entries)
+        except Exception as e:
+            print('Error: Unable to write %d entries to experiments database %s: %s' % (len(keyed_entries), dbfile, str(e)))
+            success = False
+    return success
+
 def ErrorToDB(DBdata:dict, errmsg:str):
     print(errmsg)
     if 'error' in DBdata['entry']['OUT']:
@@ -141,23 +120,16 @@ def ExitOrReturn(DBdata:dict, exit_on_error:bool, errmsg:str, returnvalue=None):
         return returnvalue
 
 def GetMostRecentDBEntry(DBdata:dict, key:str, modelfromIN:bool, modelname:str, exit_on_error=True)->dict:
-    DBcontent = LoadExpsDB(DBdata)
-    if DBcontent is None:
-        return ExitOrReturn(DBdata, exit_on_error, 'Experiments database error: File read error')
-    if len(DBcontent) == 0:
-        return ExitOrReturn(DBdata, exit_on_error, 'Experiments database error: Database is empty')
-    if key not in DBcontent:
-        return ExitOrReturn(DBdata, exit_on_error, 'Experiments database error: Key %s not in database' % str(key))
     try:
-        if modelfromIN:
-            INorOUT = 'IN'
-        else:
-            INorOUT = 'OUT'
-        for DBentry in reversed(DBcontent[key]):
-            if DBentry[INorOUT]['modelname'] == modelname:
-                return DBentry
+        DBentry = ExpsDB.most_recent_entry(DBdata['dbfile'], key, modelfromIN, modelname)
+        if DBentry is not None:
+            return DBentry
+        if ExpsDB.count_entries(DBdata['dbfile']) == 0:
+            return ExitOrReturn(DBdata, exit_on_error, 'Experiments database error: Database is empty')
+        if ExpsDB.count_entries(DBdata['dbfile'], key) == 0:
+            return ExitOrReturn(DBdata, exit_on_error, 'Experiments database error: Key %s not in database' % str(key))
     except Exception as e:
-        return ExitOrReturn(DBdata, exit_on_error, 'Experiments database error: Database format is corrupted: '+str(e))
+        return ExitOrReturn(DBdata, exit_on_error, 'Experiments database error: '+str(e))
     return ExitOrReturn(DBdata, exit_on_error, 'Experiments database error: modelname %s not in database' % str(modelname))
 
 def GetMostRecentDBEntryIN(DBdata:dict, key:str, modelfromIN:bool, modelname:str, exit_on_error=True)->dict:
@@ -25,6 +25,7 @@ import argparse
 
 import vbpcommon as vbp
 from BrainGenix.BG_API import NES
+from NES_interfaces.ResponseCache import invalidate_saved_model
 
 
 # Handle Arguments for Host, Port, etc
@@ -461,6 +462,7 @@ except:
 tunedmodelname = Args.modelname+"-tuned"
 try:
     MySim.ModelSave(tunedmodelname)
+    invalidate_saved_model(tunedmodelname)
     vbp.AddOutputToDB(DBdata,'modelname', tunedmodelname)
     print("Saved modified model on server as: "+tunedmodelname)
 except:
@@ -11,22 +11,29 @@ Finds optimal parameters in ~30 tests instead of 200+ with grid search.
 
 Usage:
     ./bayesian_optimization.py --n-calls 30
+    ./bayesian_optimization.py --n-calls 30 --batch-size 6
+
+With --batch-size q > 1, q tests run concurrently as separate NES
+simulations. Points are proposed with the constant liar strategy (tests
+still running are assumed to score as well as the best result so far)
+and each result is fed back to the optimizer as soon as its test
+finishes, after which the next point is proposed.
 
 Reference: https://carboncopiespythondev.atlassian.net/wiki/spaces/PCD/pages/35356687/Fall+2025+internship+Netmorph+development
 """
 
 import numpy as np
 import pandas as pd
-from skopt import gp_minimize
+from skopt import gp_minimize, Optimizer
 from skopt.space import Real
 from skopt.utils import use_named_args
 import argparse
 import time
-import shutil
 import subprocess
+import threading
 import re
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from pathlib import Path
-from datetime import datetime
 
 # Paths
 XOR_DIR = Path.home() / "BrainGenix/BrainEmulationChallenge/src/models/xor_scnm"
@@ -45,54 +52,36 @@ class BayesianOptimizer:
     def __init__(self):
         self.test_count = 0
         self.results_history = []
-        self.config_backup = None
         self.log_dir = Path("bayesian_logs")
         self.log_dir.mkdir(exist_ok=True)
+        self.results_lock = threading.Lock()
         
-    def backup_config(self):
-        """Backup original config file"""
-        config_path = XOR_DIR / CONFIG_FILE
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        self.config_backup = self.log_dir / f"{CONFIG_FILE}.backup_{timestamp}"
-        shutil.copy2(config_path, self.config_backup)
-        print(f"✓ Backed up config to: {self.config_backup}\n")
-        
-    def restore_config(self):
-        """Restore original config file"""
-        if self.config_backup and self.config_backup.exists():
-            config_path = XOR_DIR / CONFIG_FILE
-            shutil.copy2(self.config_backup, config_path)
-            print(f"\n✓ Restored original config")
-            
-    def modify_config(self, B_inf, growth_nu0, turn_separation):
-        """Modify config file with new parameters"""
-        config_path = XOR_DIR / CONFIG_FILE
-        
-        with open(config_path, 'r') as f:
-            lines = f.readlines()
-        
+    def config_overrides(self, B_inf, growth_nu0, turn_separation):
+        """
+        Parameter overrides for the reservoir script. These are appended to
+        the model content in memory, the config file itself is not modified.
+        """
         params = {
             'all_axons.B_inf': B_inf,
             'all_axons.growth_nu0': growth_nu0,
             'turn_separation': turn_separation
         }
+        return [f"{param_name}={value}" for param_name, value in params.items()]
         
-        for param_name, value in params.items():
-            for i, line in enumerate(lines):
-                if line.strip().startswith(param_name + "="):
-                    lines[i] = f"{param_name}={value};\n"
-                    break
+    def trial_modelname(self, test_id):
+        """Model name of a test in batch mode, so concurrent tests do not overwrite each other's models"""
+        return f"xor_scnm-bo{test_id}"
         
-        with open(config_path, 'w') as f:
-            f.writelines(lines)
-            
-    def run_reservoir(self, test_id):
+    def run_reservoir(self, test_id, overrides, modelname=None):
         """Run reservoir generation"""
         log_file = self.log_dir / f"test_{test_id}_reservoir.log"
+        command = [RESERVOIR_SCRIPT, "-modelfile", CONFIG_FILE, "-Port", "8000", "-override"] + overrides
+        if modelname:
+            command += ["-modelname", modelname]
         
         try:
             result = subprocess.run(
-                [RESERVOIR_SCRIPT, "-modelfile", CONFIG_FILE, "-Port", "8000"],
+                command,
                 cwd=XOR_DIR,
                 capture_output=True,
                 text=True,
@@ -112,13 +101,16 @@ class BayesianOptimizer:
             print(f"  ✗ Error: {e}")
             return False
             
-    def run_connectome(self, test_id):
+    def run_connectome(self, test_id, modelname=None):
         """Run connectome analysis and parse results"""
         log_file = self.log_dir / f"test_{test_id}_connectome.log"
+        command = [CONNECTOME_SCRIPT]
+        if modelname:
+            command += ["-modelname", modelname]
         
         try:
             result = subprocess.run(
-                [CONNECTOME_SCRIPT],
+                command,
                 cwd=XOR_DIR,
                 capture_output=True,
                 text=True,
@@ -166,10 +158,18 @@ class BayesianOptimizer:
         Runs one actual NETMORPH test and returns negative convergent neurons
         (negative because optimizer minimizes by default, we want to maximize)
         """
-        B_inf, growth_nu0, turn_separation = params
-        
         self.test_count += 1
-        test_id = self.test_count
+        return self.run_test(self.test_count, params)
+        
+    def run_test(self, test_id, params, isolated=False):
+        """
+        Runs one NETMORPH test and returns negative convergent neurons.
+        With isolated=True the test uses its own model names, so that
+        several tests can run at the same time.
+        """
+        B_inf, growth_nu0, turn_separation = params
+        overrides = self.config_overrides(B_inf, growth_nu0, turn_separation)
+        modelname = self.trial_modelname(test_id) if isolated else None
         
         print(f"\n{'='*70}")
         print(f"Bayesian Optimization - Test {test_id}")
@@ -182,13 +182,9 @@ class BayesianOptimizer:
         
         start_time = time.time()
         
-        # Modify config
-        self.modify_config(B_inf, growth_nu0, turn_separation)
-        print("  ✓ Modified config")
-        
         # Run reservoir
-        print("  Running reservoir generation... (~11 minutes)")
-        if not self.run_reservoir(test_id):
+        print(f"  Running reservoir generation for test {test_id}... (~11 minutes)")
+        if not self.run_reservoir(test_id, overrides, modelname):
             elapsed = time.time() - start_time
             elapsed_str = self.format_time(elapsed)
             
@@ -202,17 +198,16 @@ class BayesianOptimizer:
                 'status': '✗ Failed',
                 'elapsed_time': elapsed_str
             }
-            self.results_history.append(result)
-            self.save_results()
+            self.record_result(result)
             
-            print(f"  ✗ Test failed - Elapsed time: {elapsed_str}")
+            print(f"  ✗ Test {test_id} failed - Elapsed time: {elapsed_str}")
             return 0.0  # Return 0 (worst possible score)
         
         print("  ✓ Reservoir complete")
         
         # Run connectome
         print("  Running connectome analysis...")
-        convergent = self.run_connectome(test_id)
+        convergent = self.run_connectome(test_id, modelname)
         
         elapsed = time.time() - start_time
         elapsed_str = self.format_time(elapsed)
@@ -232,7 +227,7 @@ class BayesianOptimizer:
             else:
                 status = '✗ Failed'
         
-        print(f"  ✓ Connectome complete: {convergent}/10 convergent neurons")
+        print(f"  ✓ Test {test_id} connectome complete: {convergent}/10 convergent neurons")
         print(f"  Result: {status} ({percentage})")
         print(f"  Elapsed time: {elapsed_str}")
         
@@ -247,13 +242,18 @@ class BayesianOptimizer:
             'status': status,
             'elapsed_time': elapsed_str
         }
-        self.results_history.append(result)
-        self.save_results()
+        self.record_result(result)
         
         # Return negative because optimizer MINIMIZES
         # We want to MAXIMIZE convergent neurons
         return -float(convergent)
         
+    def record_result(self, result):
+        """Add a test result to the history and save it (tests may finish concurrently)"""
+        with self.results_lock:
+            self.results_history.append(result)
+            self.save_results()
+            
     def save_results(self):
         """Save results to CSV"""
         df = pd.DataFrame(self.results_history)
@@ -299,6 +299,51 @@ class BayesianOptimizer:
         print("="*70 + "\n")
 
 
+def batch_minimize(optimizer, n_calls, n_initial, batch_size):
+    """
+    Asynchronous batch Bayesian optimization. Keeps batch_size tests
+    running. Each new point is proposed by a copy of the optimizer that
+    has been told that all running tests score as well as the best result
+    so far (constant liar), which keeps proposals from piling up on the
+    same spot. Results are told to the optimizer as tests finish.
+    """
+    opt = Optimizer(
+        dimensions=param_space,
+        base_estimator="GP",
+        n_initial_points=n_initial,
+        random_state=42
+    )
+    running = {}  # future -> proposed point
+    
+    def propose():
+        if not running or not opt.yi:
+            # Nothing to lie about yet, or no results to lie with (initial points are random).
+            return opt.ask()
+        liar = opt.copy(random_state=optimizer.test_count)
+        pending = list(running.values())
+        liar.tell(pending, [min(opt.yi)] * len(pending))
+        return liar.ask()
+    
+    with ThreadPoolExecutor(max_workers=batch_size) as executor:
+        while True:
+            while len(running) < batch_size and optimizer.test_count < n_calls:
+                x = propose()
+                optimizer.test_count += 1
+                running[executor.submit(optimizer.run_test, optimizer.test_count, x, True)] = x
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                x = running.pop(future)
+                try:
+                    y = future.result()
+                except Exception as e:
+                    print(f"  ✗ Error: {e}")
+                    y = 0.0
+                opt.tell(x, y)
+    return opt
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='Bayesian Optimization for NETMORPH parameters',
@@ -313,6 +358,9 @@ Example:
     
     # Longer optimization
     ./bayesian_optimization.py --n-calls 50
+    
+    # Run 6 tests at a time on the NES server
+    ./bayesian_optimization.py --n-calls 30 --batch-size 6
         """
     )
     
@@ -320,6 +368,8 @@ Example:
                        help='Number of optimization iterations (default: 30)')
     parser.add_argument('--n-initial', type=int, default=5,
                        help='Number of random initial tests (default: 5)')
+    parser.add_argument('--batch-size', type=int, default=1,
+                       help='Number of tests running concurrently (default: 1, sequential)')
     
     args = parser.parse_args()
     
@@ -329,15 +379,18 @@ Example:
     print(f"Total tests to run: {args.n_calls}")
     print(f"Initial random exploration: {args.n_initial}")
     print(f"Smart optimization: {args.n_calls - args.n_initial}")
-    print(f"Estimated total time: ~{args.n_calls * 11} minutes ({args.n_calls * 11 / 60:.1f} hours)")
+    print(f"Concurrent tests: {args.batch_size}")
+    estimated_minutes = -(-args.n_calls // args.batch_size) * 11
+    print(f"Estimated total time: ~{estimated_minutes} minutes ({estimated_minutes / 60:.1f} hours)")
     print("="*70 + "\n")
     
     # Initialize optimizer
     optimizer = BayesianOptimizer()
-    optimizer.backup_config()
     
-    try:
-        # Run Bayesian optimization
+    # Run Bayesian optimization
+    if args.batch_size > 1:
+        result = batch_minimize(optimizer, args.n_calls, args.n_initial, args.batch_size)
+    else:
         result = gp_minimize(
             func=optimizer.objective_function,
             dimensions=param_space,
@@ -346,13 +399,9 @@ Example:
             random_state=42,
             verbose=False 
         )
-        
-        # Print summary
-        optimizer.print_summary()
-        
-    finally:
-        # Always restore config
-        optimizer.restore_config()
+    
+    # Print summary
+    optimizer.print_summary()
     
     return 0
 
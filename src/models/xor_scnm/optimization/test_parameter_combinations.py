@@ -2,12 +2,10 @@
 import pandas as pd
 import subprocess
 import re
-import shutil
 import time
 import sys
 import argparse
 from pathlib import Path
-from datetime import datetime
 
 XOR_DIR = Path.home() / "BrainGenix/BrainEmulationChallenge/src/models/xor_scnm"
 CONFIG_FILE = "nesvbp-xor-res-sep-targets"
@@ -18,51 +16,22 @@ class CSVParameterTester:
     def __init__(self, csv_file, test_ids=None):
         self.csv_file = Path(csv_file)
         self.test_ids = test_ids
-        self.config_backup = None
         self.log_dir = Path("csv_test_logs")
         self.log_dir.mkdir(exist_ok=True)
         
-    def backup_config(self):
-        config_path = XOR_DIR / CONFIG_FILE
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        self.config_backup = self.log_dir / f"{CONFIG_FILE}.backup_{timestamp}"
-        shutil.copy2(config_path, self.config_backup)
-        print(f"✓ Backed up config to: {self.config_backup}")
+    def config_overrides(self, params):
+        # Rendered in memory and appended to the model content by the
+        # reservoir script, so the shared config file is never modified.
+        return [f"{param_name}={value}" for param_name, value in params.items()]
     
-    def restore_config(self):
-        if self.config_backup and self.config_backup.exists():
-            config_path = XOR_DIR / CONFIG_FILE
-            shutil.copy2(self.config_backup, config_path)
-            print(f"✓ Restored original config")
-    
-    def modify_config(self, params):
-        config_path = XOR_DIR / CONFIG_FILE
-        
-        with open(config_path, 'r') as f:
-            lines = f.readlines()
-        
-        modified = {}
-        
-        for param_name, value in params.items():
-            for i, line in enumerate(lines):
-                if line.strip().startswith(param_name + "="):
-                    lines[i] = f"{param_name}={value};\n"
-                    modified[param_name] = value
-                    break
-        
-        with open(config_path, 'w') as f:
-            f.writelines(lines)
-        
-        return modified
-    
-    def run_reservoir(self, test_id):
+    def run_reservoir(self, test_id, overrides):
         log_file = self.log_dir / f"test_{test_id}_reservoir.log"
         
         print(f"  Running reservoir generation... (~11 minutes)")
         
         try:
             result = subprocess.run(
-                [RESERVOIR_SCRIPT, "-modelfile", CONFIG_FILE, "-Port", "8000"],
+                [RESERVOIR_SCRIPT, "-modelfile", CONFIG_FILE, "-Port", "8000", "-override"] + overrides,
                 cwd=XOR_DIR,
                 capture_output=True,
                 text=True,
@@ -179,57 +148,50 @@ class CSVParameterTester:
             print("No tests to run!")
             return
         
-        self.backup_config()
-        
-        try:
-            for idx, row in df.iterrows():
-                print(f"\n{'='*60}")
-                print(f"Test {idx+1}/{len(df)} (ID: {row['test_id']})")
-                print(f"Note: {row['notes']}")
-                print(f"{'='*60}")
-                
-                start_time = time.time()
-                
-                params = {
-                    'all_axons.B_inf': row['all_axons.B_inf'],
-                    'all_axons.growth_nu0': row['all_axons.growth_nu0'],
-                    'turn_separation': row['turn_separation']
-                }
-                
-                print(f"  Parameters:")
-                for k, v in params.items():
-                    print(f"    {k} = {v}")
-                
-                modified = self.modify_config(params)
-                print(f"  ✓ Modified config")
-                
-                if not self.run_reservoir(row['test_id']):
-                    elapsed = time.time() - start_time
-                    df.at[idx, 'convergent_neurons'] = 'N/A'
-                    df.at[idx, 'percentage'] = '0%'
-                    df.at[idx, 'status'] = '✗ Failed'
-                    df.at[idx, 'elapsed_time'] = self.format_elapsed_time(elapsed)
-                else:
-                    convergent = self.run_connectome(row['test_id'])
-                    elapsed = time.time() - start_time
-                    status, percentage = self.classify_result(convergent)
-                    
-                    df.at[idx, 'convergent_neurons'] = convergent if convergent is not None else 'N/A'
-                    df.at[idx, 'percentage'] = percentage
-                    df.at[idx, 'status'] = status
-                    df.at[idx, 'elapsed_time'] = self.format_elapsed_time(elapsed)
-                
-                self.write_results(df)
-                
-                print(f"  Result: {df.at[idx, 'status']} ({df.at[idx, 'percentage']})")
-                print(f"  Elapsed time: {df.at[idx, 'elapsed_time']}")
+        for idx, row in df.iterrows():
+            print(f"\n{'='*60}")
+            print(f"Test {idx+1}/{len(df)} (ID: {row['test_id']})")
+            print(f"Note: {row['notes']}")
+            print(f"{'='*60}")
+            
+            start_time = time.time()
+            
+            params = {
+                'all_axons.B_inf': row['all_axons.B_inf'],
+                'all_axons.growth_nu0': row['all_axons.growth_nu0'],
+                'turn_separation': row['turn_separation']
+            }
+            
+            print(f"  Parameters:")
+            for k, v in params.items():
+                print(f"    {k} = {v}")
+            
+            overrides = self.config_overrides(params)
+            
+            if not self.run_reservoir(row['test_id'], overrides):
+                elapsed = time.time() - start_time
+                df.at[idx, 'convergent_neurons'] = 'N/A'
+                df.at[idx, 'percentage'] = '0%'
+                df.at[idx, 'status'] = '✗ Failed'
+                df.at[idx, 'elapsed_time'] = self.format_elapsed_time(elapsed)
+            else:
+                convergent = self.run_connectome(row['test_id'])
+                elapsed = time.time() - start_time
+                status, percentage = self.classify_result(convergent)
                 
-                if idx < len(df) - 1:
-                    print(f"\n  Waiting 5 seconds before next test...")
-                    time.sleep(5)
-        
-        finally:
-            self.restore_config()
+                df.at[idx, 'convergent_neurons'] = convergent if convergent is not None else 'N/A'
+                df.at[idx, 'percentage'] = percentage
+                df.at[idx, 'status'] = status
+                df.at[idx, 'elapsed_time'] = self.format_elapsed_time(elapsed)
+            
+            self.write_results(df)
+            
+            print(f"  Result: {df.at[idx, 'status']} ({df.at[idx, 'percentage']})")
+            print(f"  Elapsed time: {df.at[idx, 'elapsed_time']}")
+            
+            if idx < len(df) - 1:
+                print(f"\n  Waiting 5 seconds before next test...")
+                time.sleep(5)
         
         self.print_summary(df)
     
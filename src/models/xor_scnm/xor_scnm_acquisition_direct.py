@@ -24,6 +24,7 @@ import os
 import vbpcommon as vbp
 #from BrainGenix.BG_API import BG_API_Setup
 #from NES_interfaces.KGTRecords import plot_recorded
+from NES_interfaces.ImageStackDownload import download_image_stack
 import BrainGenix.NES as NES
 import BrainGenix
 from BrainGenix.Tools.StackStitcher import StackStitcher, CaImagingStackStitcher
@@ -52,6 +53,7 @@ Parser.add_argument("-SubdivideSize", default=5, type=int, help="Amount to subdi
 Parser.add_argument("-UseHTTPS", default=False, type=bool, help="Enable or disable HTTPS")
 Parser.add_argument("-DownloadEM", action="store_true", help="Enable downloading of EM Images")
 Parser.add_argument("-ExpsDB", default="./ExpsDB.json", type=str, help="Path to experiments database JSON file")
+Parser.add_argument("-savefolder", default=None, type=str, help="Front-end output folder (def: timestamped folder in output/)")
 Args = Parser.parse_args()
 
 if Args.simID:
@@ -153,7 +155,10 @@ else:
 
 
 # Prepare front-end output folder
-savefolder = 'output/'+datetime.now().strftime('%Y%m%d%H%M%S.%f')+'-acquisition'
+if Args.savefolder:
+    savefolder = Args.savefolder
+else:
+    savefolder = 'output/'+datetime.now().strftime('%Y%m%d%H%M%S.%f')+'-acquisition'
 vbp.AddOutputToDB(DBdata, 'output_folder', savefolder)
 
 TotalEMRenders:int = 0
@@ -394,8 +399,9 @@ if not Args.simID:
             vbp.ErrorToDB(DBdata, 'NES error: Failed to render CA images')
 
         try:
-            os.makedirs(CAimagesfolder)
-            VSDACAInstance.SaveImageStack(CAimagesfolder, 10)
+            # Resumes from the download manifest if tiles were retrieved before.
+            os.makedirs(CAimagesfolder, exist_ok=True)
+            download_image_stack(VSDACAInstance, CAimagesfolder, 10)
         except:
             vbp.ErrorToDB(DBdata, 'NES error: Failed to retrieve CA images to '+str(CAimagesfolder))
 
@@ -426,7 +432,7 @@ if not Args.simID:
     try:
         recording_dict = MySim.GetRecording()
 
-        if not vbp.PlotAndStoreRecordedActivity(recording_dict, savefolder, figspecs):
+        if not vbp.PlotAndStoreRecordedActivity(recording_dict, savefolder, figspecs, async_plots=True):
             vbp.ErrorToDB(DBdata, 'File error: Failed to store plots of recorded activity')
     except:
         vbp.ErrorToDB(DBdata, 'NES error: Failed to retrieve recorded activity')
@@ -680,8 +686,8 @@ if (Args.RenderEM):
             vbp.AddOutputToDB(DBdata, 'EMparamsfile', EMparams_file)
 
             try:
-                os.makedirs(EMoutput_folder)
-                NumImagesX, NumImagesY, NumSlices = VSDAEMInstance.SaveImageStack(EMoutput_folder, 20)
+                os.makedirs(EMoutput_folder, exist_ok=True)
+                NumImagesX, NumImagesY, NumSlices = download_image_stack(VSDAEMInstance, EMoutput_folder, 20)
             except Exception as e:
                 vbp.ErrorToDB(DBdata, 'File error: Failed to retrieve EM images: '+str(e))
                 EMerror = True
@@ -733,6 +739,10 @@ if (Args.RenderEM):
 
 # ----------------------------------------------------
 
+# Wait for figures rendered in the background
+if not vbp.WaitForPlots():
+    vbp.ErrorToDB(DBdata, 'File error: Failed to store plots of recorded activity')
+
 # Update experiments database file with results
 vbp.UpdateExpsDB(DBdata)
 
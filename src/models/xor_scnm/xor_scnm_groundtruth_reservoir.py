@@ -29,6 +29,7 @@ import argparse
 
 import vbpcommon as vbp
 from BrainGenix.BG_API import NES
+from NES_interfaces.ResponseCache import invalidate_saved_model
 
 
 # Handle Arguments for Host, Port, etc
@@ -39,6 +40,7 @@ Parser.add_argument("-UseHTTPS", default=False, type=bool, help="Enable or disab
 Parser.add_argument("-modelfile", type=str, help="File to read model instructions from")
 Parser.add_argument("-modelname", default="xor_scnm", type=str, help="Name of neuronal circuit model to save")
 Parser.add_argument("-growdays", type=int, help="Number of days Netmorph growth")
+Parser.add_argument("-override", default=[], type=str, nargs='*', help="Netmorph parameter overrides, e.g. all_axons.B_inf=12.5 turn_separation=4.0")
 Parser.add_argument("-DoOBJ", action='store_true', help="Netmorph should produce OBJ output")
 Parser.add_argument("-DoBlend", action='store_true', help="Netmorph should produce Blender output")
 Parser.add_argument("-BlendExec", default="/home/rkoene/blender-4.1.1-linux-x64/blender", type=str, help="Path to Blender executable")
@@ -57,6 +59,7 @@ DBdata = vbp.InitExpDB(
     _initIN = {
         'modelfile': Args.modelfile,
         'growdays_override': str(Args.growdays),
+        'parameter_overrides': ' '.join(Args.override),
     },
     _initOUT = {
         'modelname': Args.modelname,
@@ -92,12 +95,20 @@ GROWDAYS = '''
 days=%d;
 '''
 
+PARAMETER_OVERRIDE = '''
+%s;
+'''
+
 if Args.DoOBJ:
     modelcontent += NETMORPH_OBJ % (Args.BevelDepth, Args.BevelDepth)
 if Args.DoBlend:
     modelcontent += NETMORPH_BLEND % Args.BlendExec
 if Args.growdays:
     modelcontent += GROWDAYS % Args.growdays
+for override in Args.override:
+    if '=' not in override:
+        vbp.ErrorExit(DBdata, 'override error: expected parameter=value, got '+override)
+    modelcontent += PARAMETER_OVERRIDE % override.strip().rstrip(';')
 
 
 # Create Client Configuration For Local Simulation
@@ -144,6 +155,7 @@ print(" -- Netmorph output files directory is "+str(RunResponse["NetmorphOutputD
 # Save model at the NES server
 try:
     MySim.ModelSave(Args.modelname)
+    invalidate_saved_model(Args.modelname)
     print(" -- Neuronal Circuit Model saved as "+Args.modelname)
 except:
     vbp.ErrorExit(DBdata, 'NES error: Model save failed')